@@ -0,0 +1,302 @@
+import argparse
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import rasterio
+
+from image_io import IMAGE_EXTENSIONS
+from raster_windows import iter_windows
+from run_journal import atomic_write
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+from site_catalog import DEFAULT_COUNTS_PATH, SiteCatalog, location_of, parse_scene_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATS_PATH = "data/band_stats.json"
+
+# Histogram range and bins for percentiles (Landsat reflectance x 10000 fits well inside)
+DEFAULT_HIST_RANGE = (-2000, 20000)
+DEFAULT_BINS = 2200
+PERCENTILES = (0.5, 1, 2, 5, 25, 50, 75, 95, 98, 99, 99.5)
+
+# Window size for full-resolution reads, so memory does not grow with the scene size
+READ_TILE_SIZE = 1024
+
+# Images per task; a task returns one accumulator per site it saw
+IMAGES_PER_TASK = 16
+
+
+class BandStats:
+    """Mergeable per-band statistics: count, mean and M2 (Welford/Chan), min, max and a fixed-bin histogram.
+
+    Histogram bins cover hist_range; values outside it are counted in an
+    underflow and an overflow bin, so percentiles stay exact to one bin
+    width inside the range and fall back to min/max outside it.
+    """
+
+    def __init__(self, bands, hist_range=DEFAULT_HIST_RANGE, bins=DEFAULT_BINS):
+        self.hist_range = tuple(hist_range)
+        self.bins = bins
+        self.count = np.zeros(bands, dtype=np.int64)
+        self.mean = np.zeros(bands)
+        self.m2 = np.zeros(bands)
+        self.min = np.full(bands, np.inf)
+        self.max = np.full(bands, -np.inf)
+        self.hist = np.zeros((bands, bins + 2), dtype=np.int64)  # [underflow, bins..., overflow]
+        self.images = 0
+
+    def _merge_moments(self, band, count, mean, m2):
+        """Chan et al. parallel update of one band's count/mean/M2"""
+        total = self.count[band] + count
+        if total == 0:
+            return
+        delta = mean - self.mean[band]
+        self.mean[band] += delta * count / total
+        self.m2[band] += m2 + delta * delta * self.count[band] * count / total
+        self.count[band] = total
+
+    def update(self, data, nodata=None):
+        """Add a (bands, rows, cols) block, skipping nodata and NaN pixels"""
+        lo, hi = self.hist_range
+        scale = self.bins / (hi - lo)
+        for band, values in enumerate(data):
+            values = values.ravel()
+            valid = np.ones(values.shape, dtype=bool) if nodata is None else values != nodata
+            if values.dtype.kind == 'f':
+                valid &= ~np.isnan(values)
+            if not valid.all():
+                values = values[valid]
+            if values.size == 0:
+                continue
+            values64 = values.astype(np.float64)
+            mean = values64.mean()
+            self._merge_moments(band, values.size, mean, float(np.square(values64 - mean).sum()))
+            self.min[band] = min(self.min[band], values64.min())
+            self.max[band] = max(self.max[band], values64.max())
+            # Bin 0 is the underflow and bin bins + 1 the overflow
+            index = np.floor((values64 - lo) * scale).astype(np.int64) + 1
+            np.clip(index, 0, self.bins + 1, out=index)
+            self.hist[band] += np.bincount(index, minlength=self.bins + 2)
+
+    def merge(self, other):
+        if other.hist_range != self.hist_range or other.bins != self.bins:
+            raise ValueError("Cannot merge statistics with different histogram bins")
+        for band in range(len(self.count)):
+            self._merge_moments(band, other.count[band], other.mean[band], other.m2[band])
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self.hist += other.hist
+        self.images += other.images
+        return self
+
+    def std(self):
+        return np.sqrt(self.m2 / np.maximum(self.count, 1))
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """{percentile: per-band values}, linearly interpolated inside the histogram bins"""
+        lo, hi = self.hist_range
+        width = (hi - lo) / self.bins
+        result = {}
+        for p in percentiles:
+            values = []
+            for band in range(len(self.count)):
+                if self.count[band] == 0:
+                    values.append(None)
+                    continue
+                cumulative = np.cumsum(self.hist[band])
+                rank = p / 100 * self.count[band]
+                b = int(np.searchsorted(cumulative, rank, side='left'))
+                if b == 0:
+                    value = self.min[band]
+                elif b == self.bins + 1:
+                    value = self.max[band]
+                else:
+                    before = cumulative[b - 1]
+                    value = lo + (b - 1 + (rank - before) / max(self.hist[band, b], 1)) * width
+                    value = min(max(value, self.min[band]), self.max[band])
+                values.append(float(value))
+            result[f"{p:g}"] = values
+        return result
+
+    def to_dict(self, percentiles=PERCENTILES):
+        def floats(array):
+            return [float(v) if np.isfinite(v) else None for v in array]
+        return {
+            'images': self.images,
+            'count': [int(n) for n in self.count],
+            'mean': floats(self.mean),
+            'std': floats(self.std()),
+            'min': floats(self.min),
+            'max': floats(self.max),
+            'percentiles': self.percentiles(percentiles),
+        }
+
+
+def find_images(images_dir):
+    """Images (.tif/.vrt) under images_dir, flat (data/images) or per site (dataset1/<split>/images/<site_no>/)"""
+    return sorted(path for ext in IMAGE_EXTENSIONS
+                  for path in glob.glob(os.path.join(images_dir, "**", f"*{ext}"), recursive=True))
+
+
+def image_base_site(path, images_dir):
+    """Base site of an image from its filename, or from its site folder in the MOSE layout"""
+    parent = os.path.dirname(path)
+    if os.path.normpath(parent) != os.path.normpath(images_dir):
+        return parse_scene_name(os.path.basename(parent)).base_site
+    return parse_scene_name(os.path.basename(path)).base_site
+
+
+def image_stats(path, decimate=1, hist_range=DEFAULT_HIST_RANGE, bins=DEFAULT_BINS):
+    """BandStats of one image, read window by window or (decimate > 1) as one decimated read"""
+    with rasterio.open(path) as src:
+        stats = BandStats(src.count, hist_range, bins)
+        if decimate > 1:
+            out_shape = (src.count, max(1, src.height // decimate), max(1, src.width // decimate))
+            stats.update(src.read(out_shape=out_shape), src.nodata)
+        else:
+            for window in iter_windows(src, READ_TILE_SIZE):
+                stats.update(src.read(window=window), src.nodata)
+    stats.images = 1
+    return stats
+
+
+def site_task(images, decimate=1, hist_range=DEFAULT_HIST_RANGE, bins=DEFAULT_BINS):
+    """Per-site statistics of a list of (base site, path); returns ({site: BandStats}, [(path, error)])"""
+    sites, errors = {}, []
+    for base_site, path in images:
+        try:
+            stats = image_stats(path, decimate, hist_range, bins)
+        except Exception as e:
+            errors.append((path, str(e)))
+            continue
+        if base_site in sites:
+            sites[base_site].merge(stats)
+        else:
+            sites[base_site] = stats
+    return sites, errors
+
+
+def compute_band_stats(images_dir="data/images", decimate=1, workers=1, hist_range=DEFAULT_HIST_RANGE,
+                       bins=DEFAULT_BINS, catalog=None, split=None):
+    """Statistics of every image under images_dir per group: all, split/<split>, continent/<c> and site/<base site>.
+
+    split forces the split of every image (e.g. for dataset1/<split>/images);
+    otherwise it comes from the site catalogue.
+    """
+    paths = find_images(images_dir)
+    images = [(image_base_site(path, images_dir), path) for path in paths]
+    tasks = [images[i:i + IMAGES_PER_TASK] for i in range(0, len(images), IMAGES_PER_TASK)]
+    site_stats, errors = {}, []
+
+    with Progress(len(images), "Images", unit="images", logger=logger) as progress:
+        def collect(result, task):
+            sites, task_errors = result
+            for base_site, stats in sites.items():
+                if base_site in site_stats:
+                    site_stats[base_site].merge(stats)
+                else:
+                    site_stats[base_site] = stats
+            errors.extend(task_errors)
+            progress.update(len(task))
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(site_task, task, decimate, hist_range, bins): task for task in tasks}
+                for future in as_completed(futures):
+                    collect(future.result(), futures[future])
+        else:
+            for task in tasks:
+                collect(site_task(task, decimate, hist_range, bins), task)
+
+    for path, error in errors:
+        logger.error(f"❌ Error reading {path}: {error}")
+
+    # Every coarser group is a merge of whole sites
+    groups = {}
+    for base_site in sorted(site_stats):
+        stats = site_stats[base_site]
+        entry = catalog.site(base_site) if catalog is not None else None
+        site_split = split or (entry['split'] if entry else None) or 'unknown'
+        continent = entry['continent'] if entry else location_of(base_site)[1]
+        for group in ('all', f"split/{site_split}", f"continent/{continent}", f"site/{base_site}"):
+            if group not in groups:
+                groups[group] = BandStats(len(stats.count), hist_range, bins)
+            groups[group].merge(stats)
+    return groups, errors
+
+
+def save_band_stats(path, groups, params):
+    """Write the statistics JSON: parameters plus per group count, mean, std, min, max and percentiles"""
+    payload = {'params': params, 'groups': {name: groups[name].to_dict() for name in sorted(groups)}}
+    atomic_write(path, json.dumps(payload, indent=1))
+
+
+def load_band_stats(path=DEFAULT_STATS_PATH, group='all'):
+    """One group's statistics from the JSON, with mean/std/min/max as float arrays (e.g. for normalization)"""
+    with open(path) as f:
+        stats = json.load(f)['groups'][group]
+    for key in ('mean', 'std', 'min', 'max'):
+        stats[key] = np.array([np.nan if v is None else v for v in stats[key]])
+    return stats
+
+
+def format_stat(value):
+    return f"{'n/a':>10}" if value is None else f"{value:10.2f}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-band mean, std and percentiles of the images, per split, continent and site")
+    parser.add_argument("images_dir", nargs="?", default="data/images",
+                        help="Image tree (data/images or dataset1/<split>/images)")
+    parser.add_argument("--output", default=DEFAULT_STATS_PATH, help="Statistics JSON")
+    parser.add_argument("--split", default=None,
+                        help="Split of every image (default: from base_site_counts.csv)")
+    parser.add_argument("--site-counts", default=DEFAULT_COUNTS_PATH,
+                        help="base_site_counts.csv with the split of every base site")
+    parser.add_argument("--decimate", type=int, default=1,
+                        help="Read every image at 1/N resolution (served from overviews when present)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes (1 = sequential)")
+    parser.add_argument("--hist-range", type=float, nargs=2, default=DEFAULT_HIST_RANGE, metavar=("LO", "HI"),
+                        help="Value range of the percentile histogram")
+    parser.add_argument("--bins", type=int, default=DEFAULT_BINS,
+                        help="Histogram bins over --hist-range (percentile resolution)")
+    add_logging_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+    catalog = SiteCatalog.load(args.site_counts) if os.path.exists(args.site_counts) else None
+
+    logger.info(f"\n=== Band statistics of {args.images_dir} ===")
+    groups, errors = compute_band_stats(args.images_dir, args.decimate, args.workers, args.hist_range, args.bins,
+                                        catalog, args.split)
+    if not groups:
+        logger.error(f"❌ No images found in {args.images_dir}")
+        return
+
+    params = {'images_dir': args.images_dir, 'decimate': args.decimate,
+              'hist_range': list(args.hist_range), 'bins': args.bins}
+    save_band_stats(args.output, groups, params)
+
+    overall = groups['all']
+    logger.info(f"\n✅ Statistics of {overall.images} images in {len(groups)} groups saved to {args.output}")
+    percentiles = overall.percentiles((2, 98))
+    std = overall.std()
+    for band in range(len(overall.count)):
+        # A band without valid pixels has no statistics
+        mean, sd = (overall.mean[band], std[band]) if overall.count[band] else (None, None)
+        logger.info(f"  Band {band + 1}: mean {format_stat(mean)}  std {format_stat(sd)}  "
+                    f"p2 {format_stat(percentiles['2'][band])}  p98 {format_stat(percentiles['98'][band])}")
+    if errors:
+        logger.error(f"❌ {len(errors)} images could not be read")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyproj
+import rasterio
+from rasterio.transform import from_origin
+
+import create_gt
+from create_gt import calculate_ndvi_mask, combine_masks
+from generate_rgb import write_preview
+from kml_index import PolygonStore
+from label_fusion import available_backends, fuse_labels
+from label_io import write_label
+import reorganize_dataset
+
+# Synthetic scenes are placed in UTM zone 29N around (-11, 13), like the Mali sites
+SYNTHETIC_CRS = "EPSG:32629"
+SYNTHETIC_ORIGIN_LONLAT = (-11.0, 13.0)
+PIXEL_SIZE = 30
+
+
+def best_time(fn, repeats=5):
+    """Best wall time of fn() over repeats runs (after one warm-up call) and its last result"""
+    result = fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def synthetic_fusion_inputs(shape, seed=0):
+    """Landsat-like NIR/Red bands, a cloud band and a base mining mask"""
+    rng = np.random.default_rng(seed)
+    nir = rng.integers(0, 6000, shape, dtype=np.uint16)
+    red = rng.integers(0, 6000, shape, dtype=np.uint16)
+    cloud = (rng.random(shape) < 0.2).astype(np.uint16)
+    base_mask = np.where(rng.random(shape) < 0.3, 2, 0).astype(np.uint8)
+    return nir, red, cloud, base_mask
+
+
+def reference_fusion(nir, red, cloud, base_mask):
+    """The original create_gt.py path, including the copy of the cached base mask"""
+    mask = base_mask.copy()
+    vegetation_mask = calculate_ndvi_mask(nir, red)
+    return combine_masks(mask, vegetation_mask, cloud.astype(np.uint8))
+
+
+def bench_label_fusion(shape=(4096, 4096), repeats=5):
+    """Time fuse_labels() backends against the reference path and check they agree"""
+    nir, red, cloud, base_mask = synthetic_fusion_inputs(shape)
+    mpix = shape[0] * shape[1] / 1e6
+
+    seconds, expected = best_time(lambda: reference_fusion(nir, red, cloud, base_mask), repeats)
+    results = {'reference': {'seconds': seconds, 'mpix_per_s': mpix / seconds, 'matches_reference': True}}
+
+    out = np.empty(shape, dtype=np.uint8)
+    for backend in available_backends():
+        seconds, label = best_time(lambda: fuse_labels(nir, red, cloud, base_mask, backend=backend, out=out),
+                                   repeats)
+        results[f'fuse_labels[{backend}]'] = {
+            'seconds': seconds,
+            'mpix_per_s': mpix / seconds,
+            'matches_reference': bool(np.array_equal(label, expected)),
+        }
+    return results
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (MB)"""
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+
+def git_commit():
+    """Commit the benchmark ran against, if run inside a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def kml_ring(transformer, cx, cy, radius, vertices, rng):
+    """KML coordinates of an irregular ring around (cx, cy) in projected metres"""
+    angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+    radii = radius * rng.uniform(0.6, 1.0, vertices)
+    lon, lat = transformer.transform(cx + radii * np.cos(angles), cy + radii * np.sin(angles))
+    points = [f"{x:.7f},{y:.7f},0" for x, y in zip(lon, lat)]
+    return " ".join(points + points[:1])
+
+
+def make_synthetic_dataset(root, n_sites=4, scenes_per_site=5, size=(1024, 1024),
+                           polygons_per_site=50, polygon_radius=1500, vertices=200, seed=0):
+    """Write 8-band Landsat-like GeoTIFFs, the metadata CSV and a KML under root.
+
+    The layout matches what create_gt.py expects (metadata/, mining_ndvi_timeseries/).
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, "metadata"), exist_ok=True)
+    os.makedirs(os.path.join(root, "mining_ndvi_timeseries"), exist_ok=True)
+    to_utm = pyproj.Transformer.from_crs("EPSG:4326", SYNTHETIC_CRS, always_xy=True)
+    to_lonlat = pyproj.Transformer.from_crs(SYNTHETIC_CRS, "EPSG:4326", always_xy=True)
+    x0, y0 = to_utm.transform(*SYNTHETIC_ORIGIN_LONLAT)
+    height, width = size
+    extent_x, extent_y = width * PIXEL_SIZE, height * PIXEL_SIZE
+
+    rows = []
+    placemarks = []
+    for site in range(n_sites):
+        base_site = f"bench_site_{site}_agm_region"
+        # Sites sit side by side, each on its own grid
+        left, top = x0 + site * 2 * extent_x, y0
+        for idx in range(polygons_per_site):
+            cx = left + rng.uniform(0, extent_x)
+            cy = top - rng.uniform(0, extent_y)
+            coords = kml_ring(to_lonlat, cx, cy, polygon_radius, vertices, rng)
+            placemarks.append(
+                f"<Placemark><name>{base_site}_{idx}</name><Polygon><outerBoundaryIs><LinearRing>"
+                f"<coordinates>{coords}</coordinates></LinearRing></outerBoundaryIs></Polygon></Placemark>"
+            )
+        for scene in range(scenes_per_site):
+            image_id = f"Landsat_Image_{base_site}_1_2020{scene % 12 + 1:02d}{scene // 12 + 1:02d}.tif"
+            bands = rng.integers(0, 4000, (8, height, width), dtype=np.uint16)
+            bands[7] = rng.random((height, width)) < 0.2  # Cloud band
+            profile = dict(driver='GTiff', width=width, height=height, count=8, dtype='uint16',
+                           crs=SYNTHETIC_CRS, transform=from_origin(left, top, PIXEL_SIZE, PIXEL_SIZE))
+            with rasterio.open(os.path.join(root, "mining_ndvi_timeseries", image_id), 'w', **profile) as dst:
+                dst.write(bands)
+            rows.append({'image_id': image_id, 'site_no': f"{base_site}_1"})
+
+    pd.DataFrame(rows).to_csv(os.path.join(root, "metadata", "image_file_metadata.csv"), index=False)
+    with open(os.path.join(root, "metadata", "global_mining_extents_detailed.kml"), 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n')
+        f.write("\n".join(placemarks))
+        f.write("\n</Document></kml>\n")
+    return rows
+
+
+def stage_result(seconds, scenes=None, nbytes=None):
+    result = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+    if scenes:
+        result['scenes_per_s'] = scenes / seconds if seconds else None
+    if nbytes:
+        result['mb_per_s'] = nbytes / 1e6 / seconds if seconds else None
+    return result
+
+
+def bench_pipeline(root, rows):
+    """Time each stage of create_gt.py and reorganize_dataset.py on the synthetic dataset in root"""
+    cwd = os.getcwd()
+    os.chdir(root)
+    stages = {}
+    try:
+        kml_path = create_gt.kml_path
+        start = time.perf_counter()
+        store = PolygonStore.from_kml(kml_path)
+        stages['kml_parse'] = stage_result(time.perf_counter() - start, nbytes=os.path.getsize(kml_path))
+        create_gt.polygon_store = store
+
+        scenes = []
+        for row in rows:
+            with rasterio.open(os.path.join("mining_ndvi_timeseries", row['image_id'])) as src:
+                scenes.append((row, src.bounds, src.crs, src.transform, (src.height, src.width)))
+        scene_bytes = sum(os.path.getsize(os.path.join("mining_ndvi_timeseries", r['image_id'])) for r in rows)
+
+        # Polygon lookup + reprojection to the image CRS + clipping to the image
+        start = time.perf_counter()
+        polygons = [create_gt.get_polygons_for_site(create_gt.base_site_name(row['site_no']), bounds, crs)
+                    for row, bounds, crs, _, _ in scenes]
+        stages['reprojection'] = stage_result(time.perf_counter() - start, len(rows))
+
+        start = time.perf_counter()
+        masks = [create_gt.generate_base_mask(polys, shape, transform)
+                 for polys, (_, _, _, transform, shape) in zip(polygons, scenes)]
+        stages['rasterize'] = stage_result(time.perf_counter() - start, len(rows))
+
+        start = time.perf_counter()
+        bands = []
+        for row in rows:
+            with rasterio.open(os.path.join("mining_ndvi_timeseries", row['image_id'])) as src:
+                bands.append(src.read())
+        stages['read'] = stage_result(time.perf_counter() - start, len(rows), scene_bytes)
+
+        start = time.perf_counter()
+        labels = [fuse_labels(b[3], b[2], b[7], mask) for b, mask in zip(bands, masks)]
+        stages['ndvi_fusion'] = stage_result(time.perf_counter() - start, len(rows))
+
+        os.makedirs("bench_png", exist_ok=True)
+        start = time.perf_counter()
+        for idx, (b, label) in enumerate(zip(bands, labels)):
+            write_label(os.path.join("bench_png", f"{idx}_label.png"), label)
+            write_preview(os.path.join("bench_png", f"{idx}_rgb.png"), b[2], b[1], b[0])
+        png_bytes = sum(os.path.getsize(os.path.join("bench_png", f)) for f in os.listdir("bench_png"))
+        stages['png_write'] = stage_result(time.perf_counter() - start, len(rows), png_bytes)
+        del bands, labels, masks
+
+        # End to end, exactly as create_gt.py runs it (sequential)
+        os.makedirs("data/images", exist_ok=True)
+        os.makedirs("data/labels", exist_ok=True)
+        os.makedirs("data/rgb", exist_ok=True)
+        df = pd.DataFrame(rows)
+        start = time.perf_counter()
+        for site_no, image_ids in create_gt.group_images_by_site(df):
+            create_gt.process_site_group(site_no, image_ids)
+        stages['create_gt'] = stage_result(time.perf_counter() - start, len(rows), scene_bytes)
+
+        image_files = reorganize_dataset.get_image_files()
+        data_bytes = sum(os.path.getsize(os.path.join(dirpath, f))
+                         for dirpath, _, files in os.walk("data") for f in files)
+        reorganize_dataset.create_dataset_structure()
+        start = time.perf_counter()
+        reorganize_dataset.organize_files_by_site(image_files, "train")
+        stages['reorganize'] = stage_result(time.perf_counter() - start, len(rows), data_bytes)
+    finally:
+        os.chdir(cwd)
+    return stages
+
+
+def compare_results(current, baseline):
+    """Print per-stage speedups of current over a baseline results JSON"""
+    print(f"\n=== Compared to {baseline.get('meta', {}).get('commit') or 'baseline'} ===")
+    for section in ('stages', 'label_fusion'):
+        for name, stats in current.get(section, {}).items():
+            old = baseline.get(section, {}).get(name)
+            if old and stats['seconds']:
+                ratio = old['seconds'] / stats['seconds']
+                flag = "⚠️ " if ratio < 0.9 else ""
+                print(f"{flag}{name:24s} {old['seconds']:8.3f}s -> {stats['seconds']:8.3f}s  ({ratio:.2f}x)")
+
+
+def print_stages(stages):
+    print("\n=== Pipeline stages ===")
+    for name, stats in stages.items():
+        throughput = []
+        if stats.get('scenes_per_s'):
+            throughput.append(f"{stats['scenes_per_s']:8.2f} scenes/s")
+        if stats.get('mb_per_s'):
+            throughput.append(f"{stats['mb_per_s']:8.1f} MB/s")
+        print(f"{name:14s} {stats['seconds']:8.3f}s  {'  '.join(throughput):34s} peak RSS {stats['peak_rss_mb']:.0f} MB")
+
+
+def print_results(title, results):
+    print(f"\n=== {title} ===")
+    for name, stats in results.items():
+        match = "✅" if stats['matches_reference'] else "❌ differs from reference"
+        print(f"{name:24s} {stats['seconds'] * 1000:9.1f} ms  {stats['mpix_per_s']:8.1f} Mpix/s  {match}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dataset-generation pipeline on synthetic data")
+    parser.add_argument("--sites", type=int, default=4)
+    parser.add_argument("--scenes-per-site", type=int, default=5)
+    parser.add_argument("--size", type=int, nargs=2, default=[1024, 1024], metavar=("ROWS", "COLS"),
+                        help="Synthetic scene size")
+    parser.add_argument("--polygons-per-site", type=int, default=50)
+    parser.add_argument("--polygon-radius", type=float, default=1500, help="Polygon radius in metres")
+    parser.add_argument("--vertices", type=int, default=200, help="Vertices per polygon")
+    parser.add_argument("--fusion-size", type=int, nargs=2, default=[4096, 4096], metavar=("ROWS", "COLS"),
+                        help="Scene size of the label fusion micro-benchmark")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--only-fusion", action="store_true", help="Only run the label fusion micro-benchmark")
+    parser.add_argument("--workdir", help="Directory for the synthetic dataset (default: a temporary directory)")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = {'meta': {'commit': git_commit(), 'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        'params': vars(args)}}
+
+    if not args.only_fusion:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as root:
+            print(f"\n=== Generating synthetic dataset in {root} ===")
+            rows = make_synthetic_dataset(root, args.sites, args.scenes_per_site, tuple(args.size),
+                                          args.polygons_per_site, args.polygon_radius, args.vertices)
+            results['stages'] = bench_pipeline(root, rows)
+        print_stages(results['stages'])
+
+    results['label_fusion'] = bench_label_fusion(tuple(args.fusion_size), args.repeats)
+    print_results(f"Label fusion ({args.fusion_size[0]}x{args.fusion_size[1]})", results['label_fusion'])
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n✅ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
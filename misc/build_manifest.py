@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+
+DEFAULT_MANIFEST_PATH = "data/build_manifest.json"
+
+
+def file_signature(path):
+    """Cheap change signature of a file: (mtime in ns, size)"""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def build_key(inputs=(), params=None, extra=None):
+    """Digest of everything an output depends on.
+
+    inputs are file paths (tracked by mtime/size), params the processing
+    parameters and extra any precomputed content digests (e.g. per-site
+    polygon hashes).
+    """
+    payload = {
+        'inputs': {path: file_signature(path) for path in inputs},
+        'params': params or {},
+        'extra': extra or {},
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class BuildManifest:
+    """JSON record of the inputs and parameters every output was built from.
+
+    Targets are namespaced by script (e.g. "create_gt:<image_id>"), so all
+    pipeline steps share one manifest in data/.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_up_to_date(self, target, key, outputs):
+        """True if target was built with the same key and all its outputs still exist"""
+        entry = self.entries.get(target)
+        if entry is None or entry['key'] != key:
+            return False
+        return all(os.path.exists(output) for output in outputs)
+
+    def record(self, target, key, outputs):
+        self.entries[target] = {'key': key, 'outputs': list(outputs)}
+
+    def forget(self, target):
+        self.entries.pop(target, None)
+
+    def save(self):
+        """Write the manifest atomically"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
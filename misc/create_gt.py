@@ -1,49 +1,115 @@
 import rasterio
 from rasterio.features import rasterize
-from shapely.geometry import Polygon, shape, box
-from shapely.ops import transform
-from xml.etree import ElementTree as ET
+from rasterio.warp import transform_bounds
+from shapely.geometry import box
 import numpy as np
-import pyproj
 import os
-import shutil
-import re
-import pandas as pd
+import argparse
+import logging
+import time
+import shapely
 from shapely.errors import GEOSException
-import matplotlib.pyplot as plt
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+from kml_index import DEFAULT_RESOLUTION_M, PolygonStore, base_site_name
+from generate_rgb import rgb_output_path, rgba_composite, write_preview
+from raster_windows import iter_windows, StreamingCopyWriter
+from label_io import LABEL_FORMATS, label_filename, write_label, WindowedLabelWriter
+from rasterio.windows import transform as window_transform
+from build_manifest import BuildManifest, build_key
+from image_io import IMAGE_FORMATS, image_filename, write_image, WindowedImageWriter
+from label_fusion import BACKENDS, DEFAULT_PRIORITY, NDVI_THRESHOLD, fuse_labels
+from reprojection import ProjectedSites
+from mask_cache import DEFAULT_MAX_MB, MaskCache, grid_key
+from run_log import Progress, StageProfiler, add_logging_args, setup_logging, verbosity
+from run_journal import CHECKPOINT_EVERY, RunJournal, journal_paths
+from metadata_io import count_rows, read_metadata_chunks
+from stage_pipeline import DEFAULT_DEPTH, run_pipeline
+
+logger = logging.getLogger(__name__)
 
 # File paths
 kml_path = "metadata/global_mining_extents_detailed.kml"
 metadata_path = "metadata/image_file_metadata.csv"
 
-# Read metadata CSV
-df = pd.read_csv(metadata_path)
-print(f"\n=== Processing {len(df)} images ===")
+# Dictionary to store generated labels
+base_mask_cache = MaskCache()  # Base mining masks by (site polygons, CRS, transform, shape)
+polygon_store = None  # KML polygons, parsed once (or loaded from the on-disk cache)
+polygon_resolution_m = DEFAULT_RESOLUTION_M  # Pixel size the polygons are simplified for (0 = repair only)
+projected_sites = None  # Site polygons reprojected per (base site, CRS)
+scene_buffers = {}  # Reused per-process buffers by name ('bands', 'label')
+profiler = StageProfiler()  # Per-scene wall time of each stage
 
-# Create output directories if they don't exist
-os.makedirs("data/images", exist_ok=True)
-os.makedirs("data/labels", exist_ok=True)
+# Site groups queued per worker process; the rest of the metadata stays unread until needed
+GROUPS_IN_FLIGHT_PER_WORKER = 2
 
-# Dictionary to store generated labels
-base_mask_cache = {}  # Cache for base mining masks by site_no
+def get_polygon_store():
+    """Load the KML polygon store on first use"""
+    global polygon_store
+    if polygon_store is None:
+        polygon_store = PolygonStore.load(kml_path, resolution_m=polygon_resolution_m)
+    return polygon_store
 
-def calculate_ndvi_mask(image_path):
-    """Calculate NDVI mask where NDVI > 0.5 (vegetation)"""
-    with rasterio.open(image_path) as src:
-        # Read B4 (NIR) and B3 (Red) bands
-        b4 = src.read(4).astype(np.float32)  # NIR band
-        b3 = src.read(3).astype(np.float32)  # Red band
-        
-        # Calculate NDVI
-        denominator = b4 + b3
-        # Avoid division by zero
-        denominator[denominator == 0] = 1e-6
-        ndvi = (b4 - b3) / denominator
-        
-        # Create mask where NDVI > 0.5 (vegetation)
-        vegetation_mask = ndvi > 0.5
-        
-        return vegetation_mask
+def configure_polygon_store(resolution_m=DEFAULT_RESOLUTION_M):
+    """Simplify the KML polygons for pixels of resolution_m metres (0 = repair only) from the next load on"""
+    global polygon_store, polygon_resolution_m
+    if resolution_m != polygon_resolution_m:
+        polygon_store = None
+    polygon_resolution_m = resolution_m
+
+def get_projected_sites():
+    """Reprojection memo for the current polygon store"""
+    global projected_sites
+    store = get_polygon_store()
+    if projected_sites is None or projected_sites.store is not store:
+        projected_sites = ProjectedSites(store)
+    return projected_sites
+
+def configure_mask_cache(max_mb=DEFAULT_MAX_MB, spill_dir=None):
+    """Replace the base mask cache with one of the given memory budget and spill directory"""
+    global base_mask_cache
+    base_mask_cache = MaskCache(int(max_mb * 2**20), spill_dir)
+
+def reused_buffer(name, shape, dtype):
+    """Per-process buffer that is only reallocated when the shape or dtype changes"""
+    buffer = scene_buffers.get(name)
+    if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+        buffer = np.empty(shape, dtype=dtype)
+        scene_buffers[name] = buffer
+    return buffer
+
+def read_scene(src):
+    """Read all bands of a scene with a single read() into a reused buffer"""
+    buffer = reused_buffer('bands', (src.count, src.height, src.width), src.dtypes[0])
+    return src.read(out=buffer)
+
+# calculate_ndvi_mask() + combine_masks() is the reference for label_fusion.fuse_labels()
+# (see benchmark.py); the pipeline itself uses fuse_labels()
+def calculate_ndvi_mask(nir, red, threshold=NDVI_THRESHOLD):
+    """Calculate NDVI mask where NDVI > threshold (vegetation) from B4 (NIR) and B3 (Red) arrays"""
+    b4 = nir.astype(np.float32)  # NIR band
+    b3 = red.astype(np.float32)  # Red band
+    
+    # Calculate NDVI
+    denominator = b4 + b3
+    # Avoid division by zero
+    denominator[denominator == 0] = 1e-6
+    ndvi = (b4 - b3) / denominator
+    
+    # Create mask where NDVI > threshold (vegetation)
+    vegetation_mask = ndvi > threshold
+    
+    return vegetation_mask
+
+def combine_masks(mask, vegetation_mask, cloud_mask):
+    """Combine masks with priority: cloud (1) > mining (2) > background (0)"""
+    # Set mining areas that are vegetation (NDVI > 0.5) to background
+    mask[vegetation_mask] = 0
+    
+    final_mask = np.zeros_like(mask)
+    final_mask[cloud_mask == 1] = 1  # Set cloud pixels to 1
+    final_mask[(mask == 2) & (cloud_mask != 1)] = 2  # Set mining pixels to 2 where not cloud
+    return final_mask
 
 def generate_base_mask(polygons, image_shape, image_transform):
     """Generate base mining mask from polygons"""
@@ -55,142 +121,517 @@ def generate_base_mask(polygons, image_shape, image_transform):
         dtype='uint8'
     )
 
+def clip_polygon(poly_projected, image_box, label):
+    """Clip one polygon to the image, fixing it with buffer(0) if GEOS rejects it; None if it cannot be fixed"""
+    try:
+        return poly_projected.intersection(image_box)
+    except GEOSException:
+        logger.warning(f"⚠️ {label}: invalid geometry, trying to fix with buffer(0)...")
+        try:
+            return poly_projected.buffer(0).intersection(image_box)
+        except GEOSException as e:
+            logger.warning(f"❌ {label}: cannot fix geometry problem, skipped: {str(e)}")
+            return None
+
 def get_polygons_for_site(base_site_no, image_bounds, image_crs):
     """Get polygons for a specific site"""
-    # Setup CRS transformer from EPSG:4326 (KML) to image CRS
-    project = pyproj.Transformer.from_crs("EPSG:4326", image_crs, always_xy=True).transform
-    
     # Create image bounding box in the image's CRS
     image_box = box(*image_bounds)
     
-    # Read KML and reproject polygons
-    tree = ET.parse(kml_path)
-    root = tree.getroot()
-    ns = {"kml": "http://www.opengis.net/kml/2.2"}
-    
-    polygons = []
-    total_polygons = 0
-    matched_polygons = 0
-    
-    print("\n=== Polygon Checks ===")
-    for pm in root.findall(".//kml:Placemark", ns):
-        name_elem = pm.find(".//kml:name", ns)
-        if name_elem is not None:
-            # Remove index suffix from polygon name for comparison
-            poly_name = re.sub(r'_\d+$', '', name_elem.text)
-            if base_site_no.lower() in poly_name.lower():
-                coords_elem = pm.find(".//kml:coordinates", ns)
-                if coords_elem is not None:
-                    coords_text = coords_elem.text.strip()
-                    coords = [tuple(map(float, pt.split(",")[:2])) for pt in coords_text.split()]
-                    poly_wgs84 = Polygon(coords)
-                    poly_projected = transform(project, poly_wgs84)  # Reproject to image CRS
-    
-                    total_polygons += 1
-                    poly_bounds = poly_projected.bounds
-                    intersects = poly_projected.intersects(image_box)
-                    print(f"Polygon {total_polygons} ({name_elem.text}): Bounds {poly_bounds} | Intersects Image: {intersects}")
-                    if intersects:
-                        try:
-                            # Try to calculate intersection
-                            intersection = poly_projected.intersection(image_box)
-                        except GEOSException:
-                            print(f"  ⚠️ Compilation error, trying to fix with buffer(0)...")
-                            try:
-                                # Fix geometry problem with buffer(0)
-                                intersection = poly_projected.buffer(0).intersection(image_box.buffer(0))
-                            except GEOSException as e:
-                                print(f"  ❌ Cannot fix geometry problem: {str(e)}")
-                                continue
-                        
-                        if not intersection.is_empty:
-                            polygons.append(intersection)
-                            matched_polygons += 1
-    
-    print(f"\nTotal polygons in KML: {total_polygons}")
-    print(f"Polygons matching base site_no '{base_site_no}': {matched_polygons}")
-    print(f"Polygons intersecting the image: {len(polygons)}")
+    # Only reproject polygons of this site whose lon/lat bounding box overlaps the image
+    store = get_polygon_store()
+    site_indices = store.site_indices(base_site_no)
+    wgs84_bounds = transform_bounds(image_crs, "EPSG:4326", *image_bounds)
+    candidates = store.query(wgs84_bounds, base_site_no)
+    # All polygons of the site are reprojected once per CRS, in one vectorized call
+    projected = get_projected_sites().subset(base_site_no, image_crs, candidates)
     
-    return polygons
-
-# Process each image
-for _, row in df.iterrows():
-    image_id = row['image_id']
-    site_no = row['site_no']
+    total_polygons = len(site_indices)
     
-    # Remove index suffix from site_no (e.g., _TSTM_2 -> _TSTM)
-    base_site_no = re.sub(r'_\d+$', '', site_no)
+    # Polygons were repaired when the store was built, so one vectorized clip normally succeeds
+    try:
+        hits = shapely.intersects(projected, image_box)
+        clipped_ids = candidates[hits]
+        clipped = list(shapely.intersection(projected[hits], image_box))
+    except GEOSException:
+        # A geometry GEOS still rejects: clip polygon by polygon so only that one is skipped
+        clipped_ids = candidates
+        clipped = [clip_polygon(poly_projected, image_box, f"Polygon {idx} ({store.names[idx]})")
+                   for idx, poly_projected in zip(candidates, projected)]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("\n=== Polygon Checks ===")
+        for idx, intersection in zip(clipped_ids, clipped):
+            bounds = intersection.bounds if intersection is not None else None
+            logger.debug(f"Polygon {idx} ({store.names[idx]}): Clipped bounds {bounds}")
+    polygons = [p for p in clipped if p is not None and not p.is_empty]
     
-    print(f"\n=== Processing Image ===")
-    print(f"Image ID: {image_id}")
-    print(f"Site No: {site_no}")
-    print(f"Base Site No (for polygon search): {base_site_no}")
+    logger.debug(f"\nPolygons matching base site_no '{base_site_no}': {total_polygons}")
+    logger.debug(f"Polygons near the image (bounding box): {len(candidates)}")
+    logger.debug(f"Polygons intersecting the image: {len(polygons)}")
     
-    # Set image path
+    return polygons
+
+def scene_paths(image_id, label_format='png', write_rgb=True, image_format='tif'):
+    """Source path and output paths (image, label and optionally RGB) of one image"""
     image_path = os.path.join("mining_ndvi_timeseries", image_id)
     
     # Get image filename without path and prefix
-    output_image_filename = image_id.replace("Landsat_Image_", "")
-    output_label_filename = output_image_filename.replace(".tif", ".png")  # Change extension to .png
+    output_image_filename = image_filename(image_id, image_format)
+    outputs = {
+        'image': os.path.join("data/images", output_image_filename),
+        'label': os.path.join("data/labels", label_filename(output_image_filename, label_format)),
+    }
+    if write_rgb:
+        outputs['rgb'] = rgb_output_path(outputs['image'])
+    return image_path, outputs
+
+def scene_build_key(image_id, site_no, label_options, write_rgb, image_format='tif', fusion_options=None):
+    """Manifest key of one image: source TIFF, its site's polygons and output parameters"""
+    image_path, _ = scene_paths(image_id)
+    fusion_options = fusion_options or {}
+    params = dict(label_options, write_rgb=write_rgb, image_format=image_format,
+                  ndvi_threshold=fusion_options.get('ndvi_threshold', NDVI_THRESHOLD),
+                  priority=list(fusion_options.get('priority', DEFAULT_PRIORITY)))
+    site_digest = get_polygon_store().site_digest(base_site_name(site_no))
+    return build_key([image_path], params, {'polygons': site_digest})
+
+def process_image(image_id, site_no, write_rgb=True, windowed=False, tile_size=None, label_options=None,
+                  image_format='tif', fusion_options=None):
+    """Write bands 1-7, the 3-class label and the RGB preview of one image from a single read"""
+    if windowed:
+        # Remove index suffix from site_no (e.g., _TSTM_2 -> _TSTM)
+        base_site_no = base_site_name(site_no)
+        label_options = label_options or {}
+        image_path, outputs = scene_paths(image_id, label_options.get('label_format', 'png'),
+                                          image_format=image_format)
+        process_image_windowed(image_path, outputs['image'], outputs['label'],
+                               base_site_no, write_rgb, tile_size, label_options, image_format,
+                               fusion_options)
+        logger.debug("="*50)
+        return
+    
+    scene = load_scene(image_id, site_no, label_options, image_format)
+    label_scene(scene, fusion_options)
+    write_scene(scene, write_rgb, label_options, image_format)
+
+def load_scene(image_id, site_no, label_options=None, image_format='tif', reuse_buffers=True):
+    """Read stage: open the source once and read all 8 bands in one pass.
+
+    Returns the scene as a dict (paths, georeferencing and bands). With
+    reuse_buffers the bands live in this process's reused buffer, which the
+    next load_scene() overwrites; pipelined runs keep several scenes in
+    flight and pass reuse_buffers=False.
+    """
+    # Remove index suffix from site_no (e.g., _TSTM_2 -> _TSTM)
+    base_site_no = base_site_name(site_no)
     
-    # Set output paths
-    output_image_path = os.path.join("data/images", output_image_filename)
-    output_label_path = os.path.join("data/labels", output_label_filename)
+    logger.debug(f"\n=== Processing Image ===")
+    logger.debug(f"Image ID: {image_id}")
+    logger.debug(f"Site No: {site_no}")
+    logger.debug(f"Base Site No (for polygon search): {base_site_no}")
+    
+    # Set image and output paths
+    image_path, outputs = scene_paths(image_id, (label_options or {}).get('label_format', 'png'),
+                                      image_format=image_format)
     
-    # Copy only first 7 bands of the original image
     with rasterio.open(image_path) as src:
         # Read metadata from source
-        meta = src.meta.copy()
-        # Update metadata for 7 bands
-        meta.update(count=7)
+        scene = dict(image_id=image_id, site_no=site_no, base_site_no=base_site_no, outputs=outputs,
+                     meta=src.meta.copy(), bounds=src.bounds, crs=src.crs, transform=src.transform,
+                     shape=(src.height, src.width))
+        with profiler.stage('read'):
+            scene['bands'] = read_scene(src) if reuse_buffers else src.read()
         
-        # Read first 7 bands and write to new file
-        with rasterio.open(output_image_path, 'w', **meta) as dst:
-            for i in range(1, 8):
-                dst.write(src.read(i), i)
+        # A VRT only references the source, so it is written while the source is open
+        if image_format == 'vrt':
+            with profiler.stage('write_image'):
+                write_image(outputs['image'], None, scene['meta'], image_format, src)
     
-    print(f"✅ Image (7 bands) copied to {output_image_path}")
+    logger.debug("\n=== Image Metadata ===")
+    logger.debug(f"CRS: {scene['crs']}")
+    logger.debug(f"Bounds:\n  Left: {scene['bounds'].left}\n  Bottom: {scene['bounds'].bottom}\n"
+                 f"  Right: {scene['bounds'].right}\n  Top: {scene['bounds'].top}")
+    logger.debug(f"Image size (HxW): {scene['shape']}\n")
+    return scene
+
+def label_scene(scene, fusion_options=None, reuse_buffers=True):
+    """Compute stage: base mask of the scene's grid (cached) fused with NDVI and clouds into scene['label']"""
+    site_no, base_site_no, bands = scene['site_no'], scene['base_site_no'], scene['bands']
+    
+    # Get or generate the base mask for this site's polygons on this image's grid
+    mask_key = grid_key(get_polygon_store().site_digest(base_site_no), scene['crs'], scene['transform'],
+                        scene['shape'])
+    mask = base_mask_cache.get(mask_key)  # fuse_labels() never modifies the base mask
+    if mask is not None:
+        logger.debug(f"📋 Using cached base mask for {site_no}")
+    else:
+        logger.debug(f"🔄 Generating new base mask for {site_no}")
+        with profiler.stage('polygons'):
+            polygons = get_polygons_for_site(base_site_no, scene['bounds'], scene['crs'])
+        with profiler.stage('rasterize'):
+            mask = base_mask_cache.put(mask_key, generate_base_mask(polygons, scene['shape'], scene['transform']))
     
-    # Load image to get bounds and transform
+    # Fuse NDVI (B4/B3), cloud band (8th band) and base mask into the label in one pass
+    logger.debug("\n=== Fusing NDVI, cloud and mining masks ===")
+    label_buffer = reused_buffer('label', scene['shape'], np.uint8) if reuse_buffers else None
+    with profiler.stage('fusion'):
+        scene['label'] = fuse_labels(bands[3], bands[2], bands[7], mask, out=label_buffer, **(fusion_options or {}))
+    return scene
+
+def write_scene(scene, write_rgb=True, label_options=None, image_format='tif'):
+    """Write stage: the 7-band image, the label and the RGB preview of a labelled scene"""
+    outputs, bands, meta = scene['outputs'], scene['bands'], scene['meta']
+    
+    # Write first 7 bands to new file (VRTs were written by load_scene())
+    if image_format != 'vrt':
+        with profiler.stage('write_image'):
+            write_image(outputs['image'], bands[:7], meta, image_format)
+    logger.debug(f"✅ Image (7 bands) written to {outputs['image']} ({image_format})")
+    
+    # Save label as single-channel class values (0,1,2)
+    with profiler.stage('write_label'):
+        write_label(outputs['label'], scene['label'], profile=meta, **(label_options or {}))
+    
+    logger.debug(f"✅ Label image saved to {outputs['label']}")
+    
+    # RGB preview (bands 3-2-1) from the same array
+    if write_rgb:
+        output_rgb_path = rgb_output_path(outputs['image'])
+        with profiler.stage('write_rgb'):
+            write_preview(output_rgb_path, bands[2], bands[1], bands[0])
+        logger.debug(f"✅ RGB visualization saved to {output_rgb_path}")
+    logger.debug("="*50)
+    return scene
+
+def process_image_windowed(image_path, output_image_path, output_label_path,
+                           base_site_no, write_rgb=True, tile_size=None, label_options=None,
+                           image_format='tif', fusion_options=None):
+    """Stream one scene window by window so peak memory is bounded by the window size"""
     with rasterio.open(image_path) as src:
-        image_bounds = src.bounds
-        image_crs = src.crs
+        meta = src.meta.copy()
         image_transform = src.transform
-        image_shape = (src.height, src.width)
         
-        # Read cloud mask (8th band)
-        cloud_mask = src.read(8).astype(np.uint8)
-    
-    print("\n=== Image Metadata ===")
-    print(f"CRS: {image_crs}")
-    print(f"Bounds:\n  Left: {image_bounds.left}\n  Bottom: {image_bounds.bottom}\n  Right: {image_bounds.right}\n  Top: {image_bounds.top}")
-    print(f"Image size (HxW): {image_shape}\n")
-    
-    # Get or generate base mask for this site
-    if site_no in base_mask_cache:
-        print(f"📋 Using cached base mask for {site_no}")
-        mask = base_mask_cache[site_no].copy()  # Make a copy to avoid modifying the cached mask
-    else:
-        print(f"🔄 Generating new base mask for {site_no}")
-        polygons = get_polygons_for_site(base_site_no, image_bounds, image_crs)
-        mask = generate_base_mask(polygons, image_shape, image_transform)
-        base_mask_cache[site_no] = mask.copy()  # Cache a copy of the mask
-    
-    # Calculate NDVI mask and apply it to the mining mask
-    print("\n=== Calculating NDVI mask ===")
-    vegetation_mask = calculate_ndvi_mask(image_path)
-    # Set mining areas that are vegetation (NDVI > 0.5) to background
-    mask[vegetation_mask] = 0
+        logger.debug(f"🧱 Windowed mode: {src.height}x{src.width} scene, "
+                     f"{'native blocks' if not tile_size else f'{tile_size}px tiles'}")
+        
+        # Polygons are small compared to the raster; rasterize them per window
+        with profiler.stage('polygons'):
+            polygons = get_polygons_for_site(base_site_no, src.bounds, src.crs)
+        
+        output_rgb_path = rgb_output_path(output_image_path)
+        rgb_writer = (StreamingCopyWriter(output_rgb_path, src.width, src.height, 4)
+                      if write_rgb else nullcontext())
+        
+        with WindowedImageWriter(output_image_path, src, meta, image_format) as image_writer, \
+                WindowedLabelWriter(output_label_path, src.width, src.height, profile=meta,
+                                    **(label_options or {})) as label_writer, \
+                rgb_writer:
+            for window in iter_windows(src, tile_size):
+                with profiler.stage('read'):
+                    bands = src.read(window=window)
+                with profiler.stage('write_image'):
+                    image_writer.write(bands[:7], window)
+                
+                shape = (int(window.height), int(window.width))
+                with profiler.stage('rasterize'):
+                    mask = generate_base_mask(polygons, shape, window_transform(window, image_transform))
+                with profiler.stage('fusion'):
+                    final_mask = fuse_labels(bands[3], bands[2], bands[7], mask, **(fusion_options or {}))
+                with profiler.stage('write_label'):
+                    label_writer.write(final_mask, window)
+                
+                if write_rgb:
+                    with profiler.stage('write_rgb'):
+                        rgba = rgba_composite(bands[2], bands[1], bands[0])
+                        rgb_writer.write(rgba.transpose(2, 0, 1), window)
     
-    # Combine masks with priority: cloud (1) > mining (2) > background (0)
-    final_mask = np.zeros_like(mask)
-    final_mask[cloud_mask == 1] = 1  # Set cloud pixels to 1
-    final_mask[(mask == 2) & (cloud_mask != 1)] = 2  # Set mining pixels to 2 where not cloud
+    logger.debug(f"✅ Image (7 bands) written to {output_image_path} ({image_format})")
+    logger.debug(f"✅ Label image saved to {output_label_path}")
+    if write_rgb:
+        logger.debug(f"✅ RGB visualization saved to {output_rgb_path}")
+
+def process_site_group(site_no, image_ids, pipeline_depth=0, **options):
+    """Process images of one site, reporting per-image failures instead of aborting.
+
+    With pipeline_depth > 0 the read, compute and write stages of consecutive
+    images overlap (see process_site_group_pipelined()).
+    Returns (image_id, error or None, {stage: seconds}) per image.
+    """
+    if pipeline_depth > 0 and not options.get('windowed') and len(image_ids) > 1:
+        return process_site_group_pipelined(site_no, image_ids, pipeline_depth, **options)
+    results = []
+    for image_id in image_ids:
+        profiler.start_scene(image_id)
+        error = None
+        try:
+            with profiler.stage('total'):
+                process_image(image_id, site_no, **options)
+        except Exception as e:
+            logger.error(f"❌ Error processing {image_id}: {str(e)}")
+            error = str(e)
+        results.append((image_id, error, profiler.pop_scene(image_id)))
+    return results
+
+def process_site_group_pipelined(site_no, image_ids, depth, write_rgb=True, label_options=None,
+                                 image_format='tif', fusion_options=None, **_):
+    """Run a site's images through reader, compute and writer threads with queues of depth scenes.
+
+    While one scene is labelled, the next ones are read and the previous one
+    is written, so I/O waits overlap compute. Each scene in flight holds its
+    own band and label arrays (no reused buffers), so memory grows with depth.
+    Per-scene 'total' is the time from the start of its read to the end of its write.
+    """
+    started = {}
+    
+    def read(image_id):
+        started[image_id] = time.perf_counter()
+        profiler.start_scene(image_id)
+        return load_scene(image_id, site_no, label_options, image_format, reuse_buffers=False)
+    
+    def compute(scene):
+        profiler.start_scene(scene['image_id'])
+        return label_scene(scene, fusion_options, reuse_buffers=False)
+    
+    def write(scene):
+        profiler.start_scene(scene['image_id'])
+        return write_scene(scene, write_rgb, label_options, image_format)
+    
+    results = []
+    for image_id, _, error in run_pipeline(image_ids, [read, compute, write], depth):
+        timings = profiler.pop_scene(image_id)
+        timings['total'] = time.perf_counter() - started.pop(image_id)
+        if error is not None:
+            logger.error(f"❌ Error processing {image_id}: {str(error)}")
+            error = str(error)
+        results.append((image_id, error, timings))
+    return results
+
+def group_images_by_site(df, chunk_size=None):
+    """Group image ids by site_no (in first-seen order), splitting large sites into chunks"""
+    groups = []
+    for site_no, site_df in df.groupby('site_no', sort=False):
+        image_ids = list(site_df['image_id'])
+        step = chunk_size or len(image_ids)
+        for start in range(0, len(image_ids), step):
+            groups.append((site_no, image_ids[start:start + step]))
+    return groups
+
+def init_worker(mask_cache_mb=DEFAULT_MAX_MB, mask_spill_dir=None, log_level=0, log_file=None,
+                resolution_m=DEFAULT_RESOLUTION_M):
+    """Set up logging, the polygon store and the base mask cache once per worker process"""
+    setup_logging(log_level, log_file)
+    configure_polygon_store(resolution_m)
+    get_polygon_store()
+    configure_mask_cache(mask_cache_mb, mask_spill_dir)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate 3-class ground truth labels from KML and Landsat images")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes (1 = sequential)")
+    parser.add_argument("--no-rgb", dest="rgb", action="store_false",
+                        help="Do not write RGB previews to data/rgb")
+    parser.add_argument("--pipeline-depth", type=int, default=0, metavar="N",
+                        help=f"Overlap reading, labelling and writing of consecutive scenes with queues of N "
+                             f"scenes between the stages (e.g. {DEFAULT_DEPTH}; 0 = one scene at a time)")
+    parser.add_argument("--windowed", action="store_true",
+                        help="Stream each scene window by window to bound memory on very large scenes")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="Window size in pixels for --windowed (default: the source's internal blocks)")
+    parser.add_argument("--image-format", choices=sorted(IMAGE_FORMATS), default='tif',
+                        help="tif: 7-band copy, cog: tiled/compressed COG with overviews, "
+                             "vrt: band-subset VRT of the source (no pixels copied)")
+    parser.add_argument("--label-format", choices=sorted(LABEL_FORMATS), default='png',
+                        help="png: palette PNG, tif: compressed GeoTIFF, viridis: legacy RGBA PNG")
+    parser.add_argument("--label-compression", choices=['deflate', 'lzw'], default='deflate',
+                        help="GeoTIFF label compression")
+    parser.add_argument("--label-compress-level", type=int, default=6,
+                        help="PNG zlib / GeoTIFF DEFLATE level (1-9)")
+    parser.add_argument("--ndvi-threshold", type=float, default=NDVI_THRESHOLD,
+                        help="NDVI above which mining pixels are treated as vegetation (background)")
+    parser.add_argument("--class-priority", choices=['cloud,mining', 'mining,cloud'],
+                        default=",".join(DEFAULT_PRIORITY),
+                        help="Which class wins where cloud and mining overlap (first wins)")
+    parser.add_argument("--fusion-backend", choices=BACKENDS, default='numpy',
+                        help="Label fusion kernel (numexpr/numba fall back to numpy when not installed)")
+    parser.add_argument("--polygon-resolution", type=float, default=DEFAULT_RESOLUTION_M, metavar="METRES",
+                        help="Simplify the KML polygons to half a pixel of this size, e.g. 30 for Landsat; "
+                             "faster on dense polygons but moves label boundaries by up to half a pixel "
+                             "(default 0: only repair invalid polygons)")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild every image, ignoring the build manifest")
+    parser.add_argument("--chunk-size", type=int, default=64,
+                        help="Maximum images per task; each task builds its site's base mask once")
+    parser.add_argument("--mask-cache-mb", type=float, default=DEFAULT_MAX_MB,
+                        help="Memory budget for cached base masks, shared by all processes "
+                             "(each of --workers N workers gets 1/N of it)")
+    parser.add_argument("--mask-spill-dir", default=None,
+                        help="Spill evicted base masks here as .npy (reloaded as memmaps) instead of dropping them")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip images completed by the last (interrupted) run with the same parameters")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Only process the images that failed in the last run")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY,
+                        help="Checkpoint the run journal and build manifest after this many images")
+    parser.add_argument("--profile", default=None,
+                        help="Write per-scene stage timings to this .csv or .json file")
+    add_logging_args(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+    # Per-scene timings are only kept when they will be written out
+    profiler.keep_scenes = bool(args.profile)
+    
+    # The metadata CSV is streamed chunk by chunk; only its rows are counted up front
+    total_images = count_rows(metadata_path)
+    logger.info(f"\n=== Processing {total_images} images ===")
+    
+    # Create output directories if they don't exist
+    os.makedirs("data/images", exist_ok=True)
+    os.makedirs("data/labels", exist_ok=True)
+    if args.rgb:
+        os.makedirs("data/rgb", exist_ok=True)
+    
+    # Parse, repair and simplify the KML (or refresh its cache) once before any worker starts
+    configure_polygon_store(args.polygon_resolution)
+    logger.info(f"📋 Loaded {len(get_polygon_store())} polygons from {kml_path}")
+    
+    label_options = dict(label_format=args.label_format, compression=args.label_compression,
+                         compress_level=args.label_compress_level)
+    fusion_options = dict(ndvi_threshold=args.ndvi_threshold, priority=tuple(args.class_priority.split(",")),
+                          backend=args.fusion_backend)
+    options = dict(write_rgb=args.rgb, windowed=args.windowed, tile_size=args.tile_size,
+                   label_options=label_options, image_format=args.image_format,
+                   fusion_options=fusion_options)
+    
+    # Completed/failed images are checkpointed so an interrupted run can resume
+    manifest = BuildManifest()
+    journal_path, retry_path = journal_paths("create_gt")
+    # Every labelling parameter is in the journal key, so resuming with different ones starts a new run
+    journal_params = dict(options, polygon_resolution=args.polygon_resolution)
+    journal = RunJournal.open(journal_path, build_key(params=journal_params), args.resume or args.retry_failed,
+                              on_checkpoint=manifest.save, checkpoint_every=args.checkpoint_every)
+    if args.retry_failed:
+        logger.info(f"🔄 Retrying {len(journal.failed)} failed images")
+    elif args.resume:
+        logger.info(f"🔄 Resuming: {len(journal.completed)} images already completed")
+    
+    # Build key and metadata row of every image submitted but not yet collected
+    in_flight = {}
+    counts = {'skipped': 0, 'succeeded': 0}
+    failures = []  # (row, image_id, error)
+    
+    def stale_groups():
+        """Yield (site_no, image_ids) groups that need building, one metadata chunk at a time"""
+        row = 0
+        for chunk in read_metadata_chunks(metadata_path):
+            keep = []
+            for image_id, site_no in zip(chunk['image_id'], chunk['site_no']):
+                row += 1
+                if args.retry_failed and image_id not in journal.failed:
+                    keep.append(False)
+                    continue
+                if args.resume and image_id in journal.completed:
+                    keep.append(False)
+                    continue
+                # Skip images whose source, site polygons and parameters are unchanged since the last build
+                _, outputs = scene_paths(image_id, args.label_format, args.rgb, args.image_format)
+                try:
+                    key = scene_build_key(image_id, site_no, label_options, args.rgb,
+                                          args.image_format, fusion_options)
+                except OSError:
+                    key = None  # Missing source; let processing report it
+                if not args.force and manifest.is_up_to_date(f"create_gt:{image_id}", key, outputs.values()):
+                    counts['skipped'] += 1
+                    keep.append(False)
+                    continue
+                in_flight[image_id] = (row, key)
+                keep.append(True)
+            progress.update(len(keep) - sum(keep))
+            yield from group_images_by_site(chunk[np.asarray(keep, dtype=bool)], args.chunk_size)
+    
+    def collect(group_results):
+        for image_id, error, timings in group_results:
+            row, key = in_flight.pop(image_id)
+            profiler.add_scene(image_id, timings)
+            # Record successful builds; the journal checkpoints the manifest with it
+            target = f"create_gt:{image_id}"
+            if error is None and key is not None:
+                _, outputs = scene_paths(image_id, args.label_format, args.rgb, args.image_format)
+                manifest.record(target, key, outputs.values())
+            else:
+                manifest.forget(target)
+            if error is None:
+                counts['succeeded'] += 1
+                journal.done(image_id)
+            else:
+                failures.append((row, image_id, error))
+                journal.fail(image_id, error)
+        progress.update(len(group_results))
+    
+    try:
+        with Progress(total_images, "Scenes", unit="scenes", logger=logger) as progress:
+            if args.workers > 1:
+                logger.info(f"🚀 Processing site groups with {args.workers} workers")
+                # The budget is split across workers so total RSS does not grow with --workers
+                worker_args = (args.mask_cache_mb / args.workers, args.mask_spill_dir, verbosity(args), args.log_file,
+                               args.polygon_resolution)
+                with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                         initargs=worker_args) as executor:
+                    futures = {}
+                    
+                    def collect_done(return_when):
+                        done, _ = wait(futures, return_when=return_when)
+                        for future in done:
+                            site_no, image_ids = futures.pop(future)
+                            try:
+                                collect(future.result())
+                            except Exception as e:
+                                # Worker process died; mark the whole group as failed
+                                logger.error(f"❌ Worker failed on {site_no}: {str(e)}")
+                                collect([(image_id, str(e), {}) for image_id in image_ids])
+                    
+                    try:
+                        # Keep a bounded number of groups queued instead of submitting the whole catalogue
+                        for site_no, image_ids in stale_groups():
+                            while len(futures) >= args.workers * GROUPS_IN_FLIGHT_PER_WORKER:
+                                collect_done(FIRST_COMPLETED)
+                            future = executor.submit(process_site_group, site_no, image_ids,
+                                                     pipeline_depth=args.pipeline_depth, **options)
+                            futures[future] = (site_no, image_ids)
+                        while futures:
+                            collect_done(FIRST_COMPLETED)
+                    except BaseException:
+                        # Interrupted: don't start queued groups, only wait for those in flight
+                        executor.shutdown(cancel_futures=True)
+                        raise
+            else:
+                configure_mask_cache(args.mask_cache_mb, args.mask_spill_dir)
+                for site_no, image_ids in stale_groups():
+                    collect(process_site_group(site_no, image_ids, args.pipeline_depth, **options))
+    finally:
+        # Also on interruption, so the next run can --resume or --retry-failed
+        journal.checkpoint()
+        journal.write_retry_list(retry_path)
+    
+    if counts['skipped']:
+        logger.info(f"⏭️  Skipped {counts['skipped']} up-to-date images")
+    
+    # Report failures in metadata order
+    if failures:
+        logger.error(f"\n❌ {len(failures)} images failed:")
+        for _, image_id, error in sorted(failures):
+            logger.error(f"  {image_id}: {error}")
+        logger.error(f"Failed image ids written to {retry_path}; rerun with --retry-failed")
     
-    # Save label as PNG with original values (0,1,2)
-    plt.imsave(output_label_path, final_mask, cmap='viridis', vmin=0, vmax=2)
+    profiler.log_summary(logger)
+    if args.profile:
+        profiler.save(args.profile)
+        logger.info(f"📋 Stage timings saved to {args.profile}")
     
-    print(f"✅ Label image saved to {output_label_path}")
-    print("="*50)
+    processed = counts['succeeded'] + len(failures)
+    logger.info(f"\nDataset generation completed! ({counts['succeeded']}/{processed} images succeeded)")
 
-print("\nDataset generation completed!") 
\ No newline at end of file
+if __name__ == "__main__":
+    main()
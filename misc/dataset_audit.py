@@ -0,0 +1,340 @@
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sys
+import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+from PIL import Image
+from rasterio.errors import NotGeoreferencedWarning
+
+from image_io import IMAGE_EXTENSIONS
+from label_io import LABEL_FORMATS, read_label
+from run_journal import atomic_write
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+from shard_export import DEFAULT_DATASET_DIR, MAPPING_FILENAME
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATA_DIR = "data"
+DEFAULT_REPORT_PATH = "data/audit_report.json"
+LABEL_EXTENSIONS = tuple(sorted(set(LABEL_FORMATS.values())))
+RGB_EXTENSIONS = ('.png',)
+EXPECTED_BANDS = 7
+
+# Checks that do not make the audit fail (RGB previews are optional, e.g. create_gt.py --no-rgb)
+WARNING_CHECKS = {'missing_rgb', 'orphan_rgb', 'mixed_crs_sites', 'changed_since_baseline'}
+
+# Examples of each failed check shown in the log (the report lists all of them)
+LOG_EXAMPLES = 5
+
+
+def scan_dir(directory, extensions):
+    """({stem: (path, size)}, [duplicate paths]) of the files directly in directory with one of extensions"""
+    files, duplicates = {}, []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                stem, ext = os.path.splitext(entry.name)
+                if ext.lower() not in extensions or not entry.is_file():
+                    continue
+                if stem in files:
+                    duplicates.append(entry.path)
+                    continue
+                files[stem] = (entry.path, entry.stat().st_size)
+    except FileNotFoundError:
+        pass
+    return files, duplicates
+
+
+def subdirs(directory):
+    """Names of the directories in directory (none if it does not exist)"""
+    try:
+        with os.scandir(directory) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+        return []
+
+
+KINDS = {'images': IMAGE_EXTENSIONS, 'labels': LABEL_EXTENSIONS, 'rgb': RGB_EXTENSIONS}
+
+
+def scan_trees(data_dir, dataset_dir, executor):
+    """Files of data/<kind>/ keyed by stem and of dataset1/<split>/<kind>/<site>/ keyed by (split, site, stem).
+
+    Every directory is listed by its own os.scandir task. Returns
+    ({kind: files}, {kind: files}, duplicate paths).
+    """
+    tasks = []
+    for kind, extensions in KINDS.items():
+        tasks.append(('data', kind, None, executor.submit(scan_dir, os.path.join(data_dir, kind), extensions)))
+        for split in subdirs(dataset_dir):
+            for site in subdirs(os.path.join(dataset_dir, split, kind)):
+                directory = os.path.join(dataset_dir, split, kind, site)
+                tasks.append(('mose', kind, (split, site), executor.submit(scan_dir, directory, extensions)))
+
+    data = {kind: {} for kind in KINDS}
+    mose = {kind: {} for kind in KINDS}
+    duplicates = []
+    for tree, kind, site_key, future in tasks:
+        files, site_duplicates = future.result()
+        duplicates.extend(site_duplicates)
+        if tree == 'data':
+            data[kind] = files
+        else:
+            mose[kind].update({site_key + (stem,): entry for stem, entry in files.items()})
+    return data, mose, duplicates
+
+
+def key_name(key):
+    return "/".join(key) if isinstance(key, tuple) else key
+
+
+def cross_check(issues, prefix, images, labels, rgb):
+    """Images without label/RGB and labels/RGB without image, as set differences of their keys"""
+    image_keys, label_keys, rgb_keys = images.keys(), labels.keys(), rgb.keys()
+    issues[f'{prefix}missing_label'] = sorted(key_name(k) for k in image_keys - label_keys)
+    issues[f'{prefix}orphan_label'] = sorted(key_name(k) for k in label_keys - image_keys)
+    issues[f'{prefix}missing_rgb'] = sorted(key_name(k) for k in image_keys - rgb_keys)
+    issues[f'{prefix}orphan_rgb'] = sorted(key_name(k) for k in rgb_keys - image_keys)
+
+
+def check_mapping(issues, mapping, mose_images, data_images):
+    """filename_mapping.csv against the MOSE images and (if present) the source images in data/images"""
+    mapped = set(zip(mapping['split'], mapping['site_number'], mapping['new_filename']))
+    issues['mapping_without_image'] = sorted(key_name(k) for k in mapped - mose_images.keys())
+    issues['image_not_in_mapping'] = sorted(key_name(k) for k in mose_images.keys() - mapped)
+    keys = ['split', 'site_number', 'new_filename']
+    duplicated = mapping[mapping.duplicated(keys, keep=False)]
+    issues['duplicate_mapping_rows'] = sorted(set("/".join(row) for row in duplicated[keys].itertuples(index=False)))
+    issues['duplicate_original_filename'] = sorted(
+        mapping.loc[mapping.duplicated('original_filename', keep=False), 'original_filename'].unique())
+    index_names = mapping['file_index'].map(lambda i: f"{int(i):05d}")
+    bad_index = mapping[index_names != mapping['new_filename']]
+    issues['file_index_mismatch'] = sorted("/".join(row) for row in bad_index[keys].itertuples(index=False))
+    if data_images:
+        issues['source_missing'] = sorted(set(mapping['original_filename']) - data_images.keys())
+
+
+def raster_header(path):
+    """(width, height, bands, CRS or None) from the file header only; PNGs via Pillow's lazy open"""
+    if path.lower().endswith('.png'):
+        with Image.open(path) as image:
+            return image.width, image.height, len(image.getbands()), None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(path) as src:
+            return src.width, src.height, src.count, src.crs.to_string() if src.crs else None
+
+
+def safe_header(path):
+    try:
+        return raster_header(path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def check_headers(issues, executor, trees):
+    """Band count, CRS and image/label/RGB shape agreement of every scene, reading headers only.
+
+    trees is a list of (images, labels, rgb) dicts with matching keys.
+    """
+    paths = sorted({entry[0] for files in trees for kind in files for entry in kind.values()})
+    headers = {}
+    with Progress(len(paths), "Headers", unit="files", logger=logger) as progress:
+        for path, (header, error) in zip(paths, executor.map(safe_header, paths)):
+            headers[path] = header
+            if error is not None:
+                issues['unreadable'].append(f"{path}: {error}")
+            progress.update()
+
+    site_crs = defaultdict(set)
+    for images, labels, rgb in trees:
+        for key, (image_path, _) in images.items():
+            image = headers.get(image_path)
+            if image is None:
+                continue
+            width, height, bands, crs = image
+            if bands != EXPECTED_BANDS:
+                issues['band_count'].append(f"{image_path}: {bands} bands")
+            if crs is None:
+                issues['missing_crs'].append(image_path)
+            elif isinstance(key, tuple):
+                site_crs[key[:2]].add(crs)
+            for kind, files in (('label', labels), ('rgb', rgb)):
+                entry = files.get(key)
+                other = headers.get(entry[0]) if entry else None
+                if other is not None and other[:2] != (width, height):
+                    issues[f'{kind}_shape_mismatch'].append(
+                        f"{entry[0]}: {other[0]}x{other[1]}, image {width}x{height}")
+    issues['mixed_crs_sites'] = sorted(f"{key_name(site)}: {', '.join(sorted(crs))}"
+                                       for site, crs in site_crs.items() if len(crs) > 1)
+
+
+def file_checksum(path):
+    """SHA-1 of a file's bytes, hashed from a read-only memory map (no copies through Python buffers)"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha1().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha1(mapped).hexdigest()
+
+
+def pixel_checksum(path, kind):
+    """SHA-1 of the decoded pixels (label class values for labels), independent of the file encoding"""
+    if kind == 'labels':
+        pixels = read_label(path)
+    elif path.lower().endswith('.png'):
+        with Image.open(path) as image:
+            pixels = np.asarray(image)
+    else:
+        with rasterio.open(path) as src:
+            pixels = src.read()
+    return hashlib.sha1(np.ascontiguousarray(pixels)).hexdigest()
+
+
+def check_checksums(issues, executor, data, mose, mapping, baseline=None):
+    """Checksums of every file; MOSE copies must match their source in data/, and files their baseline checksum.
+
+    Hardlinks and symlinks to the source are the same file and are not
+    compared. A copy whose bytes differ from its source (e.g. a label in
+    another format) is only reported when its decoded pixels differ too.
+    Returns {path: sha1}.
+    """
+    paths = sorted({entry[0] for tree in (data, mose) for files in tree.values() for entry in files.values()})
+    checksums = {}
+    with Progress(len(paths), "Checksums", unit="files", logger=logger) as progress:
+        for path, digest in zip(paths, executor.map(file_checksum, paths)):
+            checksums[path] = digest
+            progress.update()
+
+    if mapping is not None:
+        different = []
+        for row in mapping.itertuples(index=False):
+            key = (row.split, row.site_number, row.new_filename)
+            for kind in KINDS:
+                copy, source = mose[kind].get(key), data[kind].get(row.original_filename)
+                if copy is None or source is None or os.path.samefile(copy[0], source[0]):
+                    continue
+                if checksums[copy[0]] != checksums[source[0]]:
+                    different.append((kind, copy[0], source[0]))
+
+        def pixels_differ(pair):
+            kind, copy, source = pair
+            try:
+                return pixel_checksum(copy, kind) != pixel_checksum(source, kind)
+            except Exception:
+                return True  # Unreadable files are already reported by the header checks
+
+        for (kind, copy, source), differ in zip(different, executor.map(pixels_differ, different)):
+            if differ:
+                issues['copy_mismatch'].append(f"{copy} != {source}")
+
+    if baseline:
+        issues['changed_since_baseline'] = sorted(path for path, digest in checksums.items()
+                                                  if path in baseline and baseline[path] != digest)
+    return checksums
+
+
+def base_check(name):
+    """Check name without the mose_ prefix of the MOSE tree's cross-checks"""
+    return name[len('mose_'):] if name.startswith('mose_') else name
+
+
+def audit(data_dir=DEFAULT_DATA_DIR, dataset_dir=DEFAULT_DATASET_DIR, headers=True, checksums=False,
+          baseline=None, workers=16):
+    """Audit data/ and the MOSE tree; returns the report dict ({'ok', 'summary', 'issues', ...})"""
+    issues = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        data, mose, duplicates = scan_trees(data_dir, dataset_dir, executor)
+        files = sum(len(f) for tree in (data, mose) for f in tree.values())
+        logger.info(f"📂 {files} files: {len(data['images'])} images in {data_dir}/, "
+                    f"{len(mose['images'])} in {dataset_dir}/")
+        issues['duplicate_stems'] = sorted(duplicates)
+        issues['empty_files'] = sorted(entry[0] for tree in (data, mose) for f in tree.values()
+                                       for entry in f.values() if entry[1] == 0)
+
+        cross_check(issues, '', data['images'], data['labels'], data['rgb'])
+        cross_check(issues, 'mose_', mose['images'], mose['labels'], mose['rgb'])
+
+        mapping = None
+        mapping_path = os.path.join(dataset_dir, MAPPING_FILENAME)
+        if os.path.exists(mapping_path):
+            mapping = pd.read_csv(mapping_path, dtype=str)
+            check_mapping(issues, mapping, mose['images'], data['images'])
+        elif mose['images']:
+            issues['mapping_missing'].append(mapping_path)
+
+        if headers:
+            check_headers(issues, executor, [(data['images'], data['labels'], data['rgb']),
+                                             (mose['images'], mose['labels'], mose['rgb'])])
+        digests = check_checksums(issues, executor, data, mose, mapping, baseline) if checksums else None
+
+    summary = {name: len(found) for name, found in sorted(issues.items())}
+    report = {
+        'ok': not any(count for name, count in summary.items() if base_check(name) not in WARNING_CHECKS),
+        'params': {'data_dir': data_dir, 'dataset_dir': dataset_dir, 'headers': headers, 'checksums': checksums},
+        'files': files,
+        'summary': summary,
+        'issues': {name: found for name, found in sorted(issues.items()) if found},
+    }
+    if digests is not None:
+        report['checksums'] = digests
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check that images, labels, RGB previews and filename_mapping.csv agree")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="Output tree of create_gt.py")
+    parser.add_argument("--dataset-dir", default=DEFAULT_DATASET_DIR, help="MOSE tree of reorganize_dataset.py")
+    parser.add_argument("--output", default=DEFAULT_REPORT_PATH, help="JSON report")
+    parser.add_argument("--no-headers", dest="headers", action="store_false",
+                        help="Skip raster header checks (band count, CRS, image/label/RGB shapes)")
+    parser.add_argument("--checksums", action="store_true",
+                        help="Hash every file (memory-mapped) and check MOSE copies against their source")
+    parser.add_argument("--baseline", default=None,
+                        help="Earlier --checksums report; files whose checksum changed are reported")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Threads for directory scans, header reads and hashing")
+    add_logging_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('checksums')
+        if baseline is None:
+            logger.error(f"❌ {args.baseline} has no checksums (run with --checksums)")
+            sys.exit(2)
+
+    logger.info(f"\n=== Auditing {args.data_dir}/ and {args.dataset_dir}/ ===")
+    report = audit(args.data_dir, args.dataset_dir, args.headers, args.checksums or bool(baseline),
+                   baseline, args.workers)
+    atomic_write(args.output, json.dumps(report, indent=1))
+
+    for name, found in report['issues'].items():
+        icon = "⚠️" if base_check(name) in WARNING_CHECKS else "❌"
+        logger.warning(f"{icon} {name}: {len(found)}")
+        for example in found[:LOG_EXAMPLES]:
+            logger.warning(f"    {example}")
+    if report['ok']:
+        logger.info(f"\n✅ {report['files']} files passed the audit; report saved to {args.output}")
+    else:
+        logger.error(f"\n❌ Audit failed; report saved to {args.output}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,324 @@
 import rasterio
 import numpy as np
-import matplotlib.pyplot as plt
 import os
-from pathlib import Path
 import glob
+import argparse
+import math
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from PIL import Image
+from rasterio.enums import Resampling
+from raster_windows import iter_windows, StreamingCopyWriter
+from build_manifest import BuildManifest, build_key
+from image_io import IMAGE_EXTENSIONS
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+from run_journal import CHECKPOINT_EVERY, RunJournal, journal_paths
+from band_stats import DEFAULT_STATS_PATH, PERCENTILES, load_band_stats
 
-# Create output directory
-os.makedirs("data/rgb", exist_ok=True)
+logger = logging.getLogger(__name__)
 
-def rescale(x, min_val=0, max_val=2000):
+# Reflectance range mapped to [0, 1] by rescale()
+RGB_RANGE = (0, 2000)
+
+# Reduced-resolution previews go to data/rgb_thumbs/x<factor>/
+THUMBNAIL_DIR = "data/rgb_thumbs"
+
+def rescale(x, min_val=RGB_RANGE[0], max_val=RGB_RANGE[1]):
     """Rescale reflectance values to [0, 1] range"""
     x = np.clip(x, min_val, max_val)
     return (x - min_val) / (max_val - min_val)
 
-def process_image(image_path):
-    """Process a single image to generate RGB visualization"""
+def rgb_composite(red, green, blue):
+    """Create an RGB composite from already-read red, green and blue bands"""
+    return np.dstack([
+        rescale(red.astype(np.float32)),
+        rescale(green.astype(np.float32)),
+        rescale(blue.astype(np.float32))
+    ])
+
+@lru_cache(maxsize=None)
+def rescale_lut(dtype, min_val=RGB_RANGE[0], max_val=RGB_RANGE[1]):
+    """uint8 lookup table over every value of an 8/16-bit integer dtype, indexed by its unsigned bit pattern.
+
+    Built with the same float32 math as rgb_composite() and the same truncation
+    as plt.imsave, so the lookup gives exactly the bytes plt.imsave wrote.
+    """
+    dtype = np.dtype(dtype)
+    unsigned = np.dtype(f"u{dtype.itemsize}")
+    values = np.arange(np.iinfo(unsigned).max + 1, dtype=unsigned).view(dtype)
+    return (rescale(values.astype(np.float32), min_val, max_val) * 255).astype(np.uint8)
+
+def rgba_composite(red, green, blue, ranges=None):
+    """uint8 RGBA preview of already-read red, green and blue bands.
+
+    ranges gives the (min, max) mapped to 0-255 for each of red, green and
+    blue (default RGB_RANGE for all three). 8/16-bit integer bands go through
+    rescale_lut() without float intermediates; other dtypes fall back to the
+    float math of rgb_composite().
+    """
+    ranges = ranges or (RGB_RANGE,) * 3
+    rgba = np.empty(red.shape + (4,), dtype=np.uint8)
+    for i, (band, (min_val, max_val)) in enumerate(zip((red, green, blue), ranges)):
+        if band.dtype.kind in 'iu' and band.dtype.itemsize <= 2:
+            rgba[..., i] = rescale_lut(band.dtype, min_val, max_val)[band.view(f"u{band.dtype.itemsize}")]
+        else:
+            rgba[..., i] = rescale(band.astype(np.float32), min_val, max_val) * 255
+    rgba[..., 3] = 255
+    return rgba
+
+def write_preview(path, red, green, blue, ranges=None):
+    """Save the RGBA preview of three bands as a PNG (same pixels as plt.imsave(path, rgb_composite(...)))"""
+    Image.fromarray(rgba_composite(red, green, blue, ranges)).save(path)
+
+def stretch_ranges(stats_path, group='all', low=2, high=98):
+    """Per-band (min, max) of bands 3-2-1 from band_stats.py percentiles, for rgba_composite().
+
+    Rounded outwards to whole values, so the top of the range maps to exactly 255.
+    A band without valid pixels (no percentiles) falls back to the fixed RGB_RANGE.
+    """
+    percentiles = load_band_stats(stats_path, group)['percentiles']
+    low_values, high_values = percentiles[f"{low:g}"], percentiles[f"{high:g}"]
+    ranges = []
+    for band in (2, 1, 0):
+        if low_values[band] is None or high_values[band] is None:
+            logger.warning(f"⚠️ Band {band + 1} has no valid pixels in {stats_path} ({group}); "
+                           f"using the fixed range {RGB_RANGE[0]}-{RGB_RANGE[1]}")
+            ranges.append(RGB_RANGE)
+        else:
+            ranges.append((math.floor(low_values[band]), math.ceil(high_values[band])))
+    return tuple(ranges)
+
+def rgb_output_path(image_path, output_dir="data/rgb"):
+    """RGB preview path for a 7-band image (same name, .png extension)"""
+    output_filename = os.path.splitext(os.path.basename(image_path))[0] + '.png'
+    return os.path.join(output_dir, output_filename)
+
+def thumbnail_path(image_path, factor, output_dir=THUMBNAIL_DIR):
+    """Path of the preview decimated by factor (e.g., data/rgb_thumbs/x4/<name>.png)"""
+    return rgb_output_path(image_path, os.path.join(output_dir, f"x{factor}"))
+
+def preview_paths(image_path, thumbnail_factors=(), full=True):
+    """All preview outputs of an image: the full-resolution PNG (if full) and one thumbnail per factor"""
+    outputs = [rgb_output_path(image_path)] if full else []
+    return outputs + [thumbnail_path(image_path, factor) for factor in thumbnail_factors]
+
+def process_image(image_path, ranges=None):
+    """Process a single image to generate RGB visualization; returns the error message on failure"""
     try:
         with rasterio.open(image_path) as src:
-            # Read bands 3-2-1 for RGB
-            red = src.read(3).astype(np.float32)
-            green = src.read(2).astype(np.float32)
-            blue = src.read(1).astype(np.float32)
-            
-            # Create RGB composite
-            rgb = np.dstack([
-                rescale(red),
-                rescale(green),
-                rescale(blue)
-            ])
-            
+            # Read bands 3-2-1 for RGB in a single read
+            red, green, blue = src.read([3, 2, 1])
+
             # Generate output filename
-            output_filename = os.path.basename(image_path).replace('.tif', '.png')
-            output_path = os.path.join("data/rgb", output_filename)
-            
+            output_path = rgb_output_path(image_path)
+
             # Save RGB image
-            plt.imsave(output_path, rgb)
-            print(f"✅ Generated RGB visualization: {output_path}")
-            
+            write_preview(output_path, red, green, blue, ranges)
+            logger.debug(f"✅ Generated RGB visualization: {output_path}")
+        return None
+
+    except Exception as e:
+        logger.error(f"❌ Error processing {image_path}: {str(e)}")
+        return str(e)
+
+def process_image_windowed(image_path, tile_size=None, ranges=None):
+    """Generate the RGB visualization window by window with bounded memory; returns the error message on failure"""
+    try:
+        with rasterio.open(image_path) as src:
+            output_path = rgb_output_path(image_path)
+            with StreamingCopyWriter(output_path, src.width, src.height, 4) as writer:
+                for window in iter_windows(src, tile_size):
+                    red, green, blue = src.read([3, 2, 1], window=window)
+                    writer.write(rgba_composite(red, green, blue, ranges).transpose(2, 0, 1), window)
+            logger.debug(f"✅ Generated RGB visualization: {output_path}")
+        return None
+
     except Exception as e:
-        print(f"❌ Error processing {image_path}: {str(e)}")
+        logger.error(f"❌ Error processing {image_path}: {str(e)}")
+        return str(e)
+
+def process_thumbnails(image_path, factors, resampling='nearest', ranges=None):
+    """Write one preview per decimation factor from decimated reads; returns the error message on failure.
+
+    Each thumbnail is read with out_shape, so GDAL serves it from the image's
+    overviews when it has them (COG) and never builds the full-resolution array.
+    """
+    try:
+        with rasterio.open(image_path) as src:
+            for factor in factors:
+                out_shape = (3, max(1, -(-src.height // factor)), max(1, -(-src.width // factor)))
+                red, green, blue = src.read([3, 2, 1], out_shape=out_shape,
+                                            resampling=Resampling[resampling])
+                output_path = thumbnail_path(image_path, factor)
+                write_preview(output_path, red, green, blue, ranges)
+                logger.debug(f"✅ Generated {out_shape[2]}x{out_shape[1]} thumbnail: {output_path}")
+        return None
+
+    except Exception as e:
+        logger.error(f"❌ Error processing thumbnails of {image_path}: {str(e)}")
+        return str(e)
+
+def render_previews(image_path, full=True, thumbnail_factors=(), windowed=False, tile_size=None,
+                    resampling='nearest', ranges=None):
+    """Full-resolution preview and/or thumbnails of one image; returns (image_path, error or None)"""
+    error = None
+    if full:
+        if windowed:
+            error = process_image_windowed(image_path, tile_size, ranges)
+        else:
+            error = process_image(image_path, ranges)
+    if error is None and thumbnail_factors:
+        error = process_thumbnails(image_path, thumbnail_factors, resampling, ranges)
+    return image_path, error
+
+def init_worker(log_level=0, log_file=None):
+    """Set up logging once per worker process"""
+    setup_logging(log_level, log_file)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate RGB visualizations from 7-band TIFF images")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes (1 = sequential)")
+    parser.add_argument("--windowed", action="store_true",
+                        help="Stream each image window by window to bound memory on very large scenes")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="Window size in pixels for --windowed (default: the image's internal blocks)")
+    parser.add_argument("--thumbnails", type=int, nargs="+", default=[], metavar="FACTOR",
+                        help=f"Also write previews decimated by these factors to {THUMBNAIL_DIR}/x<factor>/ (e.g. --thumbnails 4 16)")
+    parser.add_argument("--thumbnails-only", action="store_true",
+                        help="Only write the --thumbnails previews, not the full-resolution ones")
+    parser.add_argument("--thumbnail-resampling", choices=['nearest', 'average'], default='nearest',
+                        help="Resampling of the decimated reads; 'average' is smoother but reads every pixel "
+                             "of images without overviews")
+    parser.add_argument("--stats", default=None,
+                        help=f"Stretch each band between percentiles from this band_stats.py JSON "
+                             f"(e.g. {DEFAULT_STATS_PATH}) instead of the fixed {RGB_RANGE[0]}-{RGB_RANGE[1]}")
+    parser.add_argument("--stats-group", default='all',
+                        help="Statistics group for --stats (e.g. all, split/train, continent/Africa)")
+    parser.add_argument("--stretch", type=float, nargs=2, default=(2, 98), metavar=("LOW", "HIGH"),
+                        help=f"Percentiles mapped to black and white with --stats "
+                             f"(one of {', '.join(f'{p:g}' for p in PERCENTILES)})")
+    parser.add_argument("--force", action="store_true",
+                        help="Regenerate every preview, ignoring the build manifest")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip images completed by the last (interrupted) run")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Only process the images that failed in the last run")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY,
+                        help="Checkpoint the run journal and build manifest after this many images")
+    add_logging_args(parser)
+    args = parser.parse_args()
+    if args.thumbnails_only and not args.thumbnails:
+        parser.error("--thumbnails-only requires --thumbnails")
+    if any(factor < 1 for factor in args.thumbnails):
+        parser.error("--thumbnails factors must be positive integers")
+    # band_stats.py only stores these percentiles
+    if any(p not in PERCENTILES for p in args.stretch):
+        parser.error(f"--stretch percentiles must be among {', '.join(f'{p:g}' for p in PERCENTILES)}")
+    if args.stretch[0] >= args.stretch[1]:
+        parser.error("--stretch LOW must be below HIGH")
+    return args
 
 def main():
-    # Get all tif files in data/images
-    image_files = glob.glob("data/images/**/*.tif", recursive=True)
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+
+    full = not args.thumbnails_only
+    factors = sorted(set(args.thumbnails))
+    params = {'rescale': list(RGB_RANGE)}
+    ranges = None
+    if args.stats:
+        ranges = stretch_ranges(args.stats, args.stats_group, *args.stretch)
+        params['rescale'] = [list(r) for r in ranges]
+        logger.info(f"📋 Stretching bands 3-2-1 between {ranges} ({args.stats_group}, p{args.stretch[0]:g}-p{args.stretch[1]:g})")
+    if factors:
+        params.update(thumbnails=factors, resampling=args.thumbnail_resampling, full=full)
+
+    # Create output directories
+    if full:
+        os.makedirs("data/rgb", exist_ok=True)
+    for factor in factors:
+        os.makedirs(os.path.join(THUMBNAIL_DIR, f"x{factor}"), exist_ok=True)
+
+    # Get all images (.tif or .vrt) in data/images
+    image_files = [path for ext in IMAGE_EXTENSIONS
+                   for path in glob.glob(f"data/images/**/*{ext}", recursive=True)]
+
+    # Completed/failed images are checkpointed so an interrupted run can resume
+    manifest = BuildManifest()
+    journal_path, retry_path = journal_paths("generate_rgb")
+    journal = RunJournal.open(journal_path, build_key(params=params),
+                              args.resume or args.retry_failed, on_checkpoint=manifest.save,
+                              checkpoint_every=args.checkpoint_every)
+    if args.retry_failed:
+        image_files = [path for path in image_files if path in journal.failed]
+    elif args.resume:
+        image_files = journal.pending(image_files)
     total_files = len(image_files)
-    
-    print(f"\n=== Processing {total_files} images ===")
-    
-    # Process each image
-    for idx, image_path in enumerate(image_files, 1):
-        print(f"\nProcessing image {idx}/{total_files}: {image_path}")
-        process_image(image_path)
-    
-    print("\n=== RGB visualization generation completed! ===")
+
+    logger.info(f"\n=== Processing {total_files} images ===")
+
+    # The first output names the manifest target, so full-resolution-only runs keep their old entries
+    stale = {}
+    for image_path in image_files:
+        outputs = preview_paths(image_path, factors, full)
+        target = f"generate_rgb:{outputs[0]}"
+        key = build_key([image_path], params)
+        if args.force or not manifest.is_up_to_date(target, key, outputs):
+            stale[image_path] = (target, key, outputs)
+    skipped = total_files - len(stale)
+
+    options = dict(full=full, thumbnail_factors=factors, windowed=args.windowed, tile_size=args.tile_size,
+                   resampling=args.thumbnail_resampling, ranges=ranges)
+
+    with Progress(total_files, "Images", unit="images", logger=logger) as progress:
+        progress.update(skipped)
+
+        def collect(image_path, error):
+            target, key, outputs = stale[image_path]
+            if error is None:
+                manifest.record(target, key, outputs)
+                journal.done(image_path)
+            else:
+                manifest.forget(target)
+                journal.fail(image_path, error)
+            progress.update()
+
+        try:
+            if args.workers > 1 and len(stale) > 1:
+                logger.info(f"🚀 Rendering previews with {args.workers} workers")
+                with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                         initargs=(verbosity(args), args.log_file)) as executor:
+                    futures = {executor.submit(render_previews, image_path, **options): image_path
+                               for image_path in stale}
+                    try:
+                        for future in as_completed(futures):
+                            try:
+                                collect(*future.result())
+                            except Exception as e:
+                                # Worker process died
+                                logger.error(f"❌ Worker failed on {futures[future]}: {str(e)}")
+                                collect(futures[future], str(e))
+                    except BaseException:
+                        # Interrupted: don't start queued images, only wait for those in flight
+                        executor.shutdown(cancel_futures=True)
+                        raise
+            else:
+                for idx, image_path in enumerate(stale, 1):
+                    logger.debug(f"\nProcessing image {idx}/{len(stale)}: {image_path}")
+                    collect(*render_previews(image_path, **options))
+        finally:
+            # Also on interruption, so the next run can --resume or --retry-failed
+            journal.checkpoint()
+            journal.write_retry_list(retry_path)
+
+    if skipped:
+        logger.info(f"\n⏭️  Skipped {skipped} up-to-date previews")
+    if journal.failed:
+        logger.error(f"\n❌ {len(journal.failed)} images failed; listed in {retry_path}, rerun with --retry-failed")
+
+    logger.info("\n=== RGB visualization generation completed! ===")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
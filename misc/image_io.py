@@ -0,0 +1,118 @@
+import os
+from xml.sax.saxutils import escape
+
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+
+from raster_windows import StreamingCopyWriter
+
+# Bands kept in data/images (band 8, the cloud mask, is dropped)
+IMAGE_BANDS = tuple(range(1, 8))
+
+# Image format -> file extension
+# tif: plain 7-band copy, cog: tiled/compressed Cloud-Optimized GeoTIFF with overviews,
+# vrt: band-subset view of the source resolved at read time (no pixels copied)
+IMAGE_FORMATS = {'tif': '.tif', 'cog': '.tif', 'vrt': '.vrt'}
+IMAGE_EXTENSIONS = tuple(sorted(set(IMAGE_FORMATS.values())))
+
+COG_OPTIONS = dict(compress='DEFLATE', predictor='YES', blocksize=512,
+                   overviews='AUTO', overview_resampling='AVERAGE')
+
+GDAL_DATA_TYPES = {
+    'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16',
+    'uint32': 'UInt32', 'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64',
+}
+
+
+def image_filename(image_id, image_format='tif'):
+    """Output filename of a source image (e.g., Landsat_Image_site_1_20200524.tif -> site_1_20200524.tif)"""
+    name = os.path.splitext(image_id.replace("Landsat_Image_", ""))[0]
+    return name + IMAGE_FORMATS[image_format]
+
+
+def write_band_subset_vrt(src, vrt_path, bands=IMAGE_BANDS):
+    """Write a GDAL VRT exposing bands of an open source dataset without copying pixels"""
+    source_path = escape(os.path.abspath(src.name))
+    lines = [f'<VRTDataset rasterXSize="{src.width}" rasterYSize="{src.height}">']
+    if src.crs is not None:
+        lines.append(f'  <SRS>{escape(src.crs.to_wkt())}</SRS>')
+    lines.append(f'  <GeoTransform>{", ".join(repr(v) for v in src.transform.to_gdal())}</GeoTransform>')
+    for dst_band, src_band in enumerate(bands, 1):
+        data_type = GDAL_DATA_TYPES[src.dtypes[src_band - 1]]
+        lines.append(f'  <VRTRasterBand dataType="{data_type}" band="{dst_band}">')
+        nodata = src.nodatavals[src_band - 1]
+        if nodata is not None:
+            lines.append(f'    <NoDataValue>{nodata!r}</NoDataValue>')
+        lines.append('    <SimpleSource>')
+        # Absolute path so the VRT stays valid when linked or copied into dataset1/
+        lines.append(f'      <SourceFilename relativeToVRT="0">{source_path}</SourceFilename>')
+        lines.append(f'      <SourceBand>{src_band}</SourceBand>')
+        lines.append('    </SimpleSource>')
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+
+    with open(vrt_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_image(output_path, bands, meta, image_format='tif', src=None):
+    """Write the 7-band image from an in-memory (7, rows, cols) array.
+
+    For 'vrt' nothing is copied: the open source dataset src is referenced instead.
+    """
+    if image_format == 'vrt':
+        write_band_subset_vrt(src, output_path)
+        return
+    meta = dict(meta, count=len(bands))
+    if image_format == 'tif':
+        with rasterio.open(output_path, 'w', **meta) as dst:
+            dst.write(bands)
+    elif image_format == 'cog':
+        # The COG driver only supports CreateCopy, so stage the bands in memory first
+        with MemoryFile() as memfile:
+            with memfile.open(**dict(meta, driver='GTiff')) as mem:
+                mem.write(bands)
+                rasterio.shutil.copy(mem, output_path, driver='COG', **COG_OPTIONS)
+    else:
+        raise ValueError(f"Unknown image format: {image_format}")
+
+
+class WindowedImageWriter:
+    """Write the 7-band image window by window in any supported format"""
+
+    def __init__(self, output_path, src, meta, image_format='tif'):
+        self.image_format = image_format
+        meta = dict(meta, count=len(IMAGE_BANDS))
+        if image_format == 'tif':
+            self.dst = rasterio.open(output_path, 'w', **meta)
+        elif image_format == 'cog':
+            self.dst = StreamingCopyWriter(
+                output_path, meta['width'], meta['height'], meta['count'], meta['dtype'],
+                driver='COG', crs=meta.get('crs'), transform=meta.get('transform'),
+                nodata=meta.get('nodata'), **COG_OPTIONS
+            )
+        elif image_format == 'vrt':
+            write_band_subset_vrt(src, output_path)
+            self.dst = None
+        else:
+            raise ValueError(f"Unknown image format: {image_format}")
+
+    def write(self, bands, window):
+        """Write a (7, rows, cols) array into window"""
+        if self.image_format == 'tif':
+            self.dst.write(bands, window=window)
+        elif self.image_format == 'cog':
+            self.dst.write(bands, window)
+
+    def close(self):
+        if self.dst is not None:
+            self.dst.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if isinstance(self.dst, StreamingCopyWriter):
+            return self.dst.__exit__(exc_type, exc, tb)
+        self.close()
@@ -0,0 +1,238 @@
+import hashlib
+import os
+import pickle
+import re
+from collections import defaultdict
+from xml.etree import ElementTree as ET
+
+import numpy as np
+import shapely
+from pyproj import Geod
+from shapely.geometry import Polygon, box
+from shapely.strtree import STRtree
+
+KML_NS = "{http://www.opengis.net/kml/2.2}"
+CACHE_VERSION = 2
+
+# Pixel size the polygons are simplified for (half a pixel tolerance). 0 only repairs them, so labels keep
+# the exact KML boundaries; e.g. 30 (Landsat) is faster on dense polygons but moves boundary pixels
+DEFAULT_RESOLUTION_M = 0
+# Metres per degree of latitude; a degree of longitude is never longer
+METERS_PER_DEGREE = 111320
+
+
+def base_site_name(name):
+    """Remove index suffix from a site or placemark name (e.g., _TSTM_2 -> _TSTM)"""
+    return re.sub(r'_\d+$', '', name)
+
+
+def default_cache_path(kml_path, resolution_m=DEFAULT_RESOLUTION_M):
+    """Sidecar file next to the KML holding the polygons preprocessed for resolution_m (one per resolution)"""
+    return f"{kml_path}.polygons_{resolution_m:g}m.pkl"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_coordinates(text):
+    """Parse a KML coordinates string ("lon,lat[,alt] ...") into (lon, lat) tuples"""
+    return [tuple(map(float, pt.split(",")[:2])) for pt in text.strip().split()]
+
+
+def iter_placemarks(kml_path):
+    """Stream (name, coords) for every Placemark without keeping the parsed tree in memory.
+
+    Each Placemark is cleared and detached from its parent (Document/Folder)
+    once read, so memory stays flat however many placemarks the KML holds.
+    """
+    parents = []
+    for event, elem in ET.iterparse(kml_path, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag != KML_NS + "Placemark":
+            continue
+        name_elem = elem.find(f".//{KML_NS}name")
+        coords_elem = elem.find(f".//{KML_NS}coordinates")
+        name = name_elem.text if name_elem is not None else None
+        coords = None
+        if coords_elem is not None and coords_elem.text:
+            coords = parse_coordinates(coords_elem.text)
+        yield name, coords
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def simplify_tolerance(resolution_m):
+    """Simplification tolerance in degrees: half a pixel, never more than that in metres at any latitude"""
+    return resolution_m / 2 / METERS_PER_DEGREE
+
+
+def preprocess_polygons(polygons, resolution_m=DEFAULT_RESOLUTION_M):
+    """Repair and simplify polygons once, so clipping and rasterizing never see invalid or overly dense rings.
+
+    Invalid rings (self-intersections, bow ties) are repaired with make_valid,
+    keeping only the polygonal parts, then simplified topology-preserving to
+    half a pixel at resolution_m (None or 0 only repairs). Returns an object
+    array of Polygon/MultiPolygon; a ring with no area comes back empty.
+    """
+    geometries = shapely.make_valid(np.asarray(polygons, dtype=object))
+    for i in np.flatnonzero(shapely.get_type_id(geometries) == shapely.GeometryType.GEOMETRYCOLLECTION):
+        parts = shapely.get_parts(geometries[i])
+        parts = parts[np.isin(shapely.get_type_id(parts),
+                              (shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON))]
+        geometries[i] = shapely.union_all(parts) if len(parts) else Polygon()
+    if resolution_m:
+        geometries = shapely.simplify(geometries, simplify_tolerance(resolution_m), preserve_topology=True)
+    return geometries
+
+
+class PolygonStore:
+    """Mining extent polygons (EPSG:4326), grouped by base site and indexed with an STRtree"""
+
+    def __init__(self, names, polygons):
+        self.names = list(names)
+        self.polygons = list(polygons)
+        self.groups = defaultdict(list)  # lowercased base site -> polygon indices
+        for idx, name in enumerate(self.names):
+            self.groups[base_site_name(name).lower()].append(idx)
+        self.tree = STRtree(self.polygons)
+        self._site_indices = {}
+        self._site_digests = {}
+        self._vertex_counts = None
+        self._areas_km2 = None
+        self.resolution_m = None  # Set by from_kml/from_cache: resolution the polygons were simplified for
+
+    def __len__(self):
+        return len(self.polygons)
+
+    @classmethod
+    def from_kml(cls, kml_path, resolution_m=DEFAULT_RESOLUTION_M):
+        """Parse the KML once, keeping every named placemark with a usable ring, repaired and simplified"""
+        names, polygons = [], []
+        for name, coords in iter_placemarks(kml_path):
+            if name is None or coords is None or len(coords) < 3:
+                continue
+            names.append(name)
+            polygons.append(Polygon(coords))
+        polygons = preprocess_polygons(polygons, resolution_m)
+        keep = ~shapely.is_empty(polygons)
+        store = cls([name for name, k in zip(names, keep) if k], polygons[keep])
+        store.resolution_m = resolution_m
+        return store
+
+    @classmethod
+    def load(cls, kml_path, cache_path=None, resolution_m=DEFAULT_RESOLUTION_M):
+        """Load polygons from the on-disk cache, re-parsing the KML only when it or resolution_m has changed"""
+        cache_path = cache_path or default_cache_path(kml_path, resolution_m)
+        stat = os.stat(kml_path)
+        kml_sha256 = None
+
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                cached = None
+
+            if (cached is not None and cached.get('version') == CACHE_VERSION
+                    and cached['resolution_m'] == resolution_m):
+                if cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+                    return cls.from_cache(cached)
+                # mtime changed: only re-parse if the content really differs
+                kml_sha256 = file_hash(kml_path)
+                if cached['sha256'] == kml_sha256:
+                    store = cls.from_cache(cached)
+                    store.save(cache_path, kml_path, kml_sha256)
+                    return store
+
+        store = cls.from_kml(kml_path, resolution_m)
+        store.save(cache_path, kml_path, kml_sha256 or file_hash(kml_path))
+        return store
+
+    @classmethod
+    def from_cache(cls, cached):
+        store = cls(cached['names'], shapely.from_wkb(np.asarray(cached['wkb'], dtype=object)))
+        store.resolution_m = cached['resolution_m']
+        return store
+
+    def save(self, cache_path, kml_path, kml_sha256):
+        """Write the preprocessed polygons as WKB, keyed by the KML's mtime, size and hash and the resolution"""
+        stat = os.stat(kml_path)
+        payload = {
+            'version': CACHE_VERSION,
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'sha256': kml_sha256,
+            'resolution_m': self.resolution_m,
+            'names': self.names,
+            'wkb': list(shapely.to_wkb(np.asarray(self.polygons, dtype=object))),
+        }
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    def site_indices(self, base_site_no):
+        """Indices of polygons whose base name contains base_site_no (case-insensitive)"""
+        key = base_site_no.lower()
+        if key not in self._site_indices:
+            indices = []
+            for group_name, group in self.groups.items():
+                if key in group_name:
+                    indices.extend(group)
+            self._site_indices[key] = np.array(sorted(indices), dtype=np.int64)
+        return self._site_indices[key]
+
+    def site_digest(self, base_site_no):
+        """Content hash of a site's polygons, to invalidate only sites whose polygons changed"""
+        key = base_site_no.lower()
+        if key not in self._site_digests:
+            digest = hashlib.sha1()
+            for idx in self.site_indices(base_site_no):
+                digest.update(self.names[idx].encode())
+                digest.update(shapely.to_wkb(self.polygons[idx]))
+            self._site_digests[key] = digest.hexdigest()
+        return self._site_digests[key]
+
+    def query(self, bounds, base_site_no=None):
+        """Indices of polygons whose bounding box intersects bounds (EPSG:4326)"""
+        indices = self.tree.query(box(*bounds))
+        if base_site_no is not None:
+            indices = np.intersect1d(indices, self.site_indices(base_site_no))
+        return np.sort(indices)
+
+    def intersecting(self, bounds, base_site_no=None):
+        """Indices of polygons that actually intersect bounds (not just their bounding boxes)"""
+        indices = self.query(bounds, base_site_no)
+        polygons = np.asarray(self.polygons, dtype=object)[indices]
+        return indices[shapely.intersects(polygons, box(*bounds))]
+
+    def site_names(self):
+        """Lowercased base site names, sorted"""
+        return sorted(self.groups)
+
+    def vertex_counts(self):
+        """Ring vertices of every polygon (without the closing points); repaired polygons may have several rings"""
+        if self._vertex_counts is None:
+            polygons = np.asarray(self.polygons, dtype=object)
+            parts, part_index = shapely.get_parts(polygons, return_index=True)
+            _, ring_index = shapely.get_rings(parts, return_index=True)
+            rings = np.bincount(part_index[ring_index], minlength=len(polygons))
+            self._vertex_counts = shapely.get_num_coordinates(polygons) - rings
+        return self._vertex_counts
+
+    def areas_km2(self):
+        """Geodesic (WGS84) area of every polygon in km²"""
+        if self._areas_km2 is None:
+            geod = Geod(ellps='WGS84')
+            self._areas_km2 = np.array([abs(geod.geometry_area_perimeter(p)[0]) / 1e6 for p in self.polygons])
+        return self._areas_km2
@@ -0,0 +1,124 @@
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Class values
+BACKGROUND, CLOUD, MINING = 0, 1, 2
+
+# Pixels with NDVI above this are vegetation and never labelled as mining
+NDVI_THRESHOLD = 0.5
+
+# The first class in the priority wins where both apply (default: cloud over mining)
+DEFAULT_PRIORITY = ('cloud', 'mining')
+
+# Rows fused per block by the NumPy backend; keeps temporaries cache-sized
+BLOCK_ROWS = 256
+
+BACKENDS = ('numpy', 'numexpr', 'numba')
+
+
+def available_backends():
+    """Backends whose optional dependency is installed"""
+    return [b for b in BACKENDS if b == 'numpy' or (b == 'numexpr' and numexpr) or (b == 'numba' and numba)]
+
+
+def _cloud_first(priority):
+    priority = tuple(priority)
+    if sorted(priority) != ['cloud', 'mining']:
+        raise ValueError(f"priority must order 'cloud' and 'mining', got {priority}")
+    return priority[0] == 'cloud'
+
+
+def _fuse_numpy(nir, red, cloud, base_mask, threshold, cloud_value, cloud_first, out):
+    """Fuse block by block, so every temporary stays BLOCK_ROWS rows tall"""
+    for start in range(0, out.shape[0], BLOCK_ROWS):
+        rows = slice(start, start + BLOCK_ROWS)
+        b4 = nir[rows].astype(np.float32)
+        b3 = red[rows].astype(np.float32)
+        denominator = b4 + b3
+        denominator[denominator == 0] = 1e-6
+        np.subtract(b4, b3, out=b4)
+        np.divide(b4, denominator, out=b4)  # b4 now holds NDVI
+
+        mining = base_mask[rows] == MINING
+        mining &= ~(b4 > threshold)
+        is_cloud = cloud[rows] == cloud_value
+
+        # Write the lower-priority class first so the higher one overwrites it
+        block = out[rows]
+        block[...] = BACKGROUND
+        if cloud_first:
+            block[mining] = MINING
+            block[is_cloud] = CLOUD
+        else:
+            block[is_cloud] = CLOUD
+            block[mining] = MINING
+    return out
+
+
+def _fuse_numexpr(nir, red, cloud, base_mask, threshold, cloud_value, cloud_first, out):
+    b4 = nir.astype(np.float32, copy=False)
+    b3 = red.astype(np.float32, copy=False)
+    local_dict = dict(b4=b4, b3=b3, c=cloud, m=base_mask, t=np.float32(threshold),
+                      cv=cloud_value, eps=np.float32(1e-6))
+    ndvi = "(b4 - b3) / where(b4 + b3 == 0, eps, b4 + b3)"
+    mining = f"(m == {MINING}) & ~({ndvi} > t)"
+    if cloud_first:
+        expr = f"where(c == cv, {CLOUD}, where({mining}, {MINING}, {BACKGROUND}))"
+    else:
+        expr = f"where({mining}, {MINING}, where(c == cv, {CLOUD}, {BACKGROUND}))"
+    out[...] = numexpr.evaluate(expr, local_dict=local_dict, casting='unsafe')
+    return out
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _fuse_numba(nir, red, cloud, base_mask, threshold, cloud_value, cloud_first, out):
+        """Single pass over the pixels, rows in parallel"""
+        eps = np.float32(1e-6)
+        for i in numba.prange(out.shape[0]):
+            for j in range(out.shape[1]):
+                b4 = np.float32(nir[i, j])
+                b3 = np.float32(red[i, j])
+                denominator = b4 + b3
+                if denominator == 0:
+                    denominator = eps
+                mining = base_mask[i, j] == MINING and not ((b4 - b3) / denominator > threshold)
+                is_cloud = cloud[i, j] == cloud_value
+                if cloud_first:
+                    out[i, j] = CLOUD if is_cloud else (MINING if mining else BACKGROUND)
+                else:
+                    out[i, j] = MINING if mining else (CLOUD if is_cloud else BACKGROUND)
+        return out
+
+
+def fuse_labels(nir, red, cloud, base_mask, ndvi_threshold=NDVI_THRESHOLD, priority=DEFAULT_PRIORITY,
+                cloud_value=1, backend='numpy', out=None):
+    """Fuse raw bands, the cloud band and the base mining mask into the 0/1/2 label.
+
+    Equivalent to calculate_ndvi_mask() followed by combine_masks() in
+    create_gt.py, but without modifying base_mask and writing straight into
+    a preallocated out (uint8, same shape), so a cached base mask can be
+    reused without copying it.
+    """
+    if out is None:
+        out = np.empty(base_mask.shape, dtype=np.uint8)
+    cloud_first = _cloud_first(priority)
+
+    if backend == 'numba' and numba is not None:
+        return _fuse_numba(nir, red, cloud, base_mask, np.float32(ndvi_threshold),
+                           cloud_value, cloud_first, out)
+    if backend == 'numexpr' and numexpr is not None:
+        return _fuse_numexpr(nir, red, cloud, base_mask, ndvi_threshold, cloud_value, cloud_first, out)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown fusion backend: {backend}")
+    # NumPy is always available; also the fallback when numba/numexpr are not installed
+    return _fuse_numpy(nir, red, cloud, base_mask, ndvi_threshold, cloud_value, cloud_first, out)
@@ -0,0 +1,206 @@
+import argparse
+import glob
+import logging
+import os
+import warnings
+
+import matplotlib.pyplot as plt
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.errors import NotGeoreferencedWarning
+
+from raster_windows import StreamingCopyWriter
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+
+logger = logging.getLogger(__name__)
+
+# Class values: 0 = background, 1 = cloud, 2 = mining
+NUM_CLASSES = 3
+
+# Colours of classes 0, 1, 2 exactly as plt.imsave(..., cmap='viridis', vmin=0, vmax=2) drew them
+LABEL_RGBA = plt.get_cmap('viridis')(np.array([0.0, 0.5, 1.0]), bytes=True)  # (3, 4) uint8
+
+# Label format -> file extension ('viridis' is the legacy RGBA PNG)
+LABEL_FORMATS = {'png': '.png', 'tif': '.tif', 'viridis': '.png'}
+
+
+def label_colormap():
+    """Palette for single-channel labels, so they still look like the old viridis PNGs"""
+    return {cls: tuple(int(v) for v in LABEL_RGBA[cls]) for cls in range(NUM_CLASSES)}
+
+
+def label_filename(image_filename, label_format='png'):
+    """Label filename for an image filename (e.g., site_1_20200524.tif -> site_1_20200524.png)"""
+    return os.path.splitext(image_filename)[0] + LABEL_FORMATS[label_format]
+
+
+def find_label(label_dir, base_name):
+    """Path of the label for base_name in label_dir, whichever format it was written in"""
+    for ext in ('.png', '.tif'):
+        path = os.path.join(label_dir, base_name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def geotiff_label_profile(width, height, compression='deflate', compress_level=6, profile=None):
+    """Creation options for a tiled, compressed single-band uint8 GeoTIFF label"""
+    meta = dict(driver='GTiff', width=width, height=height, count=1, dtype='uint8',
+                compress=compression, tiled=True, blockxsize=256, blockysize=256)
+    if compression == 'deflate':
+        meta['zlevel'] = compress_level
+    if profile is not None:
+        meta.update(crs=profile.get('crs'), transform=profile.get('transform'))
+    return meta
+
+
+def write_label(path, label, label_format='png', compress_level=6, compression='deflate', profile=None):
+    """Save a uint8 label holding class values 0/1/2.
+
+    'png' writes a palette PNG and 'tif' a compressed GeoTIFF (georeferenced
+    when profile is given); both store the class index directly in one channel.
+    'viridis' keeps the legacy RGBA PNG.
+    """
+    label = np.asarray(label, dtype=np.uint8)
+    if label_format == 'png':
+        img = Image.fromarray(label)
+        img.putpalette(LABEL_RGBA[:, :3].flatten().tolist())  # L -> P, pixel values unchanged
+        img.save(path, compress_level=compress_level)
+    elif label_format == 'tif':
+        meta = geotiff_label_profile(label.shape[1], label.shape[0], compression, compress_level, profile)
+        with rasterio.open(path, 'w', **meta) as dst:
+            dst.write(label, 1)
+            dst.write_colormap(1, label_colormap())
+    elif label_format == 'viridis':
+        plt.imsave(path, label, cmap='viridis', vmin=0, vmax=2)
+    else:
+        raise ValueError(f"Unknown label format: {label_format}")
+
+
+def rgba_to_classes(rgba):
+    """Invert the viridis colormap of a legacy RGBA label back to class values"""
+    packed = (rgba[..., 0].astype(np.uint32) << 16) | (rgba[..., 1].astype(np.uint32) << 8) | rgba[..., 2]
+    label = np.zeros(rgba.shape[:2], dtype=np.uint8)
+    matched = np.zeros(rgba.shape[:2], dtype=bool)
+    for cls in range(NUM_CLASSES):
+        r, g, b = (int(v) for v in LABEL_RGBA[cls, :3])
+        hit = packed == ((r << 16) | (g << 8) | b)
+        label[hit] = cls
+        matched |= hit
+    if not matched.all():
+        raise ValueError(f"{np.count_nonzero(~matched)} pixels do not match any label colour")
+    return label
+
+
+def read_label(path):
+    """Read a label in any supported format as uint8 class values"""
+    if path.lower().endswith(('.tif', '.tiff')):
+        with rasterio.open(path) as src:
+            return src.read(1)
+    with Image.open(path) as img:
+        if img.mode in ('P', 'L'):
+            return np.array(img)
+        return rgba_to_classes(np.asarray(img.convert('RGB')))
+
+
+def read_label_window(path, window):
+    """Read one window of a label in any supported format as uint8 class values"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(path) as src:
+            if src.count == 1:
+                return src.read(1, window=window)
+            return rgba_to_classes(src.read([1, 2, 3], window=window).transpose(1, 2, 0))
+
+
+class WindowedLabelWriter:
+    """Write a label window by window in any supported format"""
+
+    def __init__(self, path, width, height, label_format='png', compress_level=6,
+                 compression='deflate', profile=None):
+        self.label_format = label_format
+        if label_format == 'tif':
+            meta = geotiff_label_profile(width, height, compression, compress_level, profile)
+            self.dst = rasterio.open(path, 'w', **meta)
+            self.dst.write_colormap(1, label_colormap())
+        elif label_format == 'png':
+            self.dst = StreamingCopyWriter(path, width, height, 1, colormap=label_colormap(),
+                                          ZLEVEL=compress_level)
+        elif label_format == 'viridis':
+            self.dst = StreamingCopyWriter(path, width, height, 4)
+        else:
+            raise ValueError(f"Unknown label format: {label_format}")
+
+    def write(self, label, window):
+        if self.label_format == 'tif':
+            self.dst.write(label, 1, window=window)
+        elif self.label_format == 'png':
+            self.dst.write(label[np.newaxis], window)
+        else:
+            self.dst.write(LABEL_RGBA[label].transpose(2, 0, 1), window)
+
+    def close(self):
+        self.dst.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if isinstance(self.dst, StreamingCopyWriter):
+            return self.dst.__exit__(exc_type, exc, tb)
+        self.dst.close()
+
+
+def convert_labels(label_dir, label_format='png', compress_level=6, compression='deflate', keep_original=False):
+    """Convert every label under label_dir (e.g. data/labels or dataset1) to a single-channel format"""
+    label_paths = sorted(glob.glob(os.path.join(label_dir, "**", "*.png"), recursive=True))
+    converted = skipped = failed = 0
+
+    logger.info(f"\n=== Converting {len(label_paths)} labels to '{label_format}' ===")
+    with Progress(len(label_paths), "Labels", unit="labels", logger=logger) as progress:
+        for path in label_paths:
+            progress.update()
+            try:
+                if label_format == 'png':
+                    with Image.open(path) as img:
+                        if img.mode in ('P', 'L'):
+                            skipped += 1
+                            continue
+                label = read_label(path)
+                output_path = os.path.splitext(path)[0] + LABEL_FORMATS[label_format]
+                # Write next to the original first so an interrupted run never leaves a broken label
+                tmp_path = output_path + ".tmp" + LABEL_FORMATS[label_format]
+                write_label(tmp_path, label, label_format, compress_level, compression)
+                os.replace(tmp_path, output_path)
+                if output_path != path and not keep_original:
+                    os.remove(path)
+                converted += 1
+            except Exception as e:
+                logger.error(f"❌ Error converting {path}: {str(e)}")
+                failed += 1
+
+    logger.info(f"✅ Converted: {converted} | Already single-channel: {skipped} | Failed: {failed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert colormapped label PNGs to single-channel class labels")
+    parser.add_argument("label_dir", nargs="?", default="data/labels",
+                        help="Label tree to convert (searched recursively)")
+    parser.add_argument("--format", dest="label_format", choices=['png', 'tif'], default='png',
+                        help="Output format: palette PNG or compressed GeoTIFF")
+    parser.add_argument("--compression", choices=['deflate', 'lzw'], default='deflate',
+                        help="GeoTIFF compression")
+    parser.add_argument("--compress-level", type=int, default=6,
+                        help="PNG zlib / GeoTIFF DEFLATE level (1-9)")
+    parser.add_argument("--keep-original", action="store_true",
+                        help="Keep the original PNG when converting to GeoTIFF")
+    add_logging_args(parser)
+    args = parser.parse_args()
+    setup_logging(verbosity(args), args.log_file)
+
+    convert_labels(args.label_dir, args.label_format, args.compress_level, args.compression, args.keep_original)
+
+
+if __name__ == "__main__":
+    main()
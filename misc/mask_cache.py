@@ -0,0 +1,117 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from reprojection import crs_key
+
+# Default in-memory budget for cached base masks (uint8, so 1 byte per pixel), shared by all create_gt.py workers
+DEFAULT_MAX_MB = 1024
+
+# Largest misalignment (in pixels) still treated as a whole-pixel grid offset
+OFFSET_TOLERANCE = 1e-6
+
+
+def grid_key(site_digest, crs, transform, shape):
+    """Cache key of a base mask: the site's polygons and the exact pixel grid they are burned into"""
+    return (site_digest, crs_key(crs), tuple(transform)[:6], tuple(shape))
+
+
+def grid_offset(key, parent_key):
+    """(row_off, col_off) of key's grid inside parent_key's grid, or None if it is not a whole-pixel window"""
+    site, crs, transform, shape = key
+    parent_site, parent_crs, parent_transform, parent_shape = parent_key
+    if (site, crs) != (parent_site, parent_crs):
+        return None
+    a, b, c, d, e, f = transform
+    pa, pb, pc, pd, pe, pf = parent_transform
+    # Same pixel size and no rotation: only the origin may differ
+    if (a, b, d, e) != (pa, pb, pd, pe) or b != 0 or d != 0:
+        return None
+    col_off = (c - pc) / a
+    row_off = (f - pf) / e
+    if abs(col_off - round(col_off)) > OFFSET_TOLERANCE or abs(row_off - round(row_off)) > OFFSET_TOLERANCE:
+        return None
+    row_off, col_off = int(round(row_off)), int(round(col_off))
+    rows, cols = shape
+    if row_off < 0 or col_off < 0 or row_off + rows > parent_shape[0] or col_off + cols > parent_shape[1]:
+        return None
+    return row_off, col_off
+
+
+class MaskCache:
+    """LRU cache of rasterized base masks bounded by a memory budget.
+
+    Masks are keyed by grid_key(), so scenes on the same grid share one
+    rasterization, and a scene whose grid is a whole-pixel window of a
+    cached grid gets a view into that mask. With spill_dir set, evicted
+    masks are written there as .npy and come back as read-only memmaps.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_MB * 2**20, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.masks = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.window_hits = self.spill_hits = self.misses = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest() + ".npy")
+
+    def get(self, key):
+        """Cached mask for key (possibly a window view or a memmap), or None"""
+        if key in self.masks:
+            self.masks.move_to_end(key)
+            self.hits += 1
+            return self.masks[key]
+
+        for parent_key in reversed(self.masks):
+            offset = grid_offset(key, parent_key)
+            if offset is not None:
+                row_off, col_off = offset
+                rows, cols = key[3]
+                self.masks.move_to_end(parent_key)
+                self.window_hits += 1
+                return self.masks[parent_key][row_off:row_off + rows, col_off:col_off + cols]
+
+        if self.spill_dir and os.path.exists(self.spill_path(key)):
+            mask = np.load(self.spill_path(key), mmap_mode='r')
+            self.spill_hits += 1
+            self._insert(key, mask)
+            return mask
+
+        self.misses += 1
+        return None
+
+    def put(self, key, mask):
+        """Cache a freshly rasterized mask, evicting (and spilling) least recently used ones"""
+        self._insert(key, mask)
+        return mask
+
+    def _insert(self, key, mask):
+        if key in self.masks:
+            self.nbytes -= self.masks.pop(key).nbytes
+        self.masks[key] = mask
+        self.nbytes += mask.nbytes
+        # Always keep the newest mask, even if it alone exceeds the budget
+        while self.nbytes > self.max_bytes and len(self.masks) > 1:
+            old_key, old_mask = self.masks.popitem(last=False)
+            self.nbytes -= old_mask.nbytes
+            self._spill(old_key, old_mask)
+
+    def _spill(self, key, mask):
+        if not self.spill_dir or isinstance(mask, np.memmap):
+            return
+        path = self.spill_path(key)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, mask)
+        os.replace(tmp_path, path)
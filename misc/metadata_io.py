@@ -0,0 +1,65 @@
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+METADATA_COLUMNS = ['image_id', 'site_no']
+
+# Rows per chunk when streaming the metadata CSV
+CHUNK_ROWS = 100_000
+
+# pyarrow reads by bytes, not rows; metadata rows are roughly this long
+APPROX_ROW_BYTES = 128
+
+# Index suffix of a site_no (e.g., _TSTM_2 -> _TSTM)
+SITE_INDEX_SUFFIX = r'_\d+$'
+
+
+def base_site_column(site_no):
+    """Vectorized base_site_name() over a Series of site numbers"""
+    return site_no.str.replace(SITE_INDEX_SUFFIX, '', regex=True)
+
+
+def read_metadata_chunks(path, columns=METADATA_COLUMNS, chunk_rows=CHUNK_ROWS):
+    """Stream the metadata CSV as DataFrames of about chunk_rows rows (all columns as strings).
+
+    Uses pyarrow's streaming CSV reader when installed, otherwise pandas'
+    chunked reader; only the requested columns are parsed.
+    """
+    if pa is not None:
+        reader = pa_csv.open_csv(
+            path,
+            read_options=pa_csv.ReadOptions(block_size=chunk_rows * APPROX_ROW_BYTES),
+            convert_options=pa_csv.ConvertOptions(include_columns=columns,
+                                                  column_types={c: pa.string() for c in columns}),
+        )
+        for batch in reader:
+            yield batch.to_pandas()
+        return
+    yield from pd.read_csv(path, usecols=columns, dtype=str, chunksize=chunk_rows)
+
+
+def count_rows(path, block_size=1 << 20):
+    """Number of data rows in a CSV (newlines minus the header), without parsing it"""
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        lines += 1  # No trailing newline
+    return max(lines - 1, 0)
+
+
+def count_base_sites(path, chunk_rows=CHUNK_ROWS):
+    """Images per base site as a Series (in first-seen order), streamed chunk by chunk"""
+    counts = {}
+    for chunk in read_metadata_chunks(path, ['site_no'], chunk_rows):
+        chunk_counts = base_site_column(chunk['site_no']).value_counts(sort=False)
+        for base_site, count in chunk_counts.items():
+            counts[base_site] = counts.get(base_site, 0) + int(count)
+    return pd.Series(counts, dtype='int64', name='image_count')
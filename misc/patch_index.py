@@ -0,0 +1,306 @@
+import argparse
+import glob
+import logging
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from build_manifest import BuildManifest, build_key
+from image_io import IMAGE_EXTENSIONS
+from label_io import NUM_CLASSES, read_label, read_label_window
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TILE_SIZE = 256
+BACKGROUND, CLOUD, MINING = range(NUM_CLASSES)
+
+# Weight of tiles without any mining pixel in 'mining' sampling, relative to an all-mining tile
+DEFAULT_BACKGROUND_WEIGHT = 0.01
+
+SAMPLING_MODES = ('mining', 'balanced', 'uniform')
+
+
+def default_index_path(label_dir, tile_size=DEFAULT_TILE_SIZE):
+    """Index file next to a label tree (e.g. data/labels -> data/labels.patches_256.npz)"""
+    return f"{os.path.normpath(label_dir)}.patches_{tile_size}.npz"
+
+
+def find_labels(label_dir):
+    """Label files (.png/.tif) under label_dir, relative to it and sorted"""
+    paths = [path for ext in ('.png', '.tif') for path in glob.glob(os.path.join(label_dir, "**", f"*{ext}"),
+                                                                      recursive=True)]
+    return sorted(os.path.relpath(path, label_dir) for path in paths)
+
+
+def tile_histograms(label, tile_size=DEFAULT_TILE_SIZE, stride=None):
+    """Class counts of every tile_size window on a stride grid of a label: (rows, cols, counts).
+
+    Pixels are first counted per class in blocks of gcd(tile_size, stride),
+    so each window is a sum of whole blocks read off a summed-area table;
+    only windows fully inside the label are indexed.
+    """
+    stride = stride or tile_size
+    height, width = label.shape
+    block = math.gcd(tile_size, stride)
+    block_rows, block_cols = height // block, width // block
+    cropped = label[:block_rows * block, :block_cols * block]
+    blocks = np.stack([(cropped == cls).reshape(block_rows, block, block_cols, block).sum((1, 3), dtype=np.int64)
+                       for cls in range(NUM_CLASSES)], axis=-1)
+    table = np.zeros((block_rows + 1, block_cols + 1, NUM_CLASSES), dtype=np.int64)
+    table[1:, 1:] = blocks.cumsum(0).cumsum(1)
+
+    span, step = tile_size // block, stride // block
+    r0 = np.arange(0, block_rows - span + 1, step)
+    c0 = np.arange(0, block_cols - span + 1, step)
+    r1, c1 = r0 + span, c0 + span
+    counts = (table[np.ix_(r1, c1)] - table[np.ix_(r0, c1)] - table[np.ix_(r1, c0)] + table[np.ix_(r0, c0)])
+    rows, cols = np.meshgrid(r0 * block, c0 * block, indexing='ij')
+    return rows.ravel(), cols.ravel(), counts.reshape(-1, NUM_CLASSES)
+
+
+def scan_label(relpath, label_dir, tile_size=DEFAULT_TILE_SIZE, stride=None):
+    """Tile histograms of one label file; returns (relpath, rows, cols, counts, error or None)"""
+    try:
+        rows, cols, counts = tile_histograms(read_label(os.path.join(label_dir, relpath)), tile_size, stride)
+        return relpath, rows, cols, counts, None
+    except Exception as e:
+        return relpath, None, None, None, str(e)
+
+
+class PatchIndex:
+    """Per-tile class histograms of a label tree, stored as flat arrays (one row per tile).
+
+    Tile i covers rows[i]:rows[i]+tile_size, cols[i]:cols[i]+tile_size of
+    label files[file_ids[i]] (relative to label_dir), with counts[i] pixels of
+    background, cloud and mining.
+    """
+
+    def __init__(self, label_dir, files, file_ids, rows, cols, counts, tile_size, stride):
+        self.label_dir = label_dir
+        self.files = np.asarray(files, dtype=str)
+        self.file_ids = file_ids
+        self.rows = rows
+        self.cols = cols
+        self.counts = counts
+        self.tile_size = tile_size
+        self.stride = stride
+        self.failed = []  # Labels that could not be scanned (set by build)
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    @classmethod
+    def build(cls, label_dir, tile_size=DEFAULT_TILE_SIZE, stride=None, workers=1):
+        """Scan every label under label_dir (in parallel with workers > 1) into a new index.
+
+        Labels that cannot be read are left out and listed in index.failed.
+        """
+        stride = stride or tile_size
+        if tile_size <= 0 or stride <= 0:
+            raise ValueError(f"Tile size and stride must be positive (got {tile_size}, {stride})")
+        files = find_labels(label_dir)
+        scan = partial(scan_label, label_dir=label_dir, tile_size=tile_size, stride=stride)
+        kept, file_ids, rows, cols, counts = [], [], [], [], []
+        failed = []
+
+        with Progress(len(files), "Labels", unit="labels", logger=logger) as progress:
+            if workers > 1:
+                executor = ProcessPoolExecutor(max_workers=workers)
+                results = executor.map(scan, files, chunksize=max(1, min(64, len(files) // (4 * workers))))
+            else:
+                executor, results = None, map(scan, files)
+            try:
+                for relpath, tile_rows, tile_cols, tile_counts, error in results:
+                    progress.update()
+                    if error is not None:
+                        logger.error(f"❌ Error scanning {relpath}: {error}")
+                        failed.append(relpath)
+                        continue
+                    file_ids.append(np.full(len(tile_rows), len(kept), dtype=np.uint32))
+                    rows.append(tile_rows.astype(np.uint32))
+                    cols.append(tile_cols.astype(np.uint32))
+                    counts.append(tile_counts.astype(np.uint32))
+                    kept.append(relpath)
+            finally:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+
+        if failed:
+            logger.error(f"❌ {len(failed)} labels could not be read and are not indexed")
+
+        def join(arrays, shape=(0,)):
+            return np.concatenate(arrays) if arrays else np.zeros(shape, dtype=np.uint32)
+
+        index = cls(label_dir, kept, join(file_ids), join(rows), join(cols), join(counts, (0, NUM_CLASSES)),
+                    tile_size, stride)
+        index.failed = failed
+        return index
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(str(data['label_dir']), data['files'], data['file_ids'], data['rows'], data['cols'],
+                       data['counts'], int(data['tile_size']), int(data['stride']))
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, label_dir=self.label_dir, files=self.files, file_ids=self.file_ids, rows=self.rows,
+                 cols=self.cols, counts=self.counts, tile_size=self.tile_size, stride=self.stride)
+        os.replace(tmp_path, path)
+
+    def fractions(self):
+        """(tiles, 3) float32 share of background, cloud and mining pixels per tile"""
+        return self.counts.astype(np.float32) / (self.tile_size * self.tile_size)
+
+    def label_path(self, i):
+        return os.path.join(self.label_dir, self.files[self.file_ids[i]])
+
+    def image_path(self, i):
+        """Image of tile i's label: same name under the sibling images/ directory, in any image format"""
+        relpath = os.path.splitext(self.files[self.file_ids[i]])[0]
+        image_dir = os.path.join(os.path.dirname(os.path.normpath(self.label_dir)), "images")
+        for ext in IMAGE_EXTENSIONS:
+            path = os.path.join(image_dir, relpath + ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def window(self, i):
+        return Window(int(self.cols[i]), int(self.rows[i]), self.tile_size, self.tile_size)
+
+    def read(self, i, bands=None):
+        """(image, label) of tile i from windowed reads, so only the tile's pixels are decoded"""
+        window = self.window(i)
+        with rasterio.open(self.image_path(i)) as src:
+            image = src.read(bands, window=window)
+        return image, read_label_window(self.label_path(i), window)
+
+    def summary(self):
+        fractions = self.fractions()
+        return {
+            'labels': len(self.files),
+            'tiles': len(self),
+            'tiles_with_mining': int(np.count_nonzero(self.counts[:, MINING])),
+            'tiles_mostly_cloud': int(np.count_nonzero(fractions[:, CLOUD] > 0.5)),
+            'class_pixels': [int(n) for n in self.counts.sum(axis=0, dtype=np.int64)],
+        }
+
+
+def alias_table(weights):
+    """Walker alias table (prob, alias) of non-negative weights, for O(1) weighted draws"""
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64) * n / weights.sum()
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = list(np.flatnonzero(scaled < 1))
+    large = list(np.flatnonzero(scaled >= 1))
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    return prob, alias
+
+
+class PatchSampler:
+    """Draw tile indices of a PatchIndex with weights set up once, in O(1) per draw.
+
+    'mining' weights tiles by their mining share (plus background_weight, so
+    tiles without mining still show up now and then), 'balanced' by the
+    inverse frequency of each class over the whole index and 'uniform'
+    equally. Tiles with more than max_cloud cloud are never drawn.
+    """
+
+    def __init__(self, index, mode='mining', background_weight=DEFAULT_BACKGROUND_WEIGHT, max_cloud=None,
+                 seed=None):
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Unknown sampling mode: {mode}")
+        self.index = index
+        self.rng = np.random.default_rng(seed)
+        fractions = index.fractions()
+        if mode == 'mining':
+            weights = fractions[:, MINING] + background_weight
+        elif mode == 'balanced':
+            class_share = fractions.mean(axis=0)
+            weights = (fractions / np.where(class_share > 0, class_share, 1)).sum(axis=1)
+        else:
+            weights = np.ones(len(index))
+        if max_cloud is not None:
+            weights = np.where(fractions[:, CLOUD] > max_cloud, 0, weights)
+        if not len(weights) or weights.sum() <= 0:
+            raise ValueError("No tiles to sample from")
+        self.weights = weights
+        self.prob, self.alias = alias_table(weights)
+
+    def sample(self, n=1):
+        """n tile indices, drawn with replacement"""
+        i = self.rng.integers(len(self.prob), size=n)
+        return np.where(self.rng.random(n) < self.prob[i], i, self.alias[i])
+
+    def __iter__(self):
+        while True:
+            yield int(self.sample(1)[0])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Index per-tile class histograms of a label tree for patch sampling")
+    parser.add_argument("label_dir", nargs="?", default="data/labels",
+                        help="Label tree to index (e.g. data/labels or dataset1/train/labels)")
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE,
+                        help="Patch size in pixels")
+    parser.add_argument("--stride", type=int, default=None,
+                        help="Distance between patch origins (default: the tile size, i.e. no overlap)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes (1 = sequential)")
+    parser.add_argument("--output", default=None,
+                        help="Index file (default: <label_dir>.patches_<tile size>.npz)")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild the index even if no label changed")
+    add_logging_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+    output = args.output or default_index_path(args.label_dir, args.tile_size)
+
+    # One index per label tree; rebuilt only when a label (or the tiling) changes
+    manifest = BuildManifest()
+    target = f"patch_index:{output}"
+    key = build_key([os.path.join(args.label_dir, path) for path in find_labels(args.label_dir)],
+                    {'tile_size': args.tile_size, 'stride': args.stride or args.tile_size})
+    if not args.force and manifest.is_up_to_date(target, key, [output]):
+        logger.info(f"⏭️  {output} is up to date")
+        return
+
+    logger.info(f"\n=== Indexing {args.tile_size}px tiles of {args.label_dir} ===")
+    index = PatchIndex.build(args.label_dir, args.tile_size, args.stride, args.workers)
+    index.save(output)
+    # An index with missing labels is never recorded, so the next run rescans them
+    if index.failed:
+        manifest.forget(target)
+    else:
+        manifest.record(target, key, [output])
+    manifest.save()
+
+    summary = index.summary()
+    logger.info(f"\n✅ {summary['tiles']} tiles from {summary['labels']} labels saved to {output}")
+    logger.info(f"  Tiles with mining: {summary['tiles_with_mining']} "
+                f"({100 * summary['tiles_with_mining'] / max(summary['tiles'], 1):.1f}%)")
+    logger.info(f"  Tiles more than half cloud: {summary['tiles_mostly_cloud']}")
+    logger.info(f"  Pixels (background/cloud/mining): {summary['class_pixels']}")
+    if index.failed:
+        logger.error(f"❌ {len(index.failed)} labels are missing from the index; fix them and run again")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
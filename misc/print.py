@@ -1,39 +1,108 @@
-from xml.etree import ElementTree as ET
-
-# Parse the KML file
-with open("metadata/global_mining_extents_detailed.kml", 'rb') as file:
-    tree = ET.parse(file)
-    root = tree.getroot()
-
-# KML namespace
-ns = {"kml": "http://www.opengis.net/kml/2.2"}
-
-# Find all placemarks
-placemarks = root.findall(".//kml:Placemark", ns)
-print(f"Found {len(placemarks)} placemarks")
-
-# Loop over placemarks
-for i, pm in enumerate(placemarks[:5]):  # Limit to 5 for brevity
-    name = pm.find("kml:name", ns)
-    print(f"\nPlacemark {i+1}")
-    print(f"Name: {name.text if name is not None else 'No name'}")
-    
-    # Look for Polygon or MultiGeometry
-    coords = pm.find(".//kml:coordinates", ns)
-    if coords is not None:
-        # Raw coordinates are like "lon,lat[,alt] lon,lat[,alt] ..."
-        raw = coords.text.strip()
-        coord_list = [tuple(map(float, pt.split(",")[:2])) for pt in raw.split()]
-        
-        # Print only the first few coordinates
-        print("Coordinates (showing first 5 points):")
-        for coord in coord_list[:5]:  # Print only first 5 coordinates
-            print(coord)
-    else:
-        print("No coordinates found")
-
-# After printing the coordinates, print all placemark names
-print("\nAll placemark names:")
-for pm in placemarks:
-    name = pm.find("kml:name", ns)
-    print(name.text if name is not None else "Unnamed")
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from kml_index import PolygonStore, base_site_name, iter_placemarks
+
+kml_path = "metadata/global_mining_extents_detailed.kml"
+
+
+def show_placemarks(kml_path, limit=5):
+    """Placemark count, the first placemarks with a few coordinates and all names, streamed from the KML"""
+    names = []
+    for i, (name, coords) in enumerate(iter_placemarks(kml_path)):
+        names.append(name)
+        if i >= limit:
+            continue
+        print(f"\nPlacemark {i+1}")
+        print(f"Name: {name if name is not None else 'No name'}")
+        if coords is not None:
+            # Print only the first few coordinates
+            print("Coordinates (showing first 5 points):")
+            for coord in coords[:5]:
+                print(coord)
+        else:
+            print("No coordinates found")
+
+    print(f"\nFound {len(names)} placemarks")
+    print("\nAll placemark names:")
+    for name in names:
+        print(name if name is not None else "Unnamed")
+
+
+def print_polygons(store, indices):
+    """One line per polygon: name, vertices, area and bounds"""
+    vertices, areas = store.vertex_counts(), store.areas_km2()
+    for i in indices:
+        minx, miny, maxx, maxy = store.polygons[i].bounds
+        print(f"{store.names[i]:50s} {vertices[i]:8d} vertices {areas[i]:12.4f} km²  "
+              f"({minx:.5f}, {miny:.5f}, {maxx:.5f}, {maxy:.5f})")
+    print(f"\n{len(indices)} polygons, {int(vertices[indices].sum())} vertices, "
+          f"{areas[indices].sum():.4f} km²")
+
+
+def site_stats(store):
+    """Per base site: polygons, vertices (total/max) and area"""
+    vertices, areas = store.vertex_counts(), store.areas_km2()
+    rows = []
+    for site in store.site_names():
+        group = np.asarray(store.groups[site])
+        rows.append((site, len(group), int(vertices[group].sum()), int(vertices[group].max()),
+                     float(areas[group].sum())))
+    return rows
+
+
+def print_site_stats(store, sort_by='site', csv_path=None):
+    rows = site_stats(store)
+    columns = ['site', 'polygons', 'vertices', 'max_vertices', 'area_km2']
+    if sort_by != 'site':
+        rows.sort(key=lambda row: row[columns.index(sort_by)], reverse=True)
+    if csv_path:
+        pd.DataFrame(rows, columns=columns).to_csv(csv_path, index=False)
+        print(f"✅ Per-site statistics saved to {csv_path}")
+    print(f"{'site':50s} {'polygons':>8s} {'vertices':>10s} {'max':>8s} {'area km²':>12s}")
+    for site, polygons, total, largest, area in rows:
+        print(f"{site:50s} {polygons:8d} {total:10d} {largest:8d} {area:12.4f}")
+    print(f"\n{len(rows)} sites, {len(store)} polygons")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inspect the mining extents KML")
+    parser.add_argument("--kml", default=kml_path, help="KML file to inspect")
+    commands = parser.add_subparsers(dest="command")
+
+    placemarks = commands.add_parser("placemarks", help="Stream the KML and print placemark names (default)")
+    placemarks.add_argument("--limit", type=int, default=5,
+                            help="Placemarks printed with their first coordinates")
+    site = commands.add_parser("site", help="Polygons of a base site (case-insensitive, as label generation matches it)")
+    site.add_argument("site", help="Base site or site number (e.g. mali_faleme_upper or mali_faleme_upper_1)")
+    bbox = commands.add_parser("bbox", help="Polygons intersecting a lon/lat bounding box")
+    bbox.add_argument("bounds", type=float, nargs=4, metavar=("MINX", "MINY", "MAXX", "MAXY"))
+    bbox.add_argument("--site", default=None, help="Only polygons of this base site")
+    stats = commands.add_parser("stats", help="Polygon count, vertices and area per base site")
+    stats.add_argument("--sort", choices=['site', 'polygons', 'vertices', 'max_vertices', 'area_km2'],
+                       default='site', help="Sort column (numeric columns sort descending)")
+    stats.add_argument("--csv", default=None, help="Also write the table to this CSV file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command in (None, "placemarks"):
+        show_placemarks(args.kml, getattr(args, 'limit', 5))
+        return
+
+    # Queries use the cached polygon store and STRtree that create_gt.py builds, never simplified,
+    # so vertex counts and areas are those of the KML
+    store = PolygonStore.load(args.kml, resolution_m=0)
+    if args.command == "site":
+        print_polygons(store, store.site_indices(base_site_name(args.site)))
+    elif args.command == "bbox":
+        print_polygons(store, store.intersecting(args.bounds, args.site and base_site_name(args.site)))
+    elif args.command == "stats":
+        print_site_stats(store, args.sort, args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import os
+import warnings
+
+import rasterio
+import rasterio.shutil
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+
+
+def iter_windows(src, tile_size=None):
+    """Yield windows covering src: its internal blocks, or square tiles of tile_size pixels"""
+    if not tile_size:
+        for _, window in src.block_windows(1):
+            yield window
+        return
+    for row_off in range(0, src.height, tile_size):
+        for col_off in range(0, src.width, tile_size):
+            yield Window(col_off, row_off,
+                         min(tile_size, src.width - col_off),
+                         min(tile_size, src.height - row_off))
+
+
+class StreamingCopyWriter:
+    """Write a PNG (or any CreateCopy-only format such as COG) window by window with bounded memory.
+
+    Windows go into a temporary tiled GeoTIFF; on close GDAL copies it to the
+    target driver block by block, so the full image is never held in memory.
+    """
+
+    def __init__(self, path, width, height, count, dtype='uint8', colormap=None,
+                 driver='PNG', crs=None, transform=None, nodata=None, **creation_options):
+        self.path = path
+        self.tmp_path = path + ".tmp.tif"
+        self.driver = driver
+        self.creation_options = creation_options
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", NotGeoreferencedWarning)
+            self.dst = rasterio.open(
+                self.tmp_path, 'w', driver='GTiff', width=width, height=height,
+                count=count, dtype=dtype, crs=crs, transform=transform, nodata=nodata,
+                tiled=True, blockxsize=256, blockysize=256
+            )
+        if colormap is not None:
+            # Carried over to the PNG as its palette
+            self.dst.write_colormap(1, colormap)
+
+    def write(self, data, window):
+        """Write a (count, rows, cols) array into window"""
+        self.dst.write(data, window=window)
+
+    def close(self):
+        self.dst.close()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", NotGeoreferencedWarning)
+            rasterio.shutil.copy(self.tmp_path, self.path, driver=self.driver, **self.creation_options)
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.dst.close()
+            os.remove(self.tmp_path)
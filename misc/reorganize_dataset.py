@@ -1,10 +1,20 @@
 import os
 import shutil
 import random
-import re
 import pandas as pd
 from pathlib import Path
 import glob
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from label_io import find_label
+from build_manifest import BuildManifest, build_key
+from image_io import IMAGE_EXTENSIONS
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+from shard_export import DEFAULT_SHARD_DIR, export_shards
+from site_catalog import DEFAULT_COUNTS_PATH, SiteCatalog, parse_scene_name
+
+logger = logging.getLogger(__name__)
 
 def create_dataset_structure():
     """Create the dataset directory structure in MOSE format"""
@@ -16,73 +26,113 @@ def create_dataset_structure():
         os.makedirs(f"dataset1/{split}/rgb", exist_ok=True)
 
 def get_image_files():
-    """Get all image files from data/images"""
-    image_files = glob.glob("data/images/*.tif")
+    """Get all image files (.tif or .vrt) from data/images"""
+    image_files = [path for ext in IMAGE_EXTENSIONS for path in glob.glob(f"data/images/*{ext}")]
     return sorted(image_files)
 
-def load_split_mapping():
-    """Load split mapping from base_site_counts.csv, lowercased and stripped for robust matching"""
-    csv_path = "/deac/csc/alqahtaniGrp/cuij/global-mining/misc/base_site_counts.csv"
-    df = pd.read_csv(csv_path)
-    split_mapping = {}
-    for _, row in df.iterrows():
-        split_mapping[row['base_site'].strip().lower()] = row['split'].strip().lower()
-    return split_mapping
-
-def get_base_site_from_filename(filename, split_mapping):
-    """Extract base site from filename, lowercased and stripped"""
-    name = filename.replace('.tif', '').replace('Landsat_Image_', '')
-    base_site = re.sub(r'_\d+_\d{8}$', '', name)
-    if base_site == name:
-        base_site = re.sub(r'_\d+$', '', name)
-    base_site = base_site.strip().lower()
-    if base_site in split_mapping:
-        return base_site
-    return None
-
-def split_dataset_by_site(image_files, split_mapping):
+def split_dataset_by_site(image_files, catalog):
     """Split dataset based on site information from base_site_counts.csv"""
-    train_files = []
-    val_files = []
-    test_files = []
+    files_by_split = {'train': [], 'val': [], 'test': []}
     unmatched = 0
     
-    print("\n=== Splitting dataset by site ===")
+    logger.debug("\n=== Splitting dataset by site ===")
     
     for image_path in image_files:
         filename = os.path.basename(image_path)
-        base_site = get_base_site_from_filename(filename, split_mapping)
+        base_site, split = catalog.split_of_file(filename)
         
-        if base_site and base_site in split_mapping:
-            split = split_mapping[base_site]
-            if split == 'train':
-                train_files.append(image_path)
-            elif split == 'val':
-                val_files.append(image_path)
-            elif split == 'test':
-                test_files.append(image_path)
-            print(f"  {filename} -> {base_site} -> {split}")
+        if split is not None:
+            if split in files_by_split:
+                files_by_split[split].append(image_path)
+            logger.debug(f"  {filename} -> {base_site} -> {split}")
         else:
-            train_files.append(image_path)
+            files_by_split['train'].append(image_path)
             unmatched += 1
-            print(f"  {filename} -> unknown site -> train (default)")
+            logger.debug(f"  {filename} -> unknown site -> train (default)")
+    
+    return files_by_split['train'], files_by_split['val'], files_by_split['test'], unmatched
+
+LINK_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+FICLONE = 0x40049409  # Linux ioctl for copy-on-write clones (btrfs, XFS, ...)
+
+def reflink(src, dst):
+    """Clone src to dst sharing data blocks; raises OSError where unsupported"""
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+def place_file(src, dst, link_mode='copy'):
+    """Place src at dst by copy, hardlink, symlink or reflink, falling back to a copy.
+    
+    Returns the mode that was actually used.
+    """
+    # Never write through an existing link into the source file
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if link_mode == 'hardlink':
+            os.link(src, dst)
+            return link_mode
+        if link_mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return link_mode
+        if link_mode == 'reflink':
+            reflink(src, dst)
+            return link_mode
+    except (OSError, ImportError):
+        # e.g. EXDEV across filesystems, EOPNOTSUPP/ENOTTY without reflink support,
+        # no fcntl on Windows; a real problem with src resurfaces in the copy below
+        if os.path.lexists(dst):
+            os.remove(dst)
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def place_if_changed(src, dst, manifest, link_mode='copy'):
+    """Place src at dst unless dst was already built from the same, unchanged src.
+    
+    Returns the mode used, or None when dst was up to date.
+    """
+    target = f"reorganize:{dst}"
+    key = build_key([src], {'link_mode': link_mode})
+    if manifest is not None and manifest.is_up_to_date(target, key, [dst]):
+        return None
+    used_mode = place_file(src, dst, link_mode)
+    if manifest is not None:
+        manifest.record(target, key, [dst])
+    return used_mode
+
+def run_file_jobs(jobs, manifest, link_mode='copy', workers=8):
+    """Place (src, dst, message) jobs through a thread pool; file I/O releases the GIL"""
+    if not jobs:
+        return
+    
+    def run(job):
+        src, dst, message = job
+        used_mode = place_if_changed(src, dst, manifest, link_mode)
+        if used_mode is not None:
+            suffix = "" if used_mode == link_mode else f" (fell back to {used_mode})"
+            logger.debug(f"✅ {message}{suffix}")
+        return used_mode
     
-    return train_files, val_files, test_files, unmatched
+    placed = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor, \
+            Progress(len(jobs), "Files", unit="files", logger=logger) as progress:
+        # Iterating re-raises the first error from any worker
+        for used_mode in executor.map(run, jobs):
+            placed += used_mode is not None
+            progress.update()
+    logger.info(f"✅ Placed {placed} files, {len(jobs) - placed} already up to date")
 
-def organize_files_by_site(file_list, split_name):
+def organize_files_by_site(file_list, split_name, manifest=None, link_mode='copy', workers=8):
     """Organize files by site number with sequential numbering in MOSE format"""
-    print(f"\n=== Organizing files for {split_name} split ===")
+    logger.info(f"\n=== Organizing files for {split_name} split ===")
     
     # Group files by site number (not base site)
     site_files = {}
     for image_path in file_list:
-        filename = os.path.basename(image_path)
-        base_name = os.path.splitext(filename)[0]
-        
         # Extract site number from filename (e.g., mali_faleme_upper_1_20200524 -> mali_faleme_upper_1)
-        name = base_name.replace('Landsat_Image_', '')
-        # Remove date suffix first, then extract site number
-        site_number = re.sub(r'_\d{8}$', '', name)
+        site_number = parse_scene_name(os.path.basename(image_path)).site_no
         
         if site_number not in site_files:
             site_files[site_number] = []
@@ -90,10 +140,13 @@ def organize_files_by_site(file_list, split_name):
     
     # Create filename mapping data
     mapping_data = []
+    # (src, dst, message) files to place once all directories exist
+    jobs = []
+    verb = "Copied" if link_mode == 'copy' else "Linked"
     
     # Process each site number
     for site_number, image_paths in site_files.items():
-        print(f"\nProcessing site: {site_number}")
+        logger.debug(f"\nProcessing site: {site_number}")
         
         # Create site directory
         site_dir = f"dataset1/{split_name}/images/{site_number}"
@@ -104,40 +157,38 @@ def organize_files_by_site(file_list, split_name):
         
         # Copy files with sequential numbering
         for idx, image_path in enumerate(image_paths):
-            base_name = os.path.splitext(os.path.basename(image_path))[0]
+            base_name, image_ext = os.path.splitext(os.path.basename(image_path))
             
             # Source paths
-            label_path = os.path.join("data/labels", f"{base_name}.png")
+            label_path = find_label("data/labels", base_name) or os.path.join("data/labels", f"{base_name}.png")
             rgb_path = os.path.join("data/rgb", f"{base_name}.png")
             
             # Destination paths with sequential numbering
             new_filename = f"{idx:05d}"  # 00000, 00001, etc.
-            dst_image = os.path.join(site_dir, f"{new_filename}.tif")
-            dst_label = os.path.join(f"dataset1/{split_name}/labels/{site_number}", f"{new_filename}.png")
+            dst_image = os.path.join(site_dir, f"{new_filename}{image_ext}")
+            label_ext = os.path.splitext(label_path)[1]
+            dst_label = os.path.join(f"dataset1/{split_name}/labels/{site_number}", f"{new_filename}{label_ext}")
             dst_rgb = os.path.join(f"dataset1/{split_name}/rgb/{site_number}", f"{new_filename}.png")
             
             # Create label and rgb directories
             os.makedirs(os.path.dirname(dst_label), exist_ok=True)
             os.makedirs(os.path.dirname(dst_rgb), exist_ok=True)
             
-            # Copy files
+            # Queue files
             if os.path.exists(image_path):
-                shutil.copy2(image_path, dst_image)
-                print(f"✅ Copied image: {base_name}.tif -> {new_filename}.tif")
+                jobs.append((image_path, dst_image, f"{verb} image: {base_name}{image_ext} -> {new_filename}{image_ext}"))
             else:
-                print(f"❌ Image not found: {image_path}")
+                logger.warning(f"❌ Image not found: {image_path}")
                 
             if os.path.exists(label_path):
-                shutil.copy2(label_path, dst_label)
-                print(f"✅ Copied label: {base_name}.png -> {new_filename}.png")
+                jobs.append((label_path, dst_label, f"{verb} label: {base_name}{label_ext} -> {new_filename}{label_ext}"))
             else:
-                print(f"❌ Label not found: {label_path}")
+                logger.warning(f"❌ Label not found: {label_path}")
                 
             if os.path.exists(rgb_path):
-                shutil.copy2(rgb_path, dst_rgb)
-                print(f"✅ Copied RGB: {base_name}.png -> {new_filename}.png")
+                jobs.append((rgb_path, dst_rgb, f"{verb} RGB: {base_name}.png -> {new_filename}.png"))
             else:
-                print(f"❌ RGB not found: {rgb_path}")
+                logger.warning(f"❌ RGB not found: {rgb_path}")
             
             # Add to mapping data
             mapping_data.append({
@@ -148,6 +199,8 @@ def organize_files_by_site(file_list, split_name):
                 'file_index': idx
             })
     
+    run_file_jobs(jobs, manifest, link_mode, workers)
+    
     return mapping_data
 
 def save_filename_mapping(all_mapping_data):
@@ -155,51 +208,74 @@ def save_filename_mapping(all_mapping_data):
     df = pd.DataFrame(all_mapping_data)
     mapping_path = "dataset1/filename_mapping.csv"
     df.to_csv(mapping_path, index=False)
-    print(f"\n✅ Filename mapping saved to: {mapping_path}")
-    print(f"Total mappings: {len(df)}")
+    logger.info(f"\n✅ Filename mapping saved to: {mapping_path}")
+    logger.info(f"Total mappings: {len(df)}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reorganize data/ into the MOSE dataset format")
+    parser.add_argument("--link-mode", choices=LINK_MODES, default='copy',
+                        help="How files are placed in dataset1/ (falls back to copy when unsupported)")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Threads used to place files")
+    parser.add_argument("--site-counts", default=DEFAULT_COUNTS_PATH,
+                        help="base_site_counts.csv with the split of every base site")
+    parser.add_argument("--export-shards", action="store_true",
+                        help=f"Also pack every split into memory-mappable shards in {DEFAULT_SHARD_DIR}/ (see shard_export.py)")
+    add_logging_args(parser)
+    return parser.parse_args()
 
 def main():
-    print("=== Dataset Reorganization (MOSE Format) ===")
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+    logger.info("=== Dataset Reorganization (MOSE Format) ===")
     
     random.seed(42)
     create_dataset_structure()
     
-    split_mapping = load_split_mapping()
-    print(f"Loaded split mapping for {len(split_mapping)} sites")
+    catalog = SiteCatalog.load(args.site_counts)
+    logger.info(f"Loaded split mapping for {len(catalog)} sites")
     
     image_files = get_image_files()
-    print(f"\nFound {len(image_files)} images")
+    logger.info(f"\nFound {len(image_files)} images")
     
     if len(image_files) == 0:
-        print("❌ No images found in data/images/")
+        logger.error("❌ No images found in data/images/")
         return
     
-    train_files, val_files, test_files, unmatched = split_dataset_by_site(image_files, split_mapping)
+    train_files, val_files, test_files, unmatched = split_dataset_by_site(image_files, catalog)
     
-    print(f"\nDataset split by site:")
-    print(f"  Train: {len(train_files)} images")
-    print(f"  Val: {len(val_files)} images")
-    print(f"  Test: {len(test_files)} images")
-    print(f"  Unmatched (defaulted to train): {unmatched}")
-    print(f"  Total: {len(train_files) + len(val_files) + len(test_files)}")
+    logger.info(f"\nDataset split by site:")
+    logger.info(f"  Train: {len(train_files)} images")
+    logger.info(f"  Val: {len(val_files)} images")
+    logger.info(f"  Test: {len(test_files)} images")
+    logger.info(f"  Unmatched (defaulted to train): {unmatched}")
+    logger.info(f"  Total: {len(train_files) + len(val_files) + len(test_files)}")
     
     # Organize files in MOSE format
     all_mapping_data = []
     
-    train_mapping = organize_files_by_site(train_files, "train")
+    # Copies whose source is unchanged since the last run are skipped
+    manifest = BuildManifest()
+    
+    train_mapping = organize_files_by_site(train_files, "train", manifest, args.link_mode, args.workers)
     all_mapping_data.extend(train_mapping)
     
-    val_mapping = organize_files_by_site(val_files, "val")
+    val_mapping = organize_files_by_site(val_files, "val", manifest, args.link_mode, args.workers)
     all_mapping_data.extend(val_mapping)
     
-    test_mapping = organize_files_by_site(test_files, "test")
+    test_mapping = organize_files_by_site(test_files, "test", manifest, args.link_mode, args.workers)
     all_mapping_data.extend(test_mapping)
     
+    manifest.save()
+    
     # Save filename mapping
     save_filename_mapping(all_mapping_data)
     
-    print("\n=== Dataset reorganization completed! ===")
-    print("Dataset organized in MOSE format with sequential numbering")
+    if args.export_shards:
+        export_shards(workers=args.workers)
+    
+    logger.info("\n=== Dataset reorganization completed! ===")
+    logger.info("Dataset organized in MOSE format with sequential numbering")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
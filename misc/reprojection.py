@@ -0,0 +1,63 @@
+from functools import lru_cache
+
+import numpy as np
+import pyproj
+import shapely
+
+# CRS of the KML polygons
+KML_CRS = "EPSG:4326"
+
+
+def crs_key(crs):
+    """Hashable key of a CRS given as a string, rasterio CRS or pyproj CRS"""
+    if isinstance(crs, str):
+        return crs
+    return crs.to_wkt()
+
+
+@lru_cache(maxsize=None)
+def _transformer(src_key, dst_key):
+    return pyproj.Transformer.from_crs(src_key, dst_key, always_xy=True)
+
+
+def get_transformer(src_crs, dst_crs):
+    """Transformer from src_crs to dst_crs (lon/lat order), built once per CRS pair"""
+    return _transformer(crs_key(src_crs), crs_key(dst_crs))
+
+
+def reproject_geometries(geometries, dst_crs, src_crs=KML_CRS):
+    """Reproject an array of geometries with a single vectorized pyproj call.
+
+    shapely.transform hands the coordinates of all geometries to the
+    transformer as one (N, 2) array instead of calling back per vertex.
+    """
+    transformer = get_transformer(src_crs, dst_crs)
+
+    def project(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(np.asarray(geometries, dtype=object), project)
+
+
+class ProjectedSites:
+    """Site polygons reprojected to image CRSs, memoized per (base site, CRS)"""
+
+    def __init__(self, store):
+        self.store = store
+        self._projected = {}
+
+    def get(self, base_site_no, crs):
+        """Reprojected polygons of a base site, aligned with store.site_indices(base_site_no)"""
+        key = (base_site_no.lower(), crs_key(crs))
+        if key not in self._projected:
+            indices = self.store.site_indices(base_site_no)
+            self._projected[key] = reproject_geometries(
+                [self.store.polygons[i] for i in indices], crs
+            )
+        return self._projected[key]
+
+    def subset(self, base_site_no, crs, indices):
+        """Reprojected polygons for store indices belonging to base_site_no"""
+        positions = np.searchsorted(self.store.site_indices(base_site_no), indices)
+        return self.get(base_site_no, crs)[positions]
@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Checkpoint after this many finished items or this many seconds, whichever comes first
+CHECKPOINT_EVERY = 100
+CHECKPOINT_SECONDS = 60
+
+
+def journal_paths(name, data_dir="data"):
+    """Journal and retry list paths of a script (e.g. data/create_gt_journal.json, data/create_gt_failed.txt)"""
+    return os.path.join(data_dir, f"{name}_journal.json"), os.path.join(data_dir, f"{name}_failed.txt")
+
+
+def atomic_write(path, text):
+    """Write text to a temporary file and rename it over path"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class RunJournal:
+    """Completed and failed items of a run, checkpointed atomically so an interrupted run can resume.
+
+    The journal remembers the parameters it was started with (params_key);
+    resuming with different parameters starts a fresh journal instead.
+    on_checkpoint is called on every checkpoint, e.g. to save the build
+    manifest alongside the journal.
+    """
+
+    def __init__(self, path, params_key=None, on_checkpoint=None,
+                 checkpoint_every=CHECKPOINT_EVERY, checkpoint_seconds=CHECKPOINT_SECONDS):
+        self.path = path
+        self.params_key = params_key
+        self.on_checkpoint = on_checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
+        self.completed = {}  # item -> True, in completion order
+        self.failed = {}  # item -> error message
+        self.unsaved = 0
+        self.last_checkpoint = time.monotonic()
+
+    @classmethod
+    def open(cls, path, params_key=None, resume=False, **kwargs):
+        """Continue the journal at path when resuming with the same parameters, else start a new one"""
+        journal = cls(path, params_key, **kwargs)
+        if not resume or not os.path.exists(path):
+            return journal
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('params_key') != params_key:
+            logger.warning(f"⚠️ {path} was written with different parameters; starting a new run")
+            return journal
+        journal.completed = dict.fromkeys(state.get('completed', []), True)
+        journal.failed = dict(state.get('failed', {}))
+        return journal
+
+    def pending(self, items):
+        """Items not completed yet, in their original order"""
+        return [item for item in items if item not in self.completed]
+
+    def done(self, item):
+        self.completed[item] = True
+        self.failed.pop(item, None)
+        self._finished()
+
+    def fail(self, item, error):
+        self.completed.pop(item, None)
+        self.failed[item] = error
+        self._finished()
+
+    def _finished(self):
+        self.unsaved += 1
+        if (self.unsaved >= self.checkpoint_every
+                or time.monotonic() - self.last_checkpoint >= self.checkpoint_seconds):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Atomically write the journal (and run on_checkpoint)"""
+        if self.on_checkpoint is not None:
+            self.on_checkpoint()
+        state = {'params_key': self.params_key, 'completed': list(self.completed), 'failed': self.failed}
+        atomic_write(self.path, json.dumps(state))
+        self.unsaved = 0
+        self.last_checkpoint = time.monotonic()
+
+    def write_retry_list(self, path):
+        """Write failed items one per line (an empty file when nothing failed)"""
+        atomic_write(path, "".join(f"{item}\n" for item in self.failed))
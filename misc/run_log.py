@@ -0,0 +1,184 @@
+import csv
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+LOG_FORMAT = "%(message)s"
+FILE_LOG_FORMAT = "%(asctime)s %(processName)s %(levelname)s %(name)s: %(message)s"
+
+# Libraries whose debug output is only shown from -vv
+LIBRARY_LOGGERS = ('rasterio', 'matplotlib', 'PIL', 'numba', 'fiona')
+
+# Seconds between progress lines when tqdm is not installed
+PROGRESS_INTERVAL = 10
+
+
+def add_logging_args(parser):
+    """Add -v/--verbose, -q/--quiet and --log-file to an argparse parser"""
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="Log per-scene/per-file details (-v), plus library debug output (-vv)")
+    parser.add_argument("-q", "--quiet", action="count", default=0,
+                        help="Only log warnings and errors (-q)")
+    parser.add_argument("--log-file", default=None,
+                        help="Also write a full debug log with timestamps to this file")
+
+
+def verbosity(args):
+    return args.verbose - args.quiet
+
+
+class TqdmHandler(logging.StreamHandler):
+    """Print log records above the progress bar instead of through it"""
+
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record), file=sys.stderr)
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging(level=0, log_file=None):
+    """Configure the root logger: 0 = INFO, >0 = DEBUG, <0 = WARNING on the console"""
+    console_level = logging.DEBUG if level > 0 else logging.INFO if level == 0 else logging.WARNING
+    console = TqdmHandler() if tqdm is not None else logging.StreamHandler(sys.stderr)
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [console]
+    if log_file:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(logging.Formatter(FILE_LOG_FORMAT))
+        handlers.append(file_handler)
+    logging.basicConfig(level=logging.DEBUG if log_file else console_level, handlers=handlers, force=True)
+    for name in LIBRARY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.NOTSET if level > 1 else logging.WARNING)
+
+
+class Progress:
+    """Progress bar (tqdm when installed, otherwise periodic log lines)"""
+
+    def __init__(self, total, desc, unit="it", logger=None):
+        self.total = total
+        self.desc = desc
+        self.unit = unit
+        self.count = 0
+        self.logger = logger or logging.getLogger(__name__)
+        self.start = self.last_report = time.perf_counter()
+        self.enabled = self.logger.isEnabledFor(logging.INFO)
+        self.bar = None
+        if tqdm is not None and self.enabled:
+            self.bar = tqdm(total=total, desc=desc, unit=unit, file=sys.stderr, dynamic_ncols=True)
+
+    def update(self, n=1):
+        self.count += n
+        if self.bar is not None:
+            self.bar.update(n)
+            return
+        now = time.perf_counter()
+        if self.enabled and (now - self.last_report >= PROGRESS_INTERVAL or self.count >= self.total):
+            self.last_report = now
+            elapsed = now - self.start
+            rate = self.count / elapsed if elapsed else 0
+            eta = (self.total - self.count) / rate if rate else 0
+            self.logger.info(f"{self.desc}: {self.count}/{self.total} {self.unit} "
+                             f"({100 * self.count / max(self.total, 1):.0f}%, {rate:.2f} {self.unit}/s, ETA {eta:.0f}s)")
+
+    def close(self):
+        if self.bar is not None:
+            self.bar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class StageProfiler:
+    """Wall time per stage (read, polygons, rasterize, ...) accumulated per scene.
+
+    Finished scenes are added to per-stage totals; their individual timings
+    are only kept (for save()) when keep_scenes is set. The current scene is
+    per thread, so pipelined stages can time different scenes at once.
+    """
+
+    def __init__(self, keep_scenes=True):
+        self.keep_scenes = keep_scenes
+        self.scenes = {}  # scene -> {stage: seconds}
+        self.totals = {}  # stage -> [seconds, scenes]
+        self.local = threading.local()
+
+    @property
+    def current(self):
+        return getattr(self.local, 'current', None)
+
+    @current.setter
+    def current(self, timings):
+        self.local.current = timings
+
+    def start_scene(self, scene):
+        self.current = self.scenes.setdefault(scene, {})
+
+    def pop_scene(self, scene):
+        """Timings of a finished scene (removed, so they can be shipped back from a worker)"""
+        if self.current is self.scenes.get(scene):
+            self.current = None
+        return self.scenes.pop(scene, {})
+
+    def add_scene(self, scene, timings):
+        for name, seconds in timings.items():
+            total = self.totals.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        if self.keep_scenes:
+            self.scenes[scene] = dict(timings)
+
+    def record(self, name, seconds):
+        """Add seconds to a stage of the current scene"""
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def summary(self):
+        """Per stage of the added scenes: total seconds, scenes, mean seconds per scene"""
+        return {name: {'seconds': seconds, 'scenes': count, 'mean_seconds': seconds / count}
+                for name, (seconds, count) in self.totals.items()}
+
+    def log_summary(self, logger, total_stage='total'):
+        summary = self.summary()
+        if not summary:
+            return
+        total = summary.get(total_stage, {}).get('seconds') or sum(s['seconds'] for s in summary.values())
+        logger.info("\n=== Time per stage ===")
+        for name, stats in summary.items():
+            share = f"{100 * stats['seconds'] / total:5.1f}%" if total and name != total_stage else "      "
+            logger.info(f"{name:14s} {stats['seconds']:10.2f}s  {share}  "
+                        f"{1000 * stats['mean_seconds']:9.1f} ms/scene ({stats['scenes']} scenes)")
+
+    def save(self, path):
+        """Write per-scene timings as CSV (one row per scene) or JSON (with the per-stage summary)"""
+        if path.endswith(".json"):
+            with open(path, 'w') as f:
+                json.dump({'stages': self.summary(), 'scenes': self.scenes}, f, indent=2)
+            return
+        names = list(self.totals)
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['scene'] + names)
+            for scene, timings in self.scenes.items():
+                writer.writerow([scene] + [f"{timings[n]:.6f}" if n in timings else "" for n in names])
@@ -0,0 +1,265 @@
+import argparse
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from build_manifest import BuildManifest, build_key
+from image_io import IMAGE_EXTENSIONS
+from label_io import find_label, read_label
+from run_journal import atomic_write
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATASET_DIR = "dataset1"
+DEFAULT_SHARD_DIR = "dataset1_shards"
+DEFAULT_SHARD_GB = 4
+INDEX_FILENAME = "shards.json"
+MAPPING_FILENAME = "filename_mapping.csv"
+INDEX_VERSION = 1
+SPLITS = ("train", "val", "test")
+
+
+def scene_sources(dataset_dir, split, site_number, new_filename):
+    """(image path, label path) of a scene in the MOSE tree; either is None when missing"""
+    image_path = None
+    for ext in IMAGE_EXTENSIONS:
+        path = os.path.join(dataset_dir, split, "images", site_number, new_filename + ext)
+        if os.path.exists(path):
+            image_path = path
+            break
+    label_path = find_label(os.path.join(dataset_dir, split, "labels", site_number), new_filename)
+    return image_path, label_path
+
+
+def scan_sites(mapping, dataset_dir):
+    """Per (split, site): its scenes in file_index order with their band count, size and dtype (headers only)"""
+    sites = []
+    for (split, site_number), rows in mapping.groupby(['split', 'site_number'], sort=False):
+        scenes = []
+        for row in rows.sort_values('file_index').to_dict('records'):
+            image_path, label_path = scene_sources(dataset_dir, split, site_number, row['new_filename'])
+            if image_path is None or label_path is None:
+                logger.warning(f"❌ Skipping {split}/{site_number}/{row['new_filename']}: "
+                               f"{'image' if image_path is None else 'label'} not found")
+                continue
+            with rasterio.open(image_path) as src:
+                scenes.append(dict(row, image_path=image_path, label_path=label_path, bands=src.count,
+                                   height=src.height, width=src.width, dtype=src.dtypes[0]))
+        if scenes:
+            sites.append({'split': split, 'site_number': site_number, 'scenes': scenes})
+    return sites
+
+
+def plan_shards(sites, dtype, max_bytes):
+    """Assign each site of a split to a shard and an element offset in it.
+
+    A site's scenes are stored as one (t, band, y, x) block, padded to the
+    largest scene of the site; a site is never split across shards.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    shards = []  # [image elements, label elements] per shard
+    for site in sites:
+        scenes = site['scenes']
+        shape = (len(scenes), max(s['bands'] for s in scenes),
+                 max(s['height'] for s in scenes), max(s['width'] for s in scenes))
+        image_size = int(np.prod(shape))
+        label_size = shape[0] * shape[2] * shape[3]
+        if not shards or (shards[-1][0] and (shards[-1][0] + image_size) * itemsize > max_bytes):
+            shards.append([0, 0])
+        site.update(shard=len(shards) - 1, shape=list(shape),
+                    image_offset=shards[-1][0], label_offset=shards[-1][1])
+        shards[-1][0] += image_size
+        shards[-1][1] += label_size
+    return shards
+
+
+def shard_filenames(split, shard):
+    return f"{split}/images_{shard:03d}.npy", f"{split}/labels_{shard:03d}.npy"
+
+
+def write_shard(output_dir, split, shard, sizes, sites, dtype, workers=8, progress=None):
+    """Fill one image shard and its label shard from the scenes of its sites (written to .tmp, then renamed)"""
+    paths = [os.path.join(output_dir, name) for name in shard_filenames(split, shard)]
+    tmp_paths = [f"{path}.tmp" for path in paths]
+    images = np.lib.format.open_memmap(tmp_paths[0], mode='w+', dtype=dtype, shape=(sizes[0],))
+    labels = np.lib.format.open_memmap(tmp_paths[1], mode='w+', dtype=np.uint8, shape=(sizes[1],))
+
+    def fill(site, t, scene):
+        t_count, bands, rows, cols = site['shape']
+        image_block = images[site['image_offset']:site['image_offset'] + t_count * bands * rows * cols]
+        label_block = labels[site['label_offset']:site['label_offset'] + t_count * rows * cols]
+        image_view = image_block.reshape(site['shape'])[t]
+        label_view = label_block.reshape(t_count, rows, cols)[t]
+        h, w = scene['height'], scene['width']
+        with rasterio.open(scene['image_path']) as src:
+            if (scene['bands'], h, w) == (bands, rows, cols) and scene['dtype'] == images.dtype:
+                src.read(out=image_view)  # Straight into the memmap, no intermediate copy
+            else:
+                image_view[:scene['bands'], :h, :w] = src.read(out_dtype=images.dtype)
+        label_view[:h, :w] = read_label(scene['label_path'])
+        if progress is not None:
+            progress.update()
+
+    jobs = [(site, t, scene) for site in sites if site['shard'] == shard
+            for t, scene in enumerate(site['scenes'])]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first failure
+        list(executor.map(lambda job: fill(*job), jobs))
+    for array in (images, labels):
+        array.flush()
+    del images, labels
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(tmp_path, path)
+
+
+def export_shards(dataset_dir=DEFAULT_DATASET_DIR, output_dir=DEFAULT_SHARD_DIR,
+                  shard_gb=DEFAULT_SHARD_GB, workers=8, force=False):
+    """Pack every split of a MOSE tree into memory-mappable .npy shards plus a JSON/CSV index"""
+    mapping = pd.read_csv(os.path.join(dataset_dir, MAPPING_FILENAME),
+                          dtype={'site_number': str, 'original_filename': str, 'new_filename': str})
+    manifest = BuildManifest()
+    index = {'version': INDEX_VERSION, 'splits': {}}
+    exported = []
+
+    for split in SPLITS:
+        sites = scan_sites(mapping[mapping['split'] == split], dataset_dir)
+        target = f"shard_export:{os.path.join(output_dir, split)}"
+        if not sites:
+            # Drop the shards of an earlier export and index the split as empty
+            for path in glob.glob(os.path.join(output_dir, split, "*.npy")):
+                os.remove(path)
+            if target in manifest.entries:
+                manifest.forget(target)
+                manifest.save()
+            index['splits'][split] = {'dtype': None, 'image_shards': [], 'label_shards': [], 'sites': []}
+            continue
+        scenes = [scene for site in sites for scene in site['scenes']]
+        dtype = np.result_type(*{scene['dtype'] for scene in scenes})
+        shards = plan_shards(sites, dtype, shard_gb * 2**30)
+        shard_files = [name for shard in range(len(shards)) for name in shard_filenames(split, shard)]
+        outputs = [os.path.join(output_dir, name) for name in shard_files]
+
+        os.makedirs(os.path.join(output_dir, split), exist_ok=True)
+        key = build_key([p for scene in scenes for p in (scene['image_path'], scene['label_path'])],
+                        {'shard_gb': shard_gb, 'dtype': dtype.str})
+        if not force and manifest.is_up_to_date(target, key, outputs):
+            logger.info(f"⏭️  {split}: {len(shards)} shards up to date")
+        else:
+            logger.info(f"\n=== Packing {len(scenes)} {split} scenes of {len(sites)} sites into {len(shards)} shards ===")
+            manifest.forget(target)
+            with Progress(len(scenes), split, unit="scenes", logger=logger) as progress:
+                for shard, sizes in enumerate(shards):
+                    write_shard(output_dir, split, shard, sizes, sites, dtype, workers, progress)
+            manifest.record(target, key, outputs)
+            manifest.save()
+        # Shards of an earlier, larger export
+        for path in glob.glob(os.path.join(output_dir, split, "*.npy")):
+            if path not in outputs:
+                os.remove(path)
+
+        index['splits'][split] = {
+            'dtype': dtype.str,
+            'image_shards': shard_files[0::2],
+            'label_shards': shard_files[1::2],
+            'sites': [{k: site[k] for k in ('site_number', 'shard', 'image_offset', 'label_offset', 'shape')}
+                      for site in sites],
+        }
+        for site in sites:
+            for t, scene in enumerate(site['scenes']):
+                exported.append(dict({k: scene[k] for k in mapping.columns},
+                                     shard=site['shard'], t=t, height=scene['height'], width=scene['width']))
+
+    # The filename mapping stays the per-scene index: the MOSE columns plus where each scene lives
+    columns = [*mapping.columns, 'shard', 't', 'height', 'width']
+    atomic_write(os.path.join(output_dir, MAPPING_FILENAME), pd.DataFrame(exported, columns=columns).to_csv(index=False))
+    atomic_write(os.path.join(output_dir, INDEX_FILENAME), json.dumps(index, indent=1))
+    logger.info(f"\n✅ Shard index saved to {os.path.join(output_dir, INDEX_FILENAME)} ({len(exported)} scenes)")
+    return index
+
+
+class ShardedDataset:
+    """Read-only view of one split of an export_shards() tree.
+
+    ds[site] is the site's (t, band, y, x) image array and ds.labels(site) its
+    (t, y, x) labels, both memmap views (no per-file open or decode); site is
+    a position or a site number, and ds[site, t, band, y, x] slices directly.
+    Scenes smaller than their site's largest one are zero-padded; their true
+    size is in ds.mapping (height, width).
+    """
+
+    def __init__(self, root=DEFAULT_SHARD_DIR, split="train"):
+        self.root = root
+        self.split = split
+        with open(os.path.join(root, INDEX_FILENAME)) as f:
+            entry = json.load(f)['splits'][split]
+        self.dtype = np.dtype(entry['dtype'])
+        self.image_shards = entry['image_shards']
+        self.label_shards = entry['label_shards']
+        self.sites = entry['sites']
+        self.site_numbers = {site['site_number']: i for i, site in enumerate(self.sites)}
+        mapping = pd.read_csv(os.path.join(root, MAPPING_FILENAME),
+                              dtype={'site_number': str, 'original_filename': str, 'new_filename': str})
+        self.mapping = mapping[mapping['split'] == split].reset_index(drop=True)
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.sites)
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.root, name), mmap_mode='r')
+        return self._arrays[name]
+
+    def site(self, site):
+        """Index entry of a site by position or site number"""
+        return self.sites[self.site_numbers[site] if isinstance(site, str) else site]
+
+    def images(self, site):
+        entry = self.site(site)
+        size = int(np.prod(entry['shape']))
+        flat = self._array(self.image_shards[entry['shard']])
+        return flat[entry['image_offset']:entry['image_offset'] + size].reshape(entry['shape'])
+
+    def labels(self, site):
+        entry = self.site(site)
+        t_count, _, rows, cols = entry['shape']
+        flat = self._array(self.label_shards[entry['shard']])
+        return flat[entry['label_offset']:entry['label_offset'] + t_count * rows * cols].reshape(t_count, rows, cols)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.images(key[0])[key[1:]]
+        return self.images(key)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pack the MOSE dataset into memory-mappable .npy shards")
+    parser.add_argument("--dataset-dir", default=DEFAULT_DATASET_DIR,
+                        help="MOSE tree written by reorganize_dataset.py")
+    parser.add_argument("--output", default=DEFAULT_SHARD_DIR,
+                        help="Directory for the shards, shards.json and filename_mapping.csv")
+    parser.add_argument("--shard-gb", type=float, default=DEFAULT_SHARD_GB,
+                        help="Target image shard size in GB (a site is never split across shards)")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Threads reading scenes into a shard")
+    parser.add_argument("--force", action="store_true",
+                        help="Rewrite every shard, ignoring the build manifest")
+    add_logging_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+    export_shards(args.dataset_dir, args.output, args.shard_gb, args.workers, args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import os
+import pickle
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import pandas as pd
+
+from build_manifest import file_signature
+
+# Written by count_images.py; the split column may be edited by hand
+DEFAULT_COUNTS_PATH = "misc/base_site_counts.csv"
+DEFAULT_CACHE_DIR = "data"
+CACHE_VERSION = 2
+
+# Country key (as it appears in base site names) -> country and continent
+LOCATION_INFO = {
+    'nicaragua': {'country': 'Nicaragua', 'continent': 'North America'},
+    'peru': {'country': 'Peru', 'continent': 'South America'},
+    'russia': {'country': 'Russia', 'continent': 'Asia'},
+    'mozambique': {'country': 'Mozambique', 'continent': 'Africa'},
+    'french_guiana': {'country': 'French Guiana', 'continent': 'South America'},
+    'cameroon': {'country': 'Cameroon', 'continent': 'Africa'},
+    'myanmar': {'country': 'Myanmar', 'continent': 'Asia'},
+    'drc': {'country': 'Democratic Republic of the Congo', 'continent': 'Africa'},
+    'mali': {'country': 'Mali', 'continent': 'Africa'},
+    'mongolia': {'country': 'Mongolia', 'continent': 'Asia'},
+    'nigeria': {'country': 'Nigeria', 'continent': 'Africa'},
+    'senegal': {'country': 'Senegal', 'continent': 'Africa'},
+    'indonesia': {'country': 'Indonesia', 'continent': 'Asia'},
+    'sierra_leone': {'country': 'Sierra Leone', 'continent': 'Africa'},
+    'venezuela': {'country': 'Venezuela', 'continent': 'South America'},
+    'phillipines': {'country': 'Philippines', 'continent': 'Asia'}
+}
+
+# Initial split of each base site, written to base_site_counts.csv by count_images.py
+SPLIT_INFO = {
+    'cameroon_kadei_river_batouri_agm_region': 'train',
+    'drc_lindi_river_upper_agm_region': 'val',
+    'mali_faleme_upper': 'train',
+    'mozambique_manica_TSTM': 'train',
+    'nigeria_ijesa_agm_region_TSTM': 'val',
+    'senegal_river_gambie_agm_region_TSTM': 'test',
+    'sierra_leone_pampan_river_gold_diamond_region': 'test',
+    'indonesia_madreng_agm_region': 'train',
+    'indonesia_kulu_agm_region': 'val',
+    'indonesia_batang_hari_bedaro_agm_region': 'train',
+    'indonesia_west_kalimantan_selimbau_agm_region_TSTM': 'train',
+    'mongolia_gatsuurt_agm_region': 'test',
+    'myanmar_chindwin_river_hkamti_agm_region': 'train',
+    'myanmar_chindwin_river_ningbyen_agm_region': 'train',
+    'myanmar_namsi_awng_agm_region': 'train',
+    'myanmar_theinkun_agm_region': 'train',
+    'myanmar_kawbyin_agm_region_TSTM': 'train',
+    'myanmar_maw_luu_agm_region': 'val',
+    'phillipines_quiniput_downstream_agm_region_TSTM': 'test',
+    'russia_mongolia_border_agm_region': 'val',
+    'russia_novotroitsk_agm_region_TSTM': 'train',
+    'russia_tumnin_agm_region_TSTM': 'train',
+    'russia_koryak_plateau': 'train',
+    'russia_tumnin_tributary_agm_region_TSTM': 'train',
+    'russia_edakuy_agm_region_TSTM': 'train',
+    'nicaragua_somotillo_agm_region': 'test',
+    'french_guiana_deux_branches_agm_region_TSTM': 'test',
+    'peru_la_pampa_south_agm_region': 'train',
+    'peru_rio_quimiri_downstream': 'val',
+    'peru_la_pampa_north_agm_region': 'train',
+    'peru_rio_inambari_channel_agm_region': 'train',
+    'peru_tournavista_agm_region_TSTM': 'train',
+    'venezuela_yapacana_south_agm_region_TSTM': 'test'
+}
+
+# <base site>_<site index>_<YYYYMMDD> (e.g., mali_faleme_upper_1_20200524), with an
+# optional Landsat_Image_ prefix; files without a date are <base site>_<site index>
+SCENE_NAME_PATTERN = re.compile(r'^(?:Landsat_Image_)?(?P<site_no>(?P<base_site>.+?)(?:_\d+)?)_(?P<date>\d{8})$')
+SITE_NO_PATTERN = re.compile(r'^(?:Landsat_Image_)?(?P<base_site>.+?)(?:_\d+)?$')
+
+# Country keys that start a base site name, longest first
+COUNTRY_PREFIX_PATTERN = re.compile(
+    r'^(' + '|'.join(re.escape(k) for k in sorted(LOCATION_INFO, key=len, reverse=True)) + r')(?:_|$)'
+)
+
+SceneName = namedtuple('SceneName', ['base_site', 'site_no', 'date'])
+
+
+@lru_cache(maxsize=None)
+def parse_scene_name(filename):
+    """(base site, site number, date) of an image/label filename; date is None without one.
+
+    e.g., mali_faleme_upper_1_20200524.tif -> ('mali_faleme_upper', 'mali_faleme_upper_1', '20200524')
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    match = SCENE_NAME_PATTERN.match(name)
+    if match:
+        return SceneName(match['base_site'], match['site_no'], match['date'])
+    site_no = name.replace('Landsat_Image_', '')
+    return SceneName(SITE_NO_PATTERN.match(name)['base_site'], site_no, None)
+
+
+@lru_cache(maxsize=None)
+def location_of(base_site):
+    """(country, continent) of a base site, or ('Unknown', 'Unknown')"""
+    key = base_site.lower()
+    match = COUNTRY_PREFIX_PATTERN.match(key)
+    if match:
+        info = LOCATION_INFO[match.group(1)]
+        return info['country'], info['continent']
+    # Country not at the start of the name: fall back to a substring search
+    for country_key, info in LOCATION_INFO.items():
+        if country_key in key:
+            return info['country'], info['continent']
+    return 'Unknown', 'Unknown'
+
+
+def default_cache_path(counts_path):
+    """Catalogue cache in data/ with the other build artifacts, named after the counts CSV"""
+    return os.path.join(DEFAULT_CACHE_DIR, os.path.basename(counts_path) + ".catalog.pkl")
+
+
+class SiteCatalog:
+    """Per base site split and location from base_site_counts.csv, with O(1) lookups by (lowercased) base site"""
+
+    def __init__(self, sites):
+        self.sites = sites  # lowercased base site -> {'base_site', 'split', 'country', 'continent', 'image_count'}
+
+    def __len__(self):
+        return len(self.sites)
+
+    @classmethod
+    def build(cls, counts_path=DEFAULT_COUNTS_PATH):
+        """Build the catalogue from base_site_counts.csv; country and continent come from its columns"""
+        df = pd.read_csv(counts_path, dtype={'base_site': str, 'split': str, 'country': str, 'continent': str})
+        sites = {}
+        for row in df.to_dict('records'):
+            base_site = row['base_site'].strip()
+            split = row.get('split')
+            country, continent = row.get('country'), row.get('continent')
+            if not isinstance(country, str) or not isinstance(continent, str):
+                # Older CSVs without the location columns
+                country, continent = location_of(base_site)
+            sites[base_site.lower()] = {
+                'base_site': base_site,
+                'split': split.strip().lower() if isinstance(split, str) else None,
+                'country': country,
+                'continent': continent,
+                'image_count': int(row['image_count']) if pd.notna(row.get('image_count')) else None,
+            }
+        return cls(sites)
+
+    @classmethod
+    def load(cls, counts_path=DEFAULT_COUNTS_PATH, cache_path=None):
+        """Load the pickled catalogue, rebuilding it when the counts CSV has changed"""
+        cache_path = cache_path or default_cache_path(counts_path)
+        sources = {'counts': file_signature(counts_path)}
+
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                cached = None
+            if cached is not None and cached.get('version') == CACHE_VERSION and cached['sources'] == sources:
+                return cls(cached['sites'])
+
+        catalog = cls.build(counts_path)
+        catalog.save(cache_path, sources)
+        return catalog
+
+    def save(self, cache_path, sources):
+        payload = {'version': CACHE_VERSION, 'sources': sources, 'sites': self.sites}
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    def site(self, base_site):
+        """Catalogue entry of a base site (case-insensitive), or None"""
+        return self.sites.get(base_site.strip().lower())
+
+    def split_of_file(self, filename):
+        """(lowercased base site, split) of an image filename, or (None, None) for unknown sites"""
+        base_site = parse_scene_name(filename).base_site.strip().lower()
+        entry = self.sites.get(base_site)
+        if entry is None or entry['split'] is None:
+            return None, None
+        return base_site, entry['split']
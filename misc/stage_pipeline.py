@@ -0,0 +1,80 @@
+import queue
+import threading
+
+# Items each queue between two stages may hold before the earlier stage blocks
+DEFAULT_DEPTH = 2
+
+# Seconds between checks for a stopped pipeline while blocked on a queue
+POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+def run_pipeline(items, stages, depth=DEFAULT_DEPTH):
+    """Run items through stages (e.g. read, compute, write), each stage on its own thread.
+
+    The first stage is called with the item and every later stage with the
+    previous stage's result, so stage i works on one item while stage i-1
+    works on the next. The queues between stages hold at most depth items:
+    a slow stage blocks the ones before it (backpressure) instead of letting
+    them run ahead and fill memory.
+
+    Yields (item, result, error) in input order; an item whose stage raised
+    skips the remaining stages and comes back with the exception as error.
+    Closing the generator (or an exception in the caller) stops all stages
+    after their current item.
+    """
+    stop = threading.Event()
+    failures = []  # Exceptions from iterating items, re-raised in the caller
+
+    def put(q, entry):
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def drain(q):
+        while not stop.is_set():
+            try:
+                entry = q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if entry is _DONE:
+                return
+            yield entry
+
+    def run_stage(stage, source, outbox):
+        try:
+            for item, value, error in source:
+                if error is None:
+                    try:
+                        value = stage(value)
+                    except Exception as e:
+                        value, error = None, e
+                if not put(outbox, (item, value, error)):
+                    return
+        except BaseException as e:
+            failures.append(e)
+        finally:
+            put(outbox, _DONE)
+
+    threads = []
+    source = ((item, item, None) for item in items)
+    for stage in stages:
+        outbox = queue.Queue(maxsize=depth)
+        threads.append(threading.Thread(target=run_stage, args=(stage, source, outbox), daemon=True))
+        source = drain(outbox)
+    for thread in threads:
+        thread.start()
+
+    try:
+        yield from source
+        if failures:
+            raise failures[0]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+from build_manifest import BuildManifest, build_key
+from label_fusion import CLOUD, MINING
+from label_io import read_label_window
+from run_journal import atomic_write
+from run_log import Progress, add_logging_args, setup_logging, verbosity
+from shard_export import DEFAULT_DATASET_DIR, MAPPING_FILENAME, scene_sources
+from site_catalog import parse_scene_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = "dataset1_composites"
+DEFAULT_MEMORY_MB = 1024
+QUALITY_MODES = ('ndvi', 'latest')
+
+# Bands 1-7 are stored as indices 0-6; NDVI uses B4 (NIR) and B3 (red) as in label_fusion
+NIR, RED = 3, 2
+
+# change.tif classes
+NO_DATA, STABLE_BACKGROUND, STABLE_MINING, MINING_GAIN, MINING_LOSS = range(5)
+
+
+def composite_chunk(images, labels, dates, quality='ndvi'):
+    """Composites and change maps of one chunk of a site's time series, fully vectorized.
+
+    images is (t, band, rows, cols) and labels (t, rows, cols) with the 0/1/2
+    classes; pixels labelled cloud are masked out. dates holds one integer
+    per scene (YYYYMMDD, or the scene number when dates are unknown).
+    Returns a dict of 2-D (or band, rows, cols) arrays.
+    """
+    clear = labels != CLOUD  # (t, rows, cols)
+    clear_count = clear.sum(axis=0, dtype=np.uint16)
+    any_clear = clear_count > 0
+
+    # Cloud-masked median per band: cloudy values become NaN, which sorts after every clear value
+    stack = images.astype(np.float32)
+    np.copyto(stack, np.nan, where=~clear[:, np.newaxis])
+    ordered = np.sort(stack, axis=0)
+    lower = np.take_along_axis(ordered, ((np.maximum(clear_count, 1) - 1) // 2)[np.newaxis, np.newaxis], axis=0)[0]
+    upper = np.take_along_axis(ordered, (clear_count // 2)[np.newaxis, np.newaxis], axis=0)[0]
+    del ordered
+    median = (lower + upper) / 2  # All-cloud pixels stay NaN
+
+    # Quality mosaic: per pixel, every band from the clear scene with the highest NDVI (or the latest one)
+    if quality == 'ndvi':
+        nir, red = stack[:, NIR], stack[:, RED]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = (nir - red) / (nir + red)
+        score[~clear | ~np.isfinite(score)] = -np.inf
+    else:
+        score = np.where(clear, np.arange(len(labels), dtype=np.float32)[:, np.newaxis, np.newaxis], -np.inf)
+    best = np.argmax(score, axis=0)
+    mosaic = np.take_along_axis(stack, best[np.newaxis, np.newaxis], axis=0)[0]
+    mosaic[:, ~any_clear] = np.nan
+
+    # First scene labelled mining, share of clear scenes labelled mining
+    mining = labels == MINING
+    ever_mining = mining.any(axis=0)
+    first_mining = np.where(ever_mining, np.asarray(dates, dtype=np.int32)[np.argmax(mining, axis=0)], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mining_frequency = np.where(any_clear, mining.sum(axis=0) / clear_count, np.nan).astype(np.float32)
+
+    # Change between the first and the last clear observation of each pixel
+    first_clear = np.argmax(clear, axis=0)
+    last_clear = len(labels) - 1 - np.argmax(clear[::-1], axis=0)
+    was_mining = np.take_along_axis(mining, first_clear[np.newaxis], axis=0)[0]
+    is_mining = np.take_along_axis(mining, last_clear[np.newaxis], axis=0)[0]
+    change = np.select([~any_clear, was_mining & is_mining, ~was_mining & is_mining, was_mining & ~is_mining],
+                       [NO_DATA, STABLE_MINING, MINING_GAIN, MINING_LOSS], STABLE_BACKGROUND).astype(np.uint8)
+
+    return {
+        'median': median,
+        'quality_mosaic': mosaic,
+        'clear_count': clear_count,
+        'first_mining': first_mining,
+        'mining_frequency': mining_frequency,
+        'change': change,
+    }
+
+
+# Output name -> (bands, dtype, nodata); None bands means the image's band count
+OUTPUTS = {
+    'median': (None, 'float32', np.nan),
+    'quality_mosaic': (None, 'float32', np.nan),
+    'clear_count': (1, 'uint16', None),
+    'first_mining': (1, 'int32', 0),
+    'mining_frequency': (1, 'float32', np.nan),
+    'change': (1, 'uint8', None),
+}
+
+
+def chunk_rows(scenes, bands, width, itemsize, memory_mb=DEFAULT_MEMORY_MB):
+    """Rows per chunk so reading and compositing one chunk stays within memory_mb"""
+    # Per scene and pixel: the source bands twice while np.stack copies the reads, the float32 stack and
+    # its sorted copy for the median, plus labels, masks and the NDVI score. Per pixel: the outputs
+    # (median and mosaic bands, median halves, maps)
+    bytes_per_row = width * (scenes * (bands * (2 * itemsize + 8) + 12) + bands * 16 + 32)
+    return max(1, int(memory_mb * 2**20 // max(bytes_per_row, 1)))
+
+
+def site_outputs(output_dir, split, site_number):
+    return {name: os.path.join(output_dir, split, site_number, f"{name}.tif") for name in OUTPUTS}
+
+
+def composite_site(scenes, output_dir, split, site_number, quality='ndvi', memory_mb=DEFAULT_MEMORY_MB):
+    """Write the composites of one site, reading its aligned scenes window by window.
+
+    scenes are dicts with image_path, label_path and date, in time order;
+    scenes whose grid differs from the site's most common grid are skipped.
+    Returns the number of scenes used.
+    """
+    grids = []
+    for scene in scenes:
+        with rasterio.open(scene['image_path']) as src:
+            grids.append((src.width, src.height, tuple(src.transform)[:6], src.crs.to_string() if src.crs else None))
+    reference = Counter(grids).most_common(1)[0][0]
+    aligned = [scene for scene, grid in zip(scenes, grids) if grid == reference]
+    if len(aligned) < len(scenes):
+        logger.warning(f"⚠️ {site_number}: skipping {len(scenes) - len(aligned)} scenes not on the site's grid")
+    dates = [scene['date'] for scene in aligned]
+
+    outputs = site_outputs(output_dir, split, site_number)
+    os.makedirs(os.path.dirname(outputs['median']), exist_ok=True)
+    try:
+        with ExitStack() as stack:
+            sources = [stack.enter_context(rasterio.open(scene['image_path'])) for scene in aligned]
+            first = sources[0]
+            profile = dict(driver='GTiff', width=first.width, height=first.height, crs=first.crs,
+                           transform=first.transform, tiled=True, blockxsize=256, blockysize=256,
+                           compress='deflate')
+            writers = {}
+            for name, (count, dtype, nodata) in OUTPUTS.items():
+                writers[name] = stack.enter_context(rasterio.open(
+                    outputs[name] + ".tmp", 'w', count=count or first.count, dtype=dtype, nodata=nodata, **profile))
+
+            rows_per_chunk = chunk_rows(len(sources), first.count, first.width,
+                                        np.dtype(first.dtypes[0]).itemsize, memory_mb)
+            for row_off in range(0, first.height, rows_per_chunk):
+                window = Window(0, row_off, first.width, min(rows_per_chunk, first.height - row_off))
+                images = np.stack([src.read(window=window) for src in sources])
+                labels = np.stack([read_label_window(scene['label_path'], window) for scene in aligned])
+                result = composite_chunk(images, labels, dates, quality)
+                for name, array in result.items():
+                    writers[name].write(array if array.ndim == 3 else array[np.newaxis], window=window)
+                del images, labels, result  # Free this chunk before the next one is read
+        for path in outputs.values():
+            os.replace(path + ".tmp", path)
+    finally:
+        # Partial outputs of a failed site are removed; the finished ones were renamed above
+        for path in outputs.values():
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+    # Scene order and dates of the stack (first_mining holds these dates)
+    atomic_write(os.path.join(os.path.dirname(outputs['median']), "scenes.json"),
+                 json.dumps([{'t': t, 'date': scene['date'], 'original_filename': scene['original_filename']}
+                             for t, scene in enumerate(aligned)], indent=1))
+    return len(aligned)
+
+
+def site_series(dataset_dir=DEFAULT_DATASET_DIR, splits=None, sites=None):
+    """{(split, site_number): scenes in time order} from the MOSE tree and its filename_mapping.csv"""
+    mapping = pd.read_csv(os.path.join(dataset_dir, MAPPING_FILENAME),
+                          dtype={'site_number': str, 'original_filename': str, 'new_filename': str})
+    if splits:
+        mapping = mapping[mapping['split'].isin(splits)]
+    if sites:
+        mapping = mapping[mapping['site_number'].isin(sites)]
+    series = {}
+    for (split, site_number), rows in mapping.groupby(['split', 'site_number'], sort=False):
+        scenes = []
+        for t, row in enumerate(rows.sort_values('file_index').to_dict('records')):
+            image_path, label_path = scene_sources(dataset_dir, split, site_number, row['new_filename'])
+            if image_path is None or label_path is None:
+                logger.warning(f"❌ {split}/{site_number}/{row['new_filename']}: image or label not found")
+                continue
+            date = parse_scene_name(row['original_filename']).date
+            scenes.append(dict(row, image_path=image_path, label_path=label_path,
+                               date=int(date) if date else t + 1))
+        scenes.sort(key=lambda scene: scene['date'])
+        if scenes:
+            series[(split, site_number)] = scenes
+    return series
+
+
+def composite_task(split, site_number, scenes, output_dir, quality, memory_mb):
+    """composite_site() for a worker; returns (site_number, scenes used, error or None)"""
+    try:
+        return site_number, composite_site(scenes, output_dir, split, site_number, quality, memory_mb), None
+    except Exception as e:
+        return site_number, 0, str(e)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cloud-masked composites and mining change maps per site time series")
+    parser.add_argument("--dataset-dir", default=DEFAULT_DATASET_DIR,
+                        help="MOSE tree written by reorganize_dataset.py")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIR,
+                        help="Directory for <split>/<site_number>/*.tif")
+    parser.add_argument("--splits", nargs="+", default=None, help="Only these splits")
+    parser.add_argument("--sites", nargs="+", default=None, help="Only these site numbers")
+    parser.add_argument("--quality", choices=QUALITY_MODES, default='ndvi',
+                        help="Quality mosaic: greenest (highest NDVI) or latest clear scene per pixel")
+    parser.add_argument("--memory-mb", type=float, default=DEFAULT_MEMORY_MB,
+                        help="Memory budget per site; long time series are processed in row chunks that fit")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, one site each (1 = sequential)")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild every site, ignoring the build manifest")
+    add_logging_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(verbosity(args), args.log_file)
+
+    series = site_series(args.dataset_dir, args.splits, args.sites)
+    logger.info(f"\n=== Compositing {len(series)} site time series ===")
+
+    # Sites whose scenes and parameters are unchanged since the last run are skipped
+    manifest = BuildManifest()
+    params = {'quality': args.quality}
+    stale = {}
+    for (split, site_number), scenes in series.items():
+        target = f"temporal_composite:{os.path.join(args.output, split, site_number)}"
+        key = build_key([p for scene in scenes for p in (scene['image_path'], scene['label_path'])], params)
+        outputs = list(site_outputs(args.output, split, site_number).values())
+        if args.force or not manifest.is_up_to_date(target, key, outputs):
+            stale[(split, site_number)] = (target, key, outputs)
+    skipped = len(series) - len(stale)
+
+    failed = 0
+    with Progress(len(series), "Sites", unit="sites", logger=logger) as progress:
+        progress.update(skipped)
+
+        def collect(split, site_number, used, error):
+            nonlocal failed
+            target, key, outputs = stale[(split, site_number)]
+            if error is None:
+                manifest.record(target, key, outputs)
+                logger.debug(f"✅ {split}/{site_number}: {used} scenes")
+            else:
+                manifest.forget(target)
+                logger.error(f"❌ Error compositing {split}/{site_number}: {error}")
+                failed += 1
+            progress.update()
+
+        if args.workers > 1:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = {executor.submit(composite_task, split, site_number, series[(split, site_number)],
+                                           args.output, args.quality, args.memory_mb): split
+                           for split, site_number in stale}
+                for future in as_completed(futures):
+                    collect(futures[future], *future.result())
+        else:
+            for split, site_number in stale:
+                collect(split, *composite_task(split, site_number, series[(split, site_number)],
+                                               args.output, args.quality, args.memory_mb))
+    manifest.save()
+
+    if skipped:
+        logger.info(f"⏭️  Skipped {skipped} up-to-date sites")
+    if failed:
+        logger.error(f"❌ {failed} sites failed")
+    logger.info(f"\n=== Composites written to {args.output}/ ===")
+
+
+if __name__ == "__main__":
+    main()